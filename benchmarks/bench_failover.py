@@ -0,0 +1,203 @@
+"""Failover time and data loss window of --ha: the active bot is killed while poll answers keep coming
+
+Runs an active and a standby offline bot with --ha --webhook on the same port and --data-dir, creates a poll
+in a few chats and posts a steady stream of poll answers, each one from a different member. Halfway through
+the active bot is killed with SIGKILL. Answers that cannot be posted are retried until they are accepted, as
+Telegram does with webhooks. Reports the time from the kill until the standby accepts updates, and the
+answers that were accepted but are missing from the state the standby leaves once it is stopped. A match
+topic created before the kill gets its first message after it, and must get its poll from the standby.
+
+Usage: python benchmarks/bench_failover.py [--storage json] [--flush-interval 1.0] [--lease-interval 0.5] [--rate 200] [--seconds 6] [--runs 3]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import ClientError, ClientSession
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from Config import Config
+from Storage import make_storage
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "src", "main.py")
+CHATS = 5
+FIRST_CHAT_ID = -1001000000000
+FIRST_USER_ID = 100000000
+
+
+class BotProcess:
+    """A bot in its own process, with its log lines collected so the benchmark can wait for one of them"""
+    def __init__(self, args):
+        env = dict(os.environ, FOOTBALLTEAMBOT_VERSION="failover")
+        self.process = subprocess.Popen([sys.executable, MAIN, "0:offline", "--offline", "--ha", "--webhook", "--log-level", "INFO"] + args,
+                                        stderr=subprocess.PIPE, text=True, env=env)
+        self.lines = []
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def read(self):
+        for line in self.process.stderr:
+            self.lines.append(line)
+
+    def wait_for(self, text, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not any(text in line for line in self.lines):
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Bot did not log {text!r}:\n{''.join(self.lines[-20:])}")
+            time.sleep(0.01)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def read_polls(storage, data_dir):
+    """Active polls in data_dir by chat id, read without writing anything"""
+    storage = make_storage(Config(storage=storage, data_dir=data_dir))
+    follower = storage.follower()
+    if follower is None:
+        polls = storage.load_active_match_polls()
+    else:
+        follower.load()
+        polls = follower.polls
+        follower.close()
+    storage.close()
+    return {int(chat_id): poll for chat_id, topics in polls.items() for polls in topics.values() for poll in polls.values()}
+
+
+async def post(session, url, update):
+    """Posts until the update is accepted and returns when it was"""
+    while True:
+        try:
+            async with session.post(url, json=update) as response:
+                if response.status == 200:
+                    return time.monotonic()
+        except ClientError:
+            pass
+        await asyncio.sleep(0.005)
+
+
+def topic_message(index, message_id, **fields):
+    chat = {"id": FIRST_CHAT_ID - index, "type": "supergroup", "title": f"Team {index}", "is_forum": True}
+    sender = {"id": FIRST_USER_ID - 1, "is_bot": False, "first_name": "Admin"}
+    return {"update_id": 2 * index + message_id, "message": dict(fields, message_id=message_id, date=int(time.time()), chat=chat, **{"from": sender},
+                                                                  message_thread_id=10, is_topic_message=True)}
+
+
+async def post_once(url, update):
+    async with ClientSession() as session:
+        await post(session, url, update)
+
+
+async def setup_polls(url, storage, data_dir):
+    async with ClientSession() as session:
+        for index in range(CHATS):
+            await post(session, url, topic_message(index, 1, forum_topic_created={"name": "J1 - Rival", "icon_color": 7322096}))
+            await post(session, url, topic_message(index, 2, text="Vamos"))
+        # Waits for its first message until after the failover
+        await post(session, url, topic_message(CHATS, 1, forum_topic_created={"name": "J1 - Rival", "icon_color": 7322096}))
+    deadline = time.monotonic() + 30
+    while True:
+        polls = read_polls(storage, data_dir)
+        if len(polls) == CHATS:
+            return polls
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Only {len(polls)} polls were created")
+        await asyncio.sleep(0.1)
+
+
+async def answer_stream(url, polls, rate, seconds, active):
+    """Posts rate answers a second for seconds, killing the active bot halfway. Returns when each answer was
+    accepted by member, when the kill happened and when the first answer was accepted after it"""
+    accepted = {}
+    poll_ids = [poll.poll_id for poll in polls.values()]
+    killed_at = recovered_at = None
+    start = time.monotonic()
+    async with ClientSession() as session:
+        for index in range(int(rate * seconds)):
+            await asyncio.sleep(max(0, start + index / rate - time.monotonic()))
+            if killed_at is None and index >= rate * seconds / 2:
+                active.process.send_signal(signal.SIGKILL)
+                killed_at = time.monotonic()
+            user_id = FIRST_USER_ID + index
+            update = {"update_id": 1000 + index, "poll_answer": {"poll_id": poll_ids[index % len(poll_ids)], "option_ids": [0], "option_persistent_ids": ["0"],
+                                                                  "user": {"id": user_id, "is_bot": False, "first_name": f"Member {index}"}}}
+            accepted[user_id] = await post(session, url, update)
+            if killed_at is not None and recovered_at is None:
+                recovered_at = accepted[user_id]
+    return accepted, killed_at, recovered_at
+
+
+def run(args):
+    data_dir = tempfile.mkdtemp(prefix="failover-")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/telegram"
+    options = ["--port", str(port), "--data-dir", data_dir, "--storage", args.storage, "--flush-interval", str(args.flush_interval),
+               "--lease-interval", str(args.lease_interval)]
+    active = BotProcess(options)
+    standby = None
+    try:
+        active.wait_for("Online")
+        polls = asyncio.run(setup_polls(url, args.storage, data_dir))
+        standby = BotProcess(options)
+        standby.wait_for("Standing by")
+        accepted, killed_at, recovered_at = asyncio.run(answer_stream(url, polls, args.rate, args.seconds, active))
+        standby.wait_for("Online")
+        asyncio.run(post_once(url, topic_message(CHATS, 2, text="Vamos")))
+        # Lets the last answers reach the storage before stopping
+        time.sleep(args.flush_interval + 0.5)
+        standby.process.send_signal(signal.SIGTERM)
+        standby.process.wait(timeout=30)
+    finally:
+        for bot in (active, standby):
+            if bot is not None and bot.process.poll() is None:
+                bot.process.kill()
+
+    polls = read_polls(args.storage, data_dir)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    voted = {user_id for poll in polls.values() for user_id in poll.votes}
+    lost = [at for user_id, at in accepted.items() if user_id not in voted]
+    return {
+        "failover": recovered_at - killed_at,
+        "lost": len(lost),
+        "accepted": len(accepted),
+        # Accepted answers before the kill that did not survive it, as seconds before the kill
+        "window": killed_at - min(lost) if lost else 0.0,
+        "pending_topic": FIRST_CHAT_ID - CHATS in polls,
+        "standby_log": [line for line in standby.lines if "Lease acquired" in line or "Followed" in line],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the failover time and data loss window of --ha")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--lease-interval", type=float, default=0.5)
+    parser.add_argument("--rate", type=float, default=200, help="Poll answers posted a second")
+    parser.add_argument("--seconds", type=float, default=6, help="Length of the answer stream, the active bot is killed halfway")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'run':>3} | {'failover':>9} | {'accepted':>8} | {'lost':>5} | {'loss window':>11} | {'pending topic':>13}")
+    for index in range(args.runs):
+        result = run(args)
+        results.append(result)
+        print(f"{index + 1:>3} | {result['failover'] * 1e3:>6.0f} ms | {result['accepted']:>8} | {result['lost']:>5} | {result['window'] * 1e3:>8.0f} ms | {'poll created' if result['pending_topic'] else 'LOST':>13}")
+        for line in result["standby_log"]:
+            print("    " + line.rstrip())
+    print(f"median failover {statistics.median(result['failover'] for result in results) * 1e3:.0f} ms, "
+          f"median loss window {statistics.median(result['window'] for result in results) * 1e3:.0f} ms "
+          f"with --storage {args.storage} --flush-interval {args.flush_interval} --lease-interval {args.lease_interval}")
@@ -0,0 +1,74 @@
+"""Size of the match history and time to query and export it: years of weekly matches of many teams
+
+Usage: python benchmarks/bench_match_history.py [teams] [years] [members]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from MatchHistory import MatchHistory
+from MatchPoll import POLL_DURATION, MatchPoll, available_options
+
+WEEK = 7 * 24 * 60 * 60
+
+
+def archive(history, teams, years, members, seed=1):
+    """Archives two polls a week of every team, in batches as the persistence job writes them"""
+    rng = random.Random(seed)
+    start = time.time() - years * 52 * WEEK
+    for week in range(years * 52):
+        rows = []
+        for team in range(teams):
+            for match in range(2):
+                created_at = start + week * WEEK + match * 3600
+                poll = MatchPoll(f"{team}-{week}-{match}", created_at)
+                for user_id in range(members):
+                    if rng.random() < 0.1:
+                        continue
+                    voted_at = created_at + rng.expovariate(1 / (POLL_DURATION / 4))
+                    poll.add_vote(user_id, rng.randrange(len(available_options)), min(voted_at, poll.deadline - 1))
+                    if rng.random() < 0.1:
+                        poll.add_vote(user_id, rng.randrange(len(available_options)), min(voted_at + 3600, poll.deadline - 1))
+                rows.append(history.row(-1000 - team, 100 + week, poll, poll.deadline))
+        history.append(rows)
+
+
+def timed(function, *args):
+    """Returns the run time of function, and the peak heap of a second run, as tracemalloc slows it down"""
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    teams = int(sys.argv[1]) if len(sys.argv) >= 2 else 50
+    years = int(sys.argv[2]) if len(sys.argv) >= 3 else 5
+    members = int(sys.argv[3]) if len(sys.argv) >= 4 else 25
+    with tempfile.TemporaryDirectory() as directory:
+        history = MatchHistory(directory)
+        start = time.perf_counter()
+        archive(history, teams, years, members)
+        size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+        print(f"Archived {history.archived} polls of {teams} teams over {years} years in {time.perf_counter() - start:.1f}s, {size / 2**20:.1f} MiB")
+        print(f"{'query':<32} | {'time':>9} | {'peak heap':>9}")
+        team = -1000
+        last_year = time.strftime("%Y-%m", time.localtime(time.time() - 365 * 24 * 60 * 60))
+        for name, function, args in (("stats of a team, every year", history.player_stats, (team,)),
+                                     ("stats of a team, last year", history.player_stats, (team, last_year)),
+                                     ("late voters of a team", history.late_voters, (team,)),
+                                     ("export a team to CSV", history.export_csv, (os.path.join(directory, "team.csv"), team)),
+                                     ("export every team to CSV", history.export_csv, (os.path.join(directory, "all.csv"),))):
+            elapsed, peak = timed(function, *args)
+            print(f"{name:<32} | {elapsed * 1e3:>6.0f} ms | {peak / 2**20:>5.1f} MiB")
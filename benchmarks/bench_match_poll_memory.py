@@ -0,0 +1,91 @@
+"""Memory per 1,000 active polls: previous MatchPoll model vs the __slots__ one
+
+The previous model kept votes in dicts keyed by stringified user ids, with the option text and an aware
+datetime in every Vote. It is kept here, trimmed to what holds memory, as the baseline.
+
+Usage: python benchmarks/bench_match_poll_memory.py [voters-per-poll]
+"""
+import datetime
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from MatchPoll import MatchPoll, available_options
+
+POLLS = 1000
+
+
+class LegacyMatchPoll:
+    def __init__(self, poll_id, created_at):
+        self.poll_id = poll_id
+        self.created_at = created_at
+        self.options = available_options
+        self.votes = {}
+        self.previous_votes = {}
+        self.deadline = created_at + datetime.timedelta(days=4)
+
+    def add_vote(self, user_id, option, timestamp):
+        if str(user_id) not in self.votes:
+            self.votes[str(user_id)] = LegacyVote(user_id, option, timestamp)
+        else:
+            self.votes[str(user_id)].option = option
+            self.votes[str(user_id)].timestamp = timestamp
+
+    def delete_vote(self, user_id):
+        vote = self.votes.pop(str(user_id), None)
+        if vote is not None:
+            self.previous_votes[str(user_id)] = vote
+
+
+class LegacyVote:
+    def __init__(self, user_id, option, timestamp):
+        self.user_id = user_id
+        self.option = option
+        self.timestamp = timestamp
+
+
+def legacy_polls(voters):
+    polls = []
+    for i in range(POLLS):
+        poll = LegacyMatchPoll(f"poll-{i}", datetime.datetime.now(tz=datetime.timezone.utc))
+        for user_id in range(voters):
+            # Votes are cast at different times, and user ids are large numbers
+            poll.add_vote(100000000 + user_id, available_options[user_id % len(available_options)], datetime.datetime.now(tz=datetime.timezone.utc))
+        for user_id in range(0, voters, 6):
+            poll.delete_vote(100000000 + user_id)
+        polls.append(poll)
+    return polls
+
+
+def compact_polls(voters):
+    polls = []
+    for i in range(POLLS):
+        poll = MatchPoll(f"poll-{i}", time.time())
+        for user_id in range(voters):
+            poll.add_vote(100000000 + user_id, user_id % len(available_options), time.time())
+        for user_id in range(0, voters, 6):
+            poll.delete_vote(100000000 + user_id)
+        polls.append(poll)
+    return polls
+
+
+def measure(make_polls, voters):
+    tracemalloc.start()
+    polls = make_polls(voters)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del polls
+    return size
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    voters = int(sys.argv[1]) if len(sys.argv) >= 2 else 18
+    print(f"{'model':<10} | {'per 1,000 polls':>15} | {'per vote':>9}")
+    for name, make_polls in (("previous", legacy_polls), ("compact", compact_polls)):
+        size = measure(make_polls, voters)
+        print(f"{name:<10} | {size / 1024:>12.0f} KiB | {size / (POLLS * voters):>7.0f} B")
@@ -0,0 +1,91 @@
+"""register_member time per message in a busy chat: string keyed dict vs MemberRegistry
+
+Replays the messages of a group chat where a few members write most of the time through the register_member
+handler of an offline bot, and through the handler the bot had before the registry for comparison.
+
+Usage: python benchmarks/bench_member_registry.py [messages]
+"""
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from telegram import Update
+
+from Config import Config
+from FootballTeamBot import FootballTeamBot
+
+CHAT_ID = -1001234567890
+logger = logging.getLogger("footballteambot.FootballTeamBot")
+
+
+class StringKeyedMembers:
+    """The handler before MemberRegistry, kept here as the baseline"""
+    def __init__(self):
+        self.chat_members = {}
+
+    async def register_member(self, update, context):
+        msg = update.message
+        await self.register_member_logic(msg.from_user, msg.chat.id)
+
+    async def register_member_logic(self, user, chat_id):
+        logger.debug("Registering member %s in chat %s", user, chat_id)
+        chat_id_str = str(chat_id)
+        if chat_id_str not in self.chat_members:
+            self.chat_members[chat_id_str] = {}
+        user_exists = str(user.id) in self.chat_members[chat_id_str]
+        if not user.is_bot and not user_exists:
+            self.chat_members[chat_id_str][str(user.id)] = {"username": user.username, "full_name": user.full_name}
+
+
+def make_updates(bot, messages, members):
+    # Chat traffic is skewed: a handful of members write most of the messages
+    rng = random.Random(8)
+    weights = [1 / (rank + 1) for rank in range(members)]
+    user_ids = rng.choices(range(members), weights=weights, k=messages)
+    updates = []
+    for update_id, user_id in enumerate(user_ids):
+        updates.append(Update.de_json({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 1700000000 + update_id,
+                "chat": {"id": CHAT_ID, "type": "supergroup", "title": "Team"},
+                "from": {"id": 1000 + user_id, "is_bot": False, "first_name": f"Player{user_id}", "last_name": "Surname", "username": f"player{user_id}"},
+                "text": "Who is coming on Sunday?",
+            },
+        }, bot))
+    return updates
+
+
+async def replay(handler, updates):
+    start = time.perf_counter()
+    for update in updates:
+        await handler(update, None)
+    return (time.perf_counter() - start) / len(updates)
+
+
+async def bench(messages, members, data_dir):
+    bot = FootballTeamBot(config=Config(offline=True, data_dir=data_dir, flush_interval=0))
+    updates = make_updates(bot.app.bot, messages, members)
+    # Stop the persistence writes from being measured, only the handlers are compared
+    bot.persistence.mark_dirty = lambda name, key=None: None
+    return {
+        "string keys": await replay(StringKeyedMembers().register_member, updates),
+        "registry": await replay(bot.register_member, updates),
+    }
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    messages = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    print(f"{'members':>8} | {'handler':<12} | {'per message':>12}")
+    for members in (20, 200, 2000):
+        with tempfile.TemporaryDirectory() as data_dir:
+            for handler, seconds in asyncio.run(bench(messages, members, data_dir)).items():
+                print(f"{members:>8} | {handler:<12} | {seconds * 1e9:>9.0f} ns")
@@ -0,0 +1,52 @@
+"""Overhead of the metrics: an instrumented handler vs the bare handler, and the time to render a scrape
+
+Usage: python benchmarks/bench_metrics.py [calls]
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from Metrics import Metrics
+
+
+async def handle_vote(update, context):
+    pass
+
+
+async def per_call(handler, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        await handler(None, None)
+    return (time.perf_counter() - start) / calls
+
+
+def bench(calls):
+    metrics = Metrics()
+    seconds = metrics.histogram("footballteambot_handler_seconds", "Handler time", ["handler"])
+    errors = metrics.counter("footballteambot_handler_errors_total", "Handler errors", ["handler"])
+    instrumented = metrics.instrument(handle_vote, seconds, errors)
+    results = {
+        "bare handler": asyncio.run(per_call(handle_vote, calls)),
+        "instrumented handler": asyncio.run(per_call(instrumented, calls)),
+    }
+    # A scrape of a bot with 20 handlers and jobs and 200 chats
+    for index in range(20):
+        seconds.observe(0.001, f"handler_{index}")
+    metrics.gauge("footballteambot_members", "Members of each chat", lambda: {(chat_id,): 20 for chat_id in range(200)}, ["chat"])
+    start = time.perf_counter()
+    for _ in range(100):
+        metrics.render()
+    results["render a scrape"] = (time.perf_counter() - start) / 100
+    return results
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    calls = int(sys.argv[1]) if len(sys.argv) >= 2 else 200000
+    print(f"{'case':<22} | {'time':>10}")
+    for case, seconds in bench(calls).items():
+        print(f"{case:<22} | {seconds * 1e6:>7.2f} us")
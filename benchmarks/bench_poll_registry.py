@@ -0,0 +1,56 @@
+"""Poll id lookup time: nested scan over active_match_polls vs PollRegistry
+
+Usage: python benchmarks/bench_poll_registry.py [lookups-per-run]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from MatchPoll import MatchPoll
+from PollRegistry import PollRegistry
+
+TOPICS_PER_CHAT = 4
+
+
+def nested_scan(active_match_polls, poll_id):
+    for chat_id, topics in active_match_polls.items():
+        for topic_id, polls in topics.items():
+            if poll_id in polls:
+                return chat_id, topic_id
+    return None, None
+
+
+def registry_lookup(registry, poll_id):
+    entry = registry.get(poll_id)
+    if entry is None:
+        return None, None
+    return entry.chat_id, entry.topic_id
+
+
+def bench(poll_count, lookups):
+    now = time.time()
+    registry = PollRegistry()
+    for i in range(poll_count):
+        registry.add(-1000000000000 - i // TOPICS_PER_CHAT, i, MatchPoll(f"poll-{i}", now))
+    # Spread the lookups over all the polls so the scan does not always stop in the first chats
+    poll_ids = [f"poll-{i * poll_count // lookups}" for i in range(lookups)]
+
+    results = {}
+    for name, lookup, state in (("nested scan", nested_scan, registry.by_chat), ("registry", registry_lookup, registry)):
+        start = time.perf_counter()
+        for poll_id in poll_ids:
+            lookup(state, poll_id)
+        results[name] = (time.perf_counter() - start) / lookups
+    return results
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    lookups = int(sys.argv[1]) if len(sys.argv) >= 2 else 2000
+    print(f"{'active polls':>12} | {'strategy':<12} | {'per lookup':>12}")
+    for poll_count in (10, 100, 1000, 10000):
+        for strategy, seconds in bench(poll_count, lookups).items():
+            print(f"{poll_count:>12} | {strategy:<12} | {seconds * 1e9:>9.0f} ns")
@@ -0,0 +1,53 @@
+"""Topic title matching time: the old inline re.match vs the compiled templates of a team
+
+Usage: python benchmarks/bench_poll_templates.py [titles-per-run]
+"""
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from PollTemplate import PollTemplate
+from Team import Team
+
+TITLES = {
+    "matching": [f"J{i} - Rival {i}" for i in range(100)],
+    "unmatched": [f"Cena de equipo {i}" for i in range(100)],
+}
+
+
+def inline_match(team, title):
+    return re.match(r"^[JA]\d+\s*-", title)
+
+
+def template_match(team, title):
+    return team.match(title)
+
+
+def bench(team, titles, runs):
+    results = {}
+    for name, match in (("inline re.match", inline_match), ("templates", template_match)):
+        start = time.perf_counter()
+        for _ in range(runs):
+            for title in titles:
+                match(team, title)
+        results[name] = (time.perf_counter() - start) / (runs * len(titles))
+    return results
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    count = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    teams = {
+        "default": Team("default"),
+        # The league template last, so matching titles go through every other pattern first
+        "5 templates": Team("5 templates", [PollTemplate(f"categoría {i}", rf"^C{i}\d+\s*-") for i in range(4)] + [PollTemplate("liga")]),
+    }
+    print(f"{'team':<12} | {'titles':<10} | {'strategy':<16} | {'per title':>10}")
+    for team_name, team in teams.items():
+        for kind, titles in TITLES.items():
+            for strategy, seconds in bench(team, titles, max(1, count // len(titles))).items():
+                print(f"{team_name:<12} | {kind:<10} | {strategy:<16} | {seconds * 1e9:>7.0f} ns")
@@ -0,0 +1,67 @@
+"""Per-vote persistence latency: full rewrite of active_match_polls.json vs journal append
+
+Usage: python benchmarks/bench_vote_journal.py [votes-per-run]
+"""
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from MatchPoll import MatchPoll, available_options
+from VoteJournal import FSYNC_ALWAYS, FSYNC_NEVER, VoteJournal, serialize_polls
+
+VOTERS_PER_POLL = 18
+
+
+def make_polls(poll_count):
+    now = time.time()
+    active_match_polls = {}
+    for i in range(poll_count):
+        chat_id = str(-1000000000000 - i // 4)
+        topic_id = str(i)
+        poll = MatchPoll(f"poll-{i}", now)
+        for user_id in range(VOTERS_PER_POLL):
+            poll.add_vote(user_id, user_id % len(available_options), now)
+        active_match_polls.setdefault(chat_id, {})[topic_id] = {poll.poll_id: poll}
+    return active_match_polls
+
+
+def full_rewrite(active_match_polls, filename):
+    with open(filename, "w") as f:
+        json.dump(serialize_polls(active_match_polls), f)
+
+
+def bench(poll_count, votes, directory):
+    active_match_polls = make_polls(poll_count)
+    results = {}
+
+    filename = os.path.join(directory, f"rewrite-{poll_count}.json")
+    start = time.perf_counter()
+    for _ in range(votes):
+        full_rewrite(active_match_polls, filename)
+    results["full rewrite"] = (time.perf_counter() - start) / votes
+
+    for fsync in (FSYNC_NEVER, FSYNC_ALWAYS):
+        journal = VoteJournal(os.path.join(directory, f"journal-{fsync}-{poll_count}.json"), fsync=fsync, compact_after=votes + 1)
+        now = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+        start = time.perf_counter()
+        for i in range(votes):
+            journal.append([journal.stamp({"op": "vote", "chat_id": "-1000000000000", "topic_id": "0", "poll_id": "poll-0", "user_id": i, "option": available_options[0], "timestamp": now})])
+        results[f"journal (fsync={fsync})"] = (time.perf_counter() - start) / votes
+        journal.close()
+    return results
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    votes = int(sys.argv[1]) if len(sys.argv) >= 2 else 200
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'active polls':>12} | {'strategy':<24} | {'per vote':>12}")
+        for poll_count in (10, 100, 1000):
+            for strategy, seconds in bench(poll_count, votes, directory).items():
+                print(f"{poll_count:>12} | {strategy:<24} | {seconds * 1e6:>9.1f} us")
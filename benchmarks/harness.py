@@ -0,0 +1,530 @@
+"""Benchmark and replay harness for the FootballTeamBot handlers
+
+Builds the bot in offline mode, so every Bot API call is answered and recorded locally, and feeds it a
+stream of updates through Application.process_update, the same path the polling and webhook modes use.
+Reports the throughput, the p50/p99 latency of every kind of update, the daily report time, the bytes
+written to disk and the peak memory.
+
+Streams are JSONL files with one Update per line, as Telegram sends them, so they can also be posted to a
+running bot with tools/post_updates.py. Poll ids are only known once the bot has sent its polls, so poll
+answers may name their poll as "@<chat_id>/<topic_id>", which is replaced by the id of the active poll of
+that topic when the answer is replayed.
+
+The stream is replayed --repeat times, each time on a new bot with empty storage, and the best timings are
+kept. Results can be saved and compared with an earlier run. Latencies, bytes written and memory that grow, or
+throughput that drops, by more than the tolerance are reported as regressions and make the run exit with 1.
+
+The stress command processes thousands of interleaved poll answers of many chats concurrently, as the bot does
+with --concurrent-updates, and exits with 1 if any vote or tally does not match the last answer of its member.
+The topics command deletes a share of the topics in the offline Telegram and exits with 1 unless the daily
+reconciliation purges exactly those, also from the storage.
+
+Usage:
+    python benchmarks/harness.py generate stream.jsonl [--chats 10] [--members 20] [--topics 2] [--seed 1]
+    python benchmarks/harness.py run [stream.jsonl] [--chats 10] [--members 20] [--topics 2] [--storage json] [--repeat 5] [--rate-limits] [--no-catch-all]
+                                     [--save results.json] [--compare baseline.json] [--tolerance 0.2] [--trace-memory]
+    python benchmarks/harness.py stress [--chats 50] [--members 30] [--answers 5000] [--concurrent-updates 64] [--jitter 0.002]
+    python benchmarks/harness.py topics [--chats 50] [--topics 4] [--deleted 0.25]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from Config import Config
+from FootballTeamBot import FootballTeamBot
+from MatchPoll import available_options
+from RateLimiter import RateLimiter
+
+FIRST_CHAT_ID = -1001000000000
+FIRST_USER_ID = 100000000
+FIRST_TOPIC_ID = 1000
+REACTIONS = ("👍", "🔥", "⚽", "👏")
+
+
+def chat(chat_index):
+    return {"id": FIRST_CHAT_ID - chat_index, "type": "supergroup", "title": f"Team {chat_index}", "is_forum": True}
+
+
+def user(chat_index, member):
+    user_id = FIRST_USER_ID + chat_index * 1000 + member
+    return {"id": user_id, "is_bot": False, "first_name": f"Player {member}", "last_name": f"Team {chat_index}", "username": f"player_{chat_index}_{member}"}
+
+
+def generate_updates(chats=10, members=20, topics=2, seed=1):
+    """Yields the updates of a match week: topics are created and get their first message, members chat,
+    then vote all at once, some retract their vote and vote again, and react to messages"""
+    rng = random.Random(seed)
+    update_ids = iter(range(1, sys.maxsize))
+    message_ids = {}
+    date = int(time.time())
+
+    def message(chat_index, member, topic, **content):
+        message_id = message_ids[chat_index] = message_ids.get(chat_index, 0) + 1
+        fields = {"message_id": message_id, "date": date, "chat": chat(chat_index), "from": user(chat_index, member),
+                  "message_thread_id": FIRST_TOPIC_ID + topic, "is_topic_message": True}
+        fields.update(content)
+        return {"update_id": next(update_ids), "message": fields}
+
+    def poll_answer(chat_index, member, topic, option_ids):
+        poll_id = f"@{chat(chat_index)['id']}/{FIRST_TOPIC_ID + topic}"
+        return {"update_id": next(update_ids), "poll_answer": {"poll_id": poll_id, "user": user(chat_index, member), "option_ids": option_ids,
+                "option_persistent_ids": [str(option) for option in option_ids]}}
+
+    everyone = [(chat_index, topic, member) for chat_index in range(chats) for topic in range(topics) for member in range(members)]
+
+    for chat_index in range(chats):
+        for topic in range(topics):
+            yield message(chat_index, 0, topic, forum_topic_created={"name": f"J{topic + 1} - Rival {topic + 1}", "icon_color": 7322096})
+            yield message(chat_index, 0, topic, text="Convocatoria")
+
+    for chat_index, topic, member in everyone:
+        if topic == 0:
+            yield message(chat_index, member, topic, text=f"Hola, soy el jugador {member}")
+
+    votes = {}
+    storm = list(everyone)
+    rng.shuffle(storm)
+    for chat_index, topic, member in storm:
+        option = votes[chat_index, topic, member] = rng.randrange(len(available_options))
+        yield poll_answer(chat_index, member, topic, [option])
+
+    retracted = rng.sample(storm, len(storm) // 5)
+    for chat_index, topic, member in retracted:
+        yield poll_answer(chat_index, member, topic, [])
+    for chat_index, topic, member in retracted[::2]:
+        # A different option than before, which alerts the chat
+        option = (votes[chat_index, topic, member] + 1) % len(available_options)
+        yield poll_answer(chat_index, member, topic, [option])
+
+    for chat_index, topic, member in rng.sample(storm, len(storm) // 2):
+        message_id = rng.randint(1, message_ids[chat_index])
+        yield {"update_id": next(update_ids), "message_reaction": {
+            "chat": chat(chat_index), "message_id": message_id, "date": date, "user": user(chat_index, member),
+            "old_reaction": [], "new_reaction": [{"type": "emoji", "emoji": rng.choice(REACTIONS)}]}}
+
+
+def read_updates(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_updates(filename, updates):
+    with open(filename, "w") as f:
+        for update in updates:
+            f.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def written_bytes():
+    """Bytes this process wrote so far, or None where /proc is not available"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+class Replay:
+    def __init__(self, bot):
+        self.bot = bot
+        self.latencies = {}
+        self.errors = 0
+        self.unresolved = 0
+        bot.app.add_error_handler(self.count_error)
+
+    async def count_error(self, update, context):
+        self.errors += 1
+
+    def kind(self, data):
+        if "poll_answer" in data:
+            return "vote" if data["poll_answer"]["option_ids"] else "retract"
+        if "message_reaction" in data:
+            return "reaction"
+        message = data.get("message")
+        if message is None:
+            return next((key for key in data if key != "update_id"), "unknown")
+        if "forum_topic_created" in message:
+            return "topic created"
+        if (message["chat"]["id"], message.get("message_thread_id")) in self.bot.pending_topics:
+            return "first message"
+        return "message"
+
+    async def resolve(self, data):
+        """Replaces a "@<chat_id>/<topic_id>" poll reference with the id of the active poll of that topic"""
+        poll_answer = data.get("poll_answer")
+        if poll_answer is None or not poll_answer["poll_id"].startswith("@"):
+            return data
+        chat_id, topic_id = poll_answer["poll_id"][1:].split("/")
+        polls = self.bot.polls.by_chat.get(int(chat_id), {}).get(int(topic_id))
+        if not polls:
+            # Polls are sent from the outbound queue, and members can only answer them once they were sent
+            await self.bot.outbound.join()
+            polls = self.bot.polls.by_chat.get(int(chat_id), {}).get(int(topic_id))
+        if not polls:
+            self.unresolved += 1
+            return data
+        return dict(data, poll_answer=dict(poll_answer, poll_id=next(reversed(polls))))
+
+    async def run(self, updates):
+        app = self.bot.app
+        for data in updates:
+            kind = self.kind(data)
+            update = Update.de_json(await self.resolve(data), app.bot)
+            start = time.perf_counter()
+            await app.process_update(update)
+            self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+
+async def replay(updates, storage, data_dir, rate_limits=False, catch_all=True):
+    config = Config(token="0:offline", storage=storage, data_dir=data_dir, offline=True, catch_all=catch_all)
+    bot = FootballTeamBot(config.token, config)
+    if not rate_limits:
+        # Offline calls take no time, so Telegram's limits would be most of what is measured
+        bot.report_fan_out.rate_limiter = RateLimiter(global_rate=float("inf"), chat_rate=float("inf"), chat_burst=float("inf"))
+    app = bot.app
+    runner = Replay(bot)
+    written = written_bytes()
+    async with app:
+        await app.start()
+        try:
+            start = time.perf_counter()
+            await runner.run(updates)
+            elapsed = time.perf_counter() - start
+
+            # Handlers only queue their sends, wait for them without the alert windows
+            drain_start = time.perf_counter()
+            bot.vote_alerts.flush_all()
+            await bot.outbound.join()
+            drain = time.perf_counter() - drain_start
+
+            report_start = time.perf_counter()
+            await bot.daily_report(types.SimpleNamespace(bot=app.bot))
+            await bot.outbound.join()
+            daily_report = time.perf_counter() - report_start
+        finally:
+            await app.stop()
+        await bot.close_storage(app)
+    written = written_bytes() - written if written is not None else directory_size(data_dir)
+
+    api_calls = {}
+    for _, method, _ in app.bot.request.calls:
+        api_calls[method] = api_calls.get(method, 0) + 1
+    handlers = {kind: {"count": len(latencies), "p50_us": percentile(latencies, 0.5) * 1e6, "p99_us": percentile(latencies, 0.99) * 1e6}
+                for kind, latencies in runner.latencies.items()}
+    return {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "throughput": len(updates) / elapsed,
+        "handlers": handlers,
+        "queue_drain_ms": drain * 1e3,
+        "daily_report_ms": daily_report * 1e3,
+        "bytes_written": written,
+        "disk_bytes": directory_size(data_dir),
+        "api_calls": api_calls,
+        "errors": runner.errors,
+        "failed_sends": bot.outbound.failed,
+        "unresolved_polls": runner.unresolved,
+        "active_polls": len(bot.polls.by_poll_id),
+    }
+
+
+def run(args):
+    updates = read_updates(args.stream) if args.stream else list(generate_updates(args.chats, args.members, args.topics, args.seed))
+    if args.trace_memory:
+        tracemalloc.start()
+    results = None
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = best_of(results, asyncio.run(replay(updates, args.storage, data_dir, args.rate_limits, args.catch_all)))
+    if args.trace_memory:
+        results["peak_traced_kib"] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    # Linux reports kilobytes, macOS bytes
+    results["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform == "darwin" else 1)
+    results["setup"] = {"stream": args.stream or f"generated chats={args.chats} members={args.members} topics={args.topics} seed={args.seed}",
+                        "storage": args.storage, "repeat": args.repeat, "rate_limits": args.rate_limits, "catch_all": args.catch_all, "python": platform.python_version(), "trace_memory": args.trace_memory}
+    return results
+
+
+def best_of(best, results):
+    """Keeps the best value of every timing over the repeated runs, which filters out most of the noise"""
+    if best is None:
+        return results
+    best["seconds"] = min(best["seconds"], results["seconds"])
+    best["throughput"] = max(best["throughput"], results["throughput"])
+    best["daily_report_ms"] = min(best["daily_report_ms"], results["daily_report_ms"])
+    best["queue_drain_ms"] = min(best["queue_drain_ms"], results["queue_drain_ms"])
+    for kind, handler in results["handlers"].items():
+        for name in ("p50_us", "p99_us"):
+            best["handlers"][kind][name] = min(best["handlers"][kind][name], handler[name])
+    return best
+
+
+def print_results(results):
+    print(f"{results['updates']} updates in {results['seconds']:.2f}s: {results['throughput']:.0f} updates/s, "
+          f"{results['errors']} errors, {results['unresolved_polls']} unresolved poll answers")
+    print(f"{'update':<14} | {'count':>6} | {'p50':>10} | {'p99':>10}")
+    for kind, handler in sorted(results["handlers"].items()):
+        print(f"{kind:<14} | {handler['count']:>6} | {handler['p50_us']:>7.0f} us | {handler['p99_us']:>7.0f} us")
+    print(f"queued sends:  {results.get('queue_drain_ms', 0):.1f} ms to drain after the stream, {results.get('failed_sends', 0)} failed")
+    print(f"daily report:  {results['daily_report_ms']:.1f} ms for {results['active_polls']} active polls")
+    print(f"bytes written: {results['bytes_written'] / 1024:.0f} KiB, {results['disk_bytes'] / 1024:.0f} KiB on disk")
+    memory = f"peak RSS:      {results['peak_rss_kib'] / 1024:.1f} MiB"
+    if "peak_traced_kib" in results:
+        memory += f", {results['peak_traced_kib'] / 1024:.1f} MiB traced"
+    print(memory)
+    print("API calls:     " + ", ".join(f"{method} {count}" for method, count in sorted(results["api_calls"].items())))
+
+
+def metrics(results):
+    """Yields (name, value, higher_is_better) for every compared metric"""
+    yield "throughput", results["throughput"], True
+    for kind, handler in results["handlers"].items():
+        yield f"{kind} p50", handler["p50_us"], False
+        yield f"{kind} p99", handler["p99_us"], False
+    yield "daily report", results["daily_report_ms"], False
+    yield "bytes written", results["bytes_written"], False
+    yield "peak RSS", results["peak_rss_kib"], False
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of every metric against the baseline and returns the regressed ones"""
+    before = {name: value for name, value, _ in metrics(baseline)}
+    regressions = []
+    print(f"{'metric':<20} | {'baseline':>12} | {'now':>12} | {'change':>8}")
+    for name, value, higher_is_better in metrics(results):
+        if not before.get(name):
+            continue
+        change = value / before[name] - 1
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<20} | {before[name]:>12.1f} | {value:>12.1f} | {change:>+7.0%}{' REGRESSION' if regressed else ''}")
+    return regressions
+
+
+async def stress(chats, members, answers, concurrent_updates, jitter, storage, data_dir, seed):
+    """Processes answers interleaved poll answers of many chats at the same time, as Application does with
+    concurrent updates, and returns the results with the votes that do not match the last answer of their member.
+    Every update first waits up to jitter seconds, like a handler waiting for Telegram, so the updates of a chat
+    overlap and any of them overtaking an earlier one shows up as a wrong vote"""
+    rng = random.Random(seed)
+    config = Config(token="0:offline", storage=storage, data_dir=data_dir, offline=True, concurrent_updates=concurrent_updates)
+    bot = FootballTeamBot(config.token, config)
+    bot.report_fan_out.rate_limiter = RateLimiter(global_rate=float("inf"), chat_rate=float("inf"), chat_burst=float("inf"))
+    app = bot.app
+    runner = Replay(bot)
+    async with app:
+        await app.start()
+        try:
+            # One match topic in every chat, created one update at a time
+            await runner.run(update for update in generate_updates(chats, 1, 1, seed) if "message" in update)
+            await bot.outbound.join()
+
+            async def wait(update, context):
+                await asyncio.sleep(rng.uniform(0, jitter))
+            app.add_handler(TypeHandler(Update, wait), group=-2)
+
+            updates = []
+            expected = {}
+            for update_id in range(answers):
+                chat_index, member = rng.randrange(chats), rng.randrange(members)
+                option_ids = [] if rng.random() < 0.1 else [rng.randrange(len(available_options))]
+                chat_id = chat(chat_index)["id"]
+                poll_id = next(reversed(bot.polls.by_chat[chat_id][FIRST_TOPIC_ID]))
+                expected[chat_id, user(chat_index, member)["id"]] = option_ids[0] if option_ids else None
+                updates.append(Update.de_json({"update_id": update_id, "poll_answer": {"poll_id": poll_id, "user": user(chat_index, member),
+                                               "option_ids": option_ids, "option_persistent_ids": [str(option) for option in option_ids]}}, app.bot))
+
+            start = time.perf_counter()
+            # The same as Application does for every update it fetches
+            await asyncio.gather(*(asyncio.create_task(app.update_processor.process_update(update, app.process_update(update))) for update in updates))
+            elapsed = time.perf_counter() - start
+            bot.vote_alerts.flush_all()
+            await bot.outbound.join()
+        finally:
+            await app.stop()
+        await bot.close_storage(app)
+
+    wrong_votes = 0
+    wrong_tallies = 0
+    for chat_id, topics in bot.polls.by_chat.items():
+        for topic_id, polls in topics.items():
+            poll = polls[next(reversed(polls))]
+            votes = {user_id: vote.option for user_id, vote in poll.votes.items()}
+            wanted = {user_id: option for (chat, user_id), option in expected.items() if chat == chat_id and option is not None}
+            wrong_votes += sum(1 for user_id in votes.keys() | wanted.keys() if votes.get(user_id) != wanted.get(user_id))
+            tallies = [sum(1 for option in votes.values() if option == code) for code in range(len(available_options))]
+            wrong_tallies += tallies != poll.tallies
+    return {
+        "answers": answers,
+        "seconds": elapsed,
+        "throughput": answers / elapsed,
+        "errors": runner.errors,
+        "wrong_votes": wrong_votes,
+        "wrong_tallies": wrong_tallies,
+        "lock_waits": app.update_processor.locks.contended,
+    }
+
+
+async def topic_cleanup(chats, topics, deleted, storage, data_dir, seed):
+    """Creates polls in topics of many chats, plus a topic per chat still waiting for its first message, deletes a
+    share of the topics in the offline Telegram and runs the daily reconciliation a day later, then again within
+    the cache TTL. Returns the results with the topics purged by mistake or left behind, also after a restart"""
+    rng = random.Random(seed)
+    config = Config(token="0:offline", storage=storage, data_dir=data_dir, offline=True)
+    bot = FootballTeamBot(config.token, config)
+    bot.report_fan_out.rate_limiter = RateLimiter(global_rate=float("inf"), chat_rate=float("inf"), chat_burst=float("inf"))
+    app = bot.app
+    runner = Replay(bot)
+    async with app:
+        await app.start()
+        try:
+            updates = [update for update in generate_updates(chats, 1, topics, seed) if "message" in update]
+            for chat_index in range(chats):
+                updates.append({"update_id": len(updates) + 1, "message": {
+                    "message_id": 10000 + chat_index, "date": int(time.time()), "chat": chat(chat_index), "from": user(chat_index, 0),
+                    "message_thread_id": FIRST_TOPIC_ID + topics, "is_topic_message": True,
+                    "forum_topic_created": {"name": f"J{topics + 1} - Rival", "icon_color": 7322096}}})
+            await runner.run(updates)
+            await bot.outbound.join()
+
+            followed = sorted(bot.followed_topics())
+            gone = set(rng.sample(followed, int(len(followed) * deleted)))
+            app.bot.request.deleted_topics.update(gone)
+            calls = len(app.bot.request.calls)
+            tomorrow = time.time() + 24 * 60 * 60
+            start = time.perf_counter()
+            purged = await bot.topics.reconcile(app.bot, followed, tomorrow)
+            elapsed = time.perf_counter() - start
+            checks = len(app.bot.request.calls) - calls
+            calls = len(app.bot.request.calls)
+            await bot.topics.reconcile(app.bot, bot.followed_topics(), tomorrow)
+            cached_checks = len(app.bot.request.calls) - calls
+            await bot.outbound.join()
+        finally:
+            await app.stop()
+        await bot.close_storage(app)
+
+    left = bot.followed_topics()
+    restarted = FootballTeamBot(config.token, config)
+    restarted_topics = {(chat_id, topic_id) for chat_id, topics in restarted.polls.by_chat.items() for topic_id in topics}
+    restarted.storage.close()
+    return {
+        "topics": len(followed),
+        "deleted": len(gone),
+        "purged": len(purged),
+        "seconds": elapsed,
+        "checks": checks,
+        "cached_checks": cached_checks,
+        "archived": bot.history.archived,
+        "errors": runner.errors,
+        "wrongly_purged": len(set(followed) - gone - left),
+        "left_behind": len(gone & (left | restarted_topics)),
+        "live_reports": len(bot.live_reports.reports),
+        "active_polls": len(bot.polls),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot handlers with synthetic or recorded update streams")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stress_command = commands.add_parser("stress", help="Check the votes stay right with concurrent updates")
+    stress_command.add_argument("--chats", type=int, default=50)
+    stress_command.add_argument("--members", type=int, default=30, help="Members of every chat")
+    stress_command.add_argument("--answers", type=int, default=5000, help="Poll answers processed at the same time")
+    stress_command.add_argument("--concurrent-updates", type=int, default=64)
+    stress_command.add_argument("--jitter", type=float, default=0.002, help="Seconds every update may wait before its handlers")
+    stress_command.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    stress_command.add_argument("--seed", type=int, default=1)
+    topics_command = commands.add_parser("topics", help="Check the daily reconciliation purges the deleted topics and only them")
+    topics_command.add_argument("--chats", type=int, default=50)
+    topics_command.add_argument("--topics", type=int, default=4, help="Match topics with a poll in every chat")
+    topics_command.add_argument("--deleted", type=float, default=0.25, help="Share of the topics deleted")
+    topics_command.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    topics_command.add_argument("--seed", type=int, default=1)
+    for name in ("generate", "run"):
+        command = commands.add_parser(name)
+        command.add_argument("stream", nargs="?" if name == "run" else None, help="JSONL file with one Update per line")
+        command.add_argument("--chats", type=int, default=10)
+        command.add_argument("--members", type=int, default=20, help="Members of every chat")
+        command.add_argument("--topics", type=int, default=2, help="Match topics of every chat")
+        command.add_argument("--seed", type=int, default=1)
+    run_command = commands.choices["run"]
+    run_command.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    run_command.add_argument("--repeat", type=int, default=5, help="Runs of the stream, each with a new bot. The best timings are kept")
+    run_command.add_argument("--save", help="Write the results to this JSON file")
+    run_command.add_argument("--compare", help="Results of an earlier run to compare with")
+    run_command.add_argument("--tolerance", type=float, default=0.2, help="Relative change reported as a regression")
+    run_command.add_argument("--rate-limits", action="store_true", help="Pace the API calls with Telegram's rate limits, as the bot does online")
+    run_command.add_argument("--no-catch-all", dest="catch_all", action="store_false", help="Run the bot without registering members from every message and reaction")
+    run_command.add_argument("--trace-memory", action="store_true", help="Also measure the peak Python heap with tracemalloc, which slows every handler")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        updates = list(generate_updates(args.chats, args.members, args.topics, args.seed))
+        write_updates(args.stream, updates)
+        print(f"Wrote {len(updates)} updates to {args.stream}")
+        return 0
+
+    if args.command == "stress":
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = asyncio.run(stress(args.chats, args.members, args.answers, args.concurrent_updates, args.jitter, args.storage, data_dir, args.seed))
+        print(f"{results['answers']} answers in {results['seconds']:.2f}s: {results['throughput']:.0f} answers/s, {results['errors']} errors, "
+              f"{results['lock_waits']} waited for their chat")
+        print(f"{results['wrong_votes']} wrong votes, {results['wrong_tallies']} wrong tallies")
+        return 1 if results["wrong_votes"] or results["wrong_tallies"] or results["errors"] else 0
+
+    if args.command == "topics":
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = asyncio.run(topic_cleanup(args.chats, args.topics, args.deleted, args.storage, data_dir, args.seed))
+        print(f"{results['topics']} topics checked in {results['seconds'] * 1e3:.0f} ms with {results['checks']} calls, "
+              f"{results['cached_checks']} calls again within the TTL, {results['errors']} errors")
+        print(f"{results['deleted']} deleted, {results['purged']} purged, {results['archived']} polls archived, "
+              f"{results['active_polls']} active polls and {results['live_reports']} live reports left")
+        print(f"{results['wrongly_purged']} purged by mistake, {results['left_behind']} left behind")
+        return 1 if results["wrongly_purged"] or results["left_behind"] or results["purged"] != results["deleted"] or results["errors"] else 0
+
+    results = run(args)
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    sys.exit(main())
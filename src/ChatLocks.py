@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger("footballteambot.ChatLocks")
+
+"""Per-chat locks
+
+With concurrent updates, the updates of different chats are processed at the same time while the updates of
+a chat are processed one at a time, in the order they arrived. Handlers can then await Telegram or the
+storage halfway through changing the polls, members or pending topics of a chat without another update of
+the same chat seeing or changing them in between.
+
+Poll and poll answer updates carry no chat, chat_of finds it through the poll id -> chat index of the bot.
+Updates without a chat, like the answers to unknown polls, take no lock.
+
+Locks only exist while some update of their chat is being processed or waiting, so idle chats cost nothing.
+
+"""
+class ChatLocks:
+    def __init__(self):
+        # chat_id -> [lock, updates holding or waiting for it]
+        self.locks = {}
+        self.acquired = 0
+        self.contended = 0
+
+    async def acquire(self, chat_id):
+        entry = self.locks.get(chat_id)
+        if entry is None:
+            entry = self.locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.acquired += 1
+        if entry[0].locked():
+            self.contended += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.forget(chat_id, entry)
+            raise
+
+    def release(self, chat_id):
+        entry = self.locks[chat_id]
+        entry[0].release()
+        self.forget(chat_id, entry)
+
+    def forget(self, chat_id, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[chat_id]
+
+    def __len__(self):
+        return len(self.locks)
+
+    def stats(self):
+        return {"locked_chats": len(self.locks), "acquired": self.acquired, "contended": self.contended}
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to max_concurrent_updates updates at the same time, one at a time for each chat.
+    chat_of returns the chat id of an update, or None for updates that need no lock"""
+
+    def __init__(self, max_concurrent_updates, chat_of):
+        super().__init__(max_concurrent_updates)
+        self.chat_of = chat_of
+        self.locks = ChatLocks()
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self.chat_of(update)
+        if chat_id is None:
+            await coroutine
+            return
+        await self.locks.acquire(chat_id)
+        try:
+            await coroutine
+        finally:
+            self.locks.release(chat_id)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self.locks:
+            logger.warning("Shutting down with updates of %s chats still being processed", len(self.locks))
@@ -0,0 +1,102 @@
+import argparse
+import os
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+"""Bot configuration
+
+Every option can be given on the command line or through a FOOTBALLTEAMBOT_<OPTION> environment variable
+
+"""
+class Config:
+    def __init__(self, token="", storage="json", data_dir=".", fsync="always", flush_interval=1.0, report_workers=8,
+                 webhook=False, listen="127.0.0.1", port=8443, webhook_path="/telegram", webhook_url=None, secret_token=None,
+                 concurrent_updates=32, offline=False, log_level="INFO", telegram_log_level="WARNING", trace_sample_rate=0.0, trace_buffer=0,
+                 migrate=False, shards=0, report_interval=10.0, reminders=(24,), alert_window=30.0, metrics=False, metrics_port=9090,
+                 member_sync=6.0, member_ttl=24.0, catch_all=True, topic_ttl=6.0, teams_reload=60.0,
+                 ha=False, lease_interval=0.5, global_rate=30.0):
+        self.token = token
+        self.storage = storage
+        self.data_dir = data_dir
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.report_workers = report_workers
+        self.webhook = webhook
+        self.listen = listen
+        self.port = port
+        self.webhook_path = webhook_path
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.concurrent_updates = concurrent_updates
+        self.offline = offline
+        self.log_level = log_level
+        self.telegram_log_level = telegram_log_level
+        self.trace_sample_rate = trace_sample_rate
+        self.trace_buffer = trace_buffer
+        self.migrate = migrate
+        self.shards = shards
+        self.report_interval = report_interval
+        self.reminders = reminders
+        self.alert_window = alert_window
+        self.metrics = metrics
+        self.metrics_port = metrics_port
+        self.member_sync = member_sync
+        self.member_ttl = member_ttl
+        self.catch_all = catch_all
+        self.topic_ttl = topic_ttl
+        self.teams_reload = teams_reload
+        self.ha = ha
+        self.lease_interval = lease_interval
+        self.global_rate = global_rate
+
+    @classmethod
+    def from_args(cls, argv=None):
+        parser = argparse.ArgumentParser(description="Football team Telegram bot")
+        parser.add_argument("token", nargs="?", default=env("TOKEN", ""), help="Telegram bot token")
+        parser.add_argument("--storage", choices=["json", "sqlite"], default=env("STORAGE", "json"), help="Storage backend for teams, members and polls")
+        parser.add_argument("--data-dir", default=env("DATA_DIR", "."), help="Directory holding the storage files")
+        parser.add_argument("--fsync", choices=["always", "interval", "never"], default=env("FSYNC", "always"), help="When the JSON vote journal is synced to disk")
+        parser.add_argument("--flush-interval", type=float, default=float(env("FLUSH_INTERVAL", 1.0)), help="Seconds between writes of the changed state. 0 writes every change immediately")
+        parser.add_argument("--report-workers", type=int, default=int(env("REPORT_WORKERS", 8)), help="Chats the outbound queue sends to concurrently")
+        parser.add_argument("--global-rate", type=float, default=float(env("GLOBAL_RATE", 30.0)), help="Telegram API calls a second the whole bot may send, split evenly between the --shards")
+        parser.add_argument("--webhook", action="store_true", default=env("WEBHOOK", "") != "", help="Receive updates through a local webhook server instead of polling")
+        parser.add_argument("--listen", default=env("LISTEN", "127.0.0.1"), help="Address the webhook server listens on")
+        parser.add_argument("--port", type=int, default=int(env("PORT", 8443)), help="Port the webhook server listens on")
+        parser.add_argument("--webhook-path", default=env("WEBHOOK_PATH", "/telegram"), help="Path the webhook server receives updates on")
+        parser.add_argument("--webhook-url", default=env("WEBHOOK_URL", None), help="Public URL registered in Telegram. Without it the webhook is expected to be set up already")
+        parser.add_argument("--secret-token", default=env("SECRET_TOKEN", None), help="Secret token Telegram must send with every webhook request")
+        parser.add_argument("--report-interval", type=float, default=float(env("REPORT_INTERVAL", 10.0)), help="Seconds the live poll reports gather vote changes before their messages are edited")
+        parser.add_argument("--reminders", type=hours, default=hours(env("REMINDERS", "24")), help="Comma separated hours before the deadline of a poll at which the members who did not vote are reminded. Empty disables them")
+        parser.add_argument("--metrics", action="store_true", default=env("METRICS", "") != "", help="Serve Prometheus metrics on /metrics, on the webhook server if there is one")
+        parser.add_argument("--metrics-port", type=int, default=int(env("METRICS_PORT", 9090)), help="Port the metrics are served on when there is no webhook server")
+        parser.add_argument("--alert-window", type=float, default=float(env("ALERT_WINDOW", 30.0)), help="Seconds the vote changes of a topic are gathered into a single alert")
+        parser.add_argument("--member-sync", type=float, default=float(env("MEMBER_SYNC", 6.0)), help="Hours between the syncs of the members of every team. 0 disables them")
+        parser.add_argument("--member-ttl", type=float, default=float(env("MEMBER_TTL", 24.0)), help="Hours a member found in a team is trusted before the sync looks them up again")
+        parser.add_argument("--no-catch-all", dest="catch_all", action="store_false", default=env("NO_CATCH_ALL", "") == "",
+                            help="Do not register members from every message and reaction, only from votes and the member sync")
+        parser.add_argument("--topic-ttl", type=float, default=float(env("TOPIC_TTL", 6.0)), help="Hours a topic found to exist is not checked again")
+        parser.add_argument("--teams-reload", type=float, default=float(env("TEAMS_RELOAD", 60.0)), help="Seconds between checks for teams and poll templates changed in the storage, 0 to disable")
+        parser.add_argument("--concurrent-updates", type=int, default=int(env("CONCURRENT_UPDATES", 32)), help="Updates processed at the same time. Updates of the same chat are always processed one at a time")
+        parser.add_argument("--offline", action="store_true", default=env("OFFLINE", "") != "", help="Answer Telegram API calls locally instead of contacting Telegram, for local testing")
+        parser.add_argument("--log-level", choices=LOG_LEVELS, type=str.upper, default=env("LOG_LEVEL", "INFO"), help="Level of the bot logs")
+        parser.add_argument("--telegram-log-level", choices=LOG_LEVELS, type=str.upper, default=env("TELEGRAM_LOG_LEVEL", "WARNING"), help="Level of the python-telegram-bot logs")
+        parser.add_argument("--trace-sample-rate", type=float, default=float(env("TRACE_SAMPLE_RATE", 0.0)), help="Fraction of the raw updates logged at DEBUG level, between 0 and 1")
+        parser.add_argument("--trace-buffer", type=int, default=int(env("TRACE_BUFFER", 0)), help="Last raw updates kept in memory and logged when a handler fails")
+        parser.add_argument("--shards", type=int, default=int(env("SHARDS", 0)), help="Worker processes the chats are split across. 0 runs the whole bot in one process")
+        parser.add_argument("--ha", action="store_true", default=env("HA", "") != "",
+                            help="Run as the active process only while holding the lease of --data-dir, as a warm standby otherwise")
+        parser.add_argument("--lease-interval", type=float, default=float(env("LEASE_INTERVAL", 0.5)), help="Seconds between the attempts of a standby to take the lease")
+        parser.add_argument("--migrate", action="store_true", help="Import the JSON files in --data-dir into the SQLite database and exit")
+        return cls(**vars(parser.parse_args(argv)))
+
+    def __repr__(self):
+        options = ", ".join(f"{key}={value!r}" for key, value in vars(self).items() if key not in ("token", "secret_token"))
+        return f"Config({options})"
+
+
+def hours(value):
+    return tuple(float(hour) for hour in value.split(",") if hour.strip())
+
+
+def env(option, default):
+    return os.environ.get(f"FOOTBALLTEAMBOT_{option}", default)
@@ -0,0 +1,71 @@
+import heapq
+import logging
+import time
+
+from apscheduler.jobstores.base import JobLookupError
+
+logger = logging.getLogger("footballteambot.DeadlineScheduler")
+
+"""Poll deadlines
+
+Every active poll gets a job that closes it at its deadline, plus a reminder job for every number of hours
+before it in the reminders of the poll, or the configured ones if the poll has none. The jobs of a poll are
+cancelled when the poll is closed for any other reason.
+
+Deadlines are also kept in a min-heap, so the polls whose deadline passed, for instance while a job could
+not run, are found without looking at every poll. Entries of cancelled polls are dropped from the heap
+lazily.
+
+"""
+class DeadlineScheduler:
+    def __init__(self, job_queue, on_deadline, on_reminder, reminders=()):
+        self.job_queue = job_queue
+        self.on_deadline = on_deadline
+        self.on_reminder = on_reminder
+        self.reminders = sorted(reminders, reverse=True)
+        self.heap = []
+        self.jobs = {}
+
+    def schedule(self, poll):
+        now = time.time()
+        jobs = [self.job_queue.run_once(self.deadline_reached, max(0, poll.deadline - now), data=poll.poll_id, name=f"deadline {poll.poll_id}")]
+        for hours in self.reminders if poll.reminders is None else poll.reminders:
+            remind_at = poll.deadline - hours * 60 * 60
+            if remind_at > now:
+                jobs.append(self.job_queue.run_once(self.remind, remind_at - now, data=(poll.poll_id, hours), name=f"reminder {poll.poll_id} {hours}h"))
+        self.cancel(poll.poll_id)
+        self.jobs[poll.poll_id] = jobs
+        heapq.heappush(self.heap, (poll.deadline, poll.poll_id))
+
+    def cancel(self, poll_id):
+        for job in self.jobs.pop(poll_id, ()):
+            try:
+                job.schedule_removal()
+            except JobLookupError:
+                # One-off jobs leave the job queue as soon as they start running
+                pass
+        if len(self.heap) > 2 * len(self.jobs) + 16:
+            self.heap = [(deadline, poll_id) for deadline, poll_id in self.heap if poll_id in self.jobs]
+            heapq.heapify(self.heap)
+
+    def expired(self, now=None):
+        """Returns the scheduled polls whose deadline passed"""
+        now = time.time() if now is None else now
+        poll_ids = []
+        while self.heap and self.heap[0][0] <= now:
+            _, poll_id = heapq.heappop(self.heap)
+            if poll_id in self.jobs:
+                poll_ids.append(poll_id)
+        return poll_ids
+
+    async def deadline_reached(self, context):
+        logger.info("Deadline of poll %s reached", context.job.data)
+        await self.on_deadline(context.bot, context.job.data)
+
+    async def remind(self, context):
+        poll_id, hours = context.job.data
+        logger.info("Sending the %sh reminder of poll %s", hours, poll_id)
+        await self.on_reminder(context.bot, poll_id)
+
+    def __len__(self):
+        return len(self.jobs)
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+
+from telegram.error import RetryAfter
+
+from RateLimiter import RateLimiter, retry_after_seconds
+
+logger = logging.getLogger("footballteambot.FanOut")
+
+"""Rate-limited Telegram API calls
+
+Every call waits for the rate limiter of its chat and RetryAfter errors are retried after the delay
+Telegram asks for. Reads, which post nothing to a chat, only wait for the global rate so they do not take the
+turn of the messages of the chat. The OutboundQueue, the member sync and the topic reconciliation run their calls through
+the FanOut of the bot, so they share its rate limits and its count of flood waits.
+
+"""
+class FanOut:
+    def __init__(self, rate_limiter=None, max_retries=3):
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.flood_waits = 0
+
+    async def call(self, chat_id, call):
+        return await self.paced(call, lambda: self.rate_limiter.acquire(chat_id), chat_id)
+
+    async def read(self, chat_id, call):
+        """Runs a call that only reads chat_id, paced by the global rate alone"""
+        return await self.paced(call, self.rate_limiter.acquire_global, chat_id)
+
+    async def paced(self, call, acquire, chat_id):
+        for attempt in range(self.max_retries + 1):
+            await acquire()
+            try:
+                return await call()
+            except RetryAfter as e:
+                self.flood_waits += 1
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                logger.warning("Flood control in chat %s, retrying in %ss", chat_id, delay)
+                await asyncio.sleep(delay)
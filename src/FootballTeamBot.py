@@ -3,27 +3,43 @@ import random
 import logging
 
 # from distutils.cmd import Command
+import asyncio
 import datetime
-import re
-
-from git import Repo
+import functools
+import signal
+import time
 
 from telegram import Update, User, Chat
-from telegram.error import BadRequest
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, ChatMemberHandler, PollHandler, PollAnswerHandler, CallbackContext, MessageHandler, MessageReactionHandler, filters
-
-from MatchPoll import MatchPoll, available_options
+from telegram.constants import ChatMemberStatus
+from telegram.error import RetryAfter
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, ChatMemberHandler, PollHandler, PollAnswerHandler, CallbackContext, MessageHandler, MessageReactionHandler, TypeHandler, filters
+
+from ChatLocks import ChatUpdateProcessor
+from FanOut import FanOut
+from HighAvailability import LEASE_FILE, Lease, Standby
+from DeadlineScheduler import DeadlineScheduler
+from LiveReport import LiveReports, split_message
+from LogConfig import UpdateTracer
+from MatchHistory import MatchHistory, late_ranking
+from MatchPoll import isoformat, local_zone, to_datetime
+from MemberRegistry import MemberRegistry
+from MemberSync import MemberSync
+from Metrics import Metrics, MetricsServer
+from OfflineRequest import OfflineRequest
+from OutboundQueue import OutboundQueue, SendRun, PRIORITY_ALERT, PRIORITY_POLL, PRIORITY_REPORT
+from PersistenceScheduler import PersistenceScheduler
+from RateLimiter import RateLimiter
+from PollRegistry import PollRegistry
+from PollTemplate import DEFAULT_TEMPLATE, PollTemplate
 from Team import Team
-import json
+from TopicLifecycle import TopicLifecycle
+from Config import Config
+from Startup import StartupTimer, get_version
+from Storage import make_storage
+from VoteChangeAlerts import VoteChangeAlerts
 import os
-import tzlocal
-
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 logger = logging.getLogger("footballteambot")
-logger.setLevel(logging.DEBUG)
-telegram_logger = logging.getLogger("telegram")
-telegram_logger.setLevel(logging.DEBUG)
 
 """Football Telegram Bot
 
@@ -31,81 +47,287 @@ It models a telegram bot and perform some reactions to Telegram commands
 
 """
 class FootballTeamBot:
-    def __init__(self, token = "TOKEN") -> None:
+    def __init__(self, token = "TOKEN", config = None, startup = None) -> None:
         super().__init__()
+        self.config = config or Config(token=token)
+        self.startup = startup or StartupTimer()
         
-        self.version = self.get_git_version(".")
-        logger.info(f"Bot version: {self.version}")
-        self.app = ApplicationBuilder().token(token).post_init(self.set_description).build()
+        self.version = get_version(".")
+        logger.info("Bot version: %s", self.version)
+        self.startup.mark("version")
+        builder = ApplicationBuilder().token(token).post_init(self.post_init).post_stop(self.post_stop).post_shutdown(self.close_storage)
+        # Updates of different chats are processed concurrently, the ones of a chat in order
+        self.update_processor = ChatUpdateProcessor(self.config.concurrent_updates, self.chat_of_update)
+        builder.concurrent_updates(self.update_processor)
+        if self.config.offline:
+            logger.info("Running offline, Telegram API calls are answered locally")
+            builder.token(token or "0:offline").request(OfflineRequest()).get_updates_request(OfflineRequest())
+        self.app = builder.build()
+        self.startup.mark("application")
         logger.info("Initializing bot")
         
-        self.teams = self.load_teams("teams.json")
+        self.storage = make_storage(self.config)
+        logger.info("Using %s in %s", type(self.storage).__name__, self.config.data_dir)
+        self.teams = self.load_teams()
+        self.startup.mark("storage")
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.handler_seconds = self.metrics.histogram("footballteambot_handler_seconds", "Time spent in update handlers and jobs", ["handler"])
+        self.handler_errors = self.metrics.counter("footballteambot_handler_errors_total", "Exceptions raised by update handlers and jobs", ["handler"])
+        self.persistence_seconds = self.metrics.histogram("footballteambot_persistence_seconds", "Time spent writing state to the storage", ["operation"])
+        self.flood_errors = 0
+        self.persistence = PersistenceScheduler(self.app.job_queue, self.config.flush_interval)
+        self.history = MatchHistory(os.path.join(self.config.data_dir, "history"))
+        # Closed polls are archived before their close is journaled or compacted away: a crash in between archives
+        # the poll twice instead of losing it
+        self.persistence.register("history", lambda keys: self.history.take(), self.metrics.timed(self.history.write, self.persistence_seconds, "history"))
+        self.persistence.register("polls", lambda keys: self.storage.take_poll_changes(), self.metrics.timed(self.storage.write_taken_poll_changes, self.persistence_seconds, "polls"),
+                                  after=("history",))
+        self.persistence.register("compaction", lambda keys: self.storage.start_compaction(self.active_match_polls), self.metrics.timed(self.run_compaction, self.persistence_seconds, "compaction"),
+                                  after=("history",))
+        self.persistence.register("chat_members", self.snapshot_chat_members, self.metrics.timed(self.write_chat_members, self.persistence_seconds, "chat_members"))
+        self.report_fan_out = FanOut(RateLimiter(global_rate=self.config.global_rate))
+        # Handlers and jobs queue their sends instead of waiting for them
+        self.outbound = OutboundQueue(self.report_fan_out, workers=self.config.report_workers)
         logger.info("Setting up handlers")
+        self.tracer = UpdateTracer(self.config.trace_sample_rate, self.config.trace_buffer)
+        if self.tracer.enabled():
+            self.app.add_handler(TypeHandler(Update, self.trace_update), group=-1)
+        self.app.add_error_handler(self.handle_error)
 
         self.app.add_handler(ChatMemberHandler(self.handle_chat_membership_update, ChatMemberHandler.MY_CHAT_MEMBER), group=0)
         
         logger.info("Setting up match poll handler")
         self.app.add_handler(MessageHandler(filters.StatusUpdate.FORUM_TOPIC_CREATED, self.handle_topic_created), group=0)
+        self.app.add_handler(CommandHandler("estadisticas", self.handle_stats), group=0)
         self.app.add_handler(MessageHandler(filters.TEXT & filters.IS_TOPIC_MESSAGE, self.handle_first_message), group=1)
-        self.app.add_handler(MessageHandler(filters.ALL, self.register_member), group=2)
-        self.app.add_handler(MessageReactionHandler(self.register_member), group=3)
+        if self.config.catch_all:
+            self.app.add_handler(MessageHandler(filters.ALL, self.register_member), group=2)
+            self.app.add_handler(MessageReactionHandler(self.register_member), group=3)
+        else:
+            logger.info("Members are only registered from their votes and the member sync")
         self.app.add_handler(PollAnswerHandler(self.handle_vote))
         self.app.add_handler(PollHandler(self.handle_poll_update))
+        for handlers in self.app.handlers.values():
+            for handler in handlers:
+                handler.callback = self.metrics.instrument(handler.callback, self.handler_seconds, self.handler_errors)
+        self.startup.mark("handlers")
 
         # Telegram API does not link polls to chats, so we need to keep track of them ourselves
-        self.chat_polls = {}
+        self.polls = PollRegistry()
+        # (chat_id, topic_id) -> template of the match topics waiting for their first message. Topic ids are only unique within a chat
         self.pending_topics = {}
-        self.active_match_polls = self.load_active_match_polls("active_match_polls.json")
-        self.chat_members = self.load_chat_members("chat_members.json")
-        logger.debug(f"Loaded chat members: {self.chat_members}")
+        # Same for the topics whose poll is being sent. They are saved as pending until it is created
+        self.creating_topics = {}
+        self.persistence.register("pending_topics", self.snapshot_pending_topics, self.metrics.timed(self.storage.save_pending_topics, self.persistence_seconds, "pending_topics"))
+        # The members of a chat are loaded the first time the chat needs them
+        self.members = MemberRegistry(self.load_chat_members)
+        self.member_sync = MemberSync(self.app.job_queue, self.members, self.report_fan_out, self.register_member_logic, self.remove_member,
+                                      self.config.member_sync * 60 * 60, self.config.member_ttl * 60 * 60)
+        self.member_sync.sync_job = self.metrics.instrument(self.member_sync.sync_job, self.handler_seconds, self.handler_errors, "member_sync")
+        self.topics = TopicLifecycle(self.report_fan_out, self.purge_topic, self.config.topic_ttl * 60 * 60, self.config.report_workers)
+        self.live_reports = LiveReports(self.app.job_queue, self.members, self.outbound, self.save_report_messages, self.config.report_interval)
+        self.vote_alerts = VoteChangeAlerts(self.app.job_queue, self.outbound, self.config.alert_window)
+        self.deadlines = DeadlineScheduler(self.app.job_queue, self.metrics.instrument(self.close_expired_poll, self.handler_seconds, self.handler_errors),
+                                           self.metrics.instrument(self.send_reminder, self.handler_seconds, self.handler_errors), self.config.reminders)
+        self.lease = None
+        # With --ha the state is restored once this process is the active one
+        if not self.config.ha:
+            self.restore_state(self.load_active_match_polls())
 
         # Daily report job
         logger.info("Scheduling daily report job")
-        local_tz = tzlocal.get_localzone()
-        self.app.job_queue.run_repeating(self.daily_report, interval=60*60*24, first=datetime.time(hour=21, minute=0, tzinfo=local_tz))
-
+        local_tz = local_zone()
+        self.app.job_queue.run_repeating(self.metrics.instrument(self.daily_report, self.handler_seconds, self.handler_errors), interval=60*60*24, first=datetime.time(hour=21, minute=0, tzinfo=local_tz))
+        if self.config.teams_reload > 0:
+            # Poll templates edited in the storage apply without a restart
+            self.app.job_queue.run_repeating(self.metrics.instrument(self.reload_teams, self.handler_seconds, self.handler_errors),
+                                             interval=self.config.teams_reload, first=self.config.teams_reload)
+        self.register_metrics()
+        self.startup.mark("jobs")
+
+    @property
+    def active_match_polls(self):
+        return self.polls.by_chat
+
+    def restore_state(self, active_match_polls):
+        self.polls.load(active_match_polls)
+        logger.info("Loaded %s active polls", len(self.polls))
+        for chat_id, topics in self.storage.load_pending_topics().items():
+            for topic_id, template in topics.items():
+                self.pending_topics[int(chat_id), int(topic_id)] = PollTemplate.from_dict(template)
+        # Chats with polls may predate the registration of teams
+        for chat_id in {int(team_id) for team_id in self.teams} | set(self.polls.by_chat):
+            self.member_sync.schedule(chat_id)
+        for chat_id, topic_id, poll in self.polls:
+            # Reports are edited on the next change, not all of them at startup
+            self.live_reports.add(chat_id, topic_id, poll, publish=False)
+            self.deadlines.schedule(poll)
+        self.startup.mark("polls")
+
+    def acquire_lease(self):
+        """Waits as a warm standby until this process holds the lease, then restores the state the active process left"""
+        self.lease = Lease(os.path.join(self.config.data_dir, LEASE_FILE))
+        if self.lease.acquire():
+            logger.info("Lease acquired, running as the active process")
+            self.restore_state(self.load_active_match_polls())
+            return
+        follower = self.storage.follower()
+        if follower is not None:
+            follower.load()
+        self.startup.mark("standby")
+        Standby(self.lease, follower.follow if follower is not None else lambda: 0, self.config.lease_interval).wait()
+        self.startup.mark("waiting")
+        if follower is not None:
+            follower.finish()
+            logger.info("Followed the journal up to %s", follower.stats())
+            active_match_polls = follower.polls
+        else:
+            active_match_polls = self.load_active_match_polls()
+        # Teams may have changed while on standby, chat members are only read on first use
+        self.teams = self.load_teams()
+        self.restore_state(active_match_polls)
+        logger.info("Took over as the active process")
+
+    def run(self):
         logger.info("Starting bot")
-        self.app.run_polling()
-
-    def __del__(self):
-        logger.info("Stopping bot")
-        self.app.stop()
-        logger.info("Shutting down bot")
-        self.app.shutdown()
+        if self.config.ha:
+            self.acquire_lease()
+        if self.config.webhook:
+            asyncio.run(self.run_webhook())
+        else:
+            self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    async def run_webhook(self):
+        from WebhookServer import WebhookServer
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        server = WebhookServer(self.queue_update, self.config.listen, self.config.port, self.config.webhook_path, self.config.secret_token,
+                               self.metrics if self.config.metrics else None)
+        async with self.app:
+            await self.set_description(self.app)
+            self.startup.mark("telegram")
+            try:
+                await server.start()
+                if self.config.webhook_url:
+                    await self.app.bot.set_webhook(self.config.webhook_url, secret_token=self.config.secret_token, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error("Could not start the webhook, falling back to polling: %s", e)
+                await server.stop()
+                await self.start_metrics_server()
+                await self.app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await self.app.start()
+            self.startup.mark("webhook")
+            self.startup.report()
+
+            await stop.wait()
+            logger.info("Stopping bot")
+            if self.app.updater.running:
+                await self.app.updater.stop()
+            await server.stop()
+            await self.app.stop()
+            await self.post_stop(self.app)
+            await self.close_storage(self.app)
+        logger.info("Bot stopped")
+
+    def register_metrics(self):
+        metrics = self.metrics
+        metrics.gauge("footballteambot_active_polls", "Polls open for votes", lambda: len(self.polls.by_poll_id))
+        metrics.gauge("footballteambot_pending_topics", "Match topics waiting for their first message to get a poll", lambda: len(self.pending_topics))
+        metrics.gauge("footballteambot_teams", "Chats the bot is a member of", lambda: len(self.teams))
+        metrics.gauge("footballteambot_members", "Known members of each chat", lambda: {(chat_id,): len(members) for chat_id, members in self.members.chats.items()}, ["chat"])
+        metrics.gauge("footballteambot_live_reports", "Live reports kept up to date", lambda: len(self.live_reports.reports))
+        metrics.gauge("footballteambot_scheduled_deadlines", "Polls with a scheduled deadline job", lambda: len(self.deadlines))
+        metrics.collected_counter("footballteambot_flood_control_total", "RetryAfter errors returned by Telegram",
+                                  lambda: {("fan_out",): self.report_fan_out.flood_waits, ("handler",): self.flood_errors}, ["source"])
+        metrics.collected_counter("footballteambot_persistence_marks_total", "Changes marked for writing", lambda: self.persistence.marks)
+        metrics.collected_counter("footballteambot_persistence_coalesced_total", "Changes written together with an earlier one", lambda: self.persistence.coalesced)
+        metrics.collected_counter("footballteambot_persistence_writes_total", "Writes of changed state", lambda: self.persistence.writes)
+        metrics.collected_counter("footballteambot_live_report_publishes_total", "Live report updates sent to Telegram", lambda: self.live_reports.publishes)
+        metrics.gauge("footballteambot_updates_in_progress", "Updates being processed", lambda: self.update_processor.current_concurrent_updates)
+        metrics.gauge("footballteambot_locked_chats", "Chats with an update being processed or waiting", lambda: len(self.update_processor.locks))
+        metrics.collected_counter("footballteambot_chat_lock_waits_total", "Updates that waited for an earlier update of their chat", lambda: self.update_processor.locks.contended)
+        metrics.collected_counter("footballteambot_archived_polls_total", "Closed polls written to the match history", lambda: self.history.archived)
+        metrics.gauge("footballteambot_unknown_members", "Members of each synced chat the bot has not seen yet", lambda: {(chat_id,): count for chat_id, count in self.member_sync.unknown_members().items()}, ["chat"])
+        metrics.collected_counter("footballteambot_member_sync_calls_total", "Telegram API calls made by the member sync", lambda: self.member_sync.api_calls)
+        metrics.collected_counter("footballteambot_pruned_members_total", "Members removed because they left their chat", lambda: self.member_sync.pruned)
+        metrics.collected_counter("footballteambot_topic_checks_total", "Topic existence checks, by whether Telegram was asked",
+                                  lambda: {("telegram",): self.topics.checks, ("cache",): self.topics.cache_hits}, ["source"])
+        metrics.collected_counter("footballteambot_deleted_topics_total", "Deleted topics whose polls were purged", lambda: self.topics.deleted)
+        metrics.gauge("footballteambot_outbound_queued", "Telegram API calls waiting in the outbound queue", lambda: len(self.outbound))
+        metrics.collected_counter("footballteambot_outbound_calls_total", "Telegram API calls taken from the outbound queue, by result",
+                                  lambda: {("sent",): self.outbound.sent, ("failed",): self.outbound.failed, ("dropped",): self.outbound.dropped}, ["result"])
+        metrics.collected_counter("footballteambot_vote_changes_total", "Vote changes reported to the vote change alerts", lambda: self.vote_alerts.changes)
+        metrics.collected_counter("footballteambot_vote_change_alerts_total", "Vote change alert messages sent", lambda: self.vote_alerts.alerts)
+
+    async def post_init(self, app):
+        await self.set_description(app)
+        await self.start_metrics_server()
+        self.startup.mark("telegram")
+        self.startup.report()
+
+    async def start_metrics_server(self):
+        if not self.config.metrics or self.metrics_server is not None:
+            return
+        self.metrics_server = MetricsServer(self.metrics, self.config.listen, self.config.metrics_port)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            logger.error("Could not start the metrics server: %s", e)
+            self.metrics_server = None
+
+    async def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+
+    async def post_stop(self, app):
+        # The alerts waiting for their window to end are sent now, and the queued calls get a few seconds to go out
+        self.vote_alerts.flush_all()
+        await self.outbound.stop()
+        await self.stop_metrics_server()
+
+    async def queue_update(self, data):
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+
+    async def trace_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.tracer.trace(update)
+
+    async def handle_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        logger.error("Error handling update %s", update, exc_info=context.error)
+        if isinstance(context.error, RetryAfter):
+            self.flood_errors += 1
+        self.tracer.dump()
+
+    async def close_storage(self, app):
+        self.persistence.flush_now()
+        logger.info("Persistence stats: %s", self.persistence.stats())
+        logger.info("Live report stats: %s", self.live_reports.stats())
+        logger.info("Outbound queue stats: %s, vote change alerts: %s", self.outbound.stats(), self.vote_alerts.stats())
+        logger.info("Chat lock stats: %s", self.update_processor.locks.stats())
+        logger.info("Match history stats: %s", self.history.stats())
+        logger.info("Member sync stats: %s", self.member_sync.stats())
+        logger.info("Topic stats: %s", self.topics.stats())
+        self.storage.close()
 
     async def set_description(self, app:ApplicationBuilder):
         bot: Bot = app.bot
-        bot_name = (await bot.get_me()).first_name
+        # Application.initialize already fetched the bot user
+        bot_name = bot.first_name
         bot_description = await bot.get_my_description()
-        logger.debug(f"Current bot description: {bot_description}")
+        logger.debug("Current bot description: %s", bot_description)
         description = f"{bot_name}. Version {self.version}. Owner @emiliogq"
-        logger.debug(f"Setting bot description to: {description}")
+        if bot_description.description == description:
+            return
+        logger.debug("Setting bot description to: %s", description)
         await app.bot.set_my_description(description)
 
 
-    def get_git_version(self, repo_path):
-        try:
-            repo = Repo(repo_path)
-            desc = repo.git.describe('--tags', '--long', '--always')
-            logger.debug(f"Git describe output: {desc}")
-            # Parse parts
-            parts = desc.split('-')
-            if len(parts) == 3:
-                tag, commits_ahead, commit = parts
-                commit = commit.lstrip('g')
-                if commits_ahead == "0":
-                    return f"{tag} ({commit})"
-                else:
-                    return f"{tag}+{commits_ahead} ({commit})"
-            return desc
-        except Exception as e:
-            logger.error(f"Error getting git version: {e}")
-            return "unknown"
-
-
-
     async def handle_chat_membership_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.debug(f"Handling chat membership update: {update}")
         chat_member_update = update.my_chat_member
         if not chat_member_update:
             return
@@ -115,320 +337,377 @@ class FootballTeamBot:
         user = chat_member_update.new_chat_member.user
         chat = chat_member_update.chat
 
-        logger.debug(f"Chat membership update for user {user} in chat {chat}: {old_status} -> {new_status}")
+        logger.debug("Chat membership update for user %s in chat %s: %s -> %s", user, chat, old_status, new_status)
 
         if new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR] and old_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
             # Bot was added to a group
-            logger.info(f"Bot was added to group {chat.title} ({chat.id}) by user {user.full_name} ({user.id})")
+            logger.info("Bot was added to group %s (%s) by user %s (%s)", chat.title, chat.id, user.full_name, user.id)
             if str(chat.id) not in self.teams:
                 self.register_team(chat.id, chat.title)
 
         elif new_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED] and old_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR]:
             # Bot was removed from a group
-            logger.info(f"Bot was removed from group {chat.title} ({chat.id}) by user {user.full_name} ({user.id})")
+            logger.info("Bot was removed from group %s (%s) by user %s (%s)", chat.title, chat.id, user.full_name, user.id)
             if str(chat.id) in self.teams:
                 self.delete_team(chat.id)
 
     def register_team(self, chat_id, chat_title):
-        logger.info(f"Registering team for chat {chat_title} ({chat_id})")
+        logger.info("Registering team for chat %s (%s)", chat_title, chat_id)
         team = Team(chat_title)
         self.teams[str(chat_id)] = team
-        self.save_teams("teams.json")
-        logger.info(f"Registered team for chat {chat_id}")
-
-    def save_teams(self, filename):
-        data = {}
-        for team_id, team in self.teams.items():
-            data[team_id] = {
-                "name": team.name,
-            }
-        logger.debug(f"Saving teams: {data}")
-        with open(filename, "w") as f:
-            json.dump(data, f)
-        logger.debug(f"Saved teams to {filename}")
+        self.save_teams(str(chat_id))
+        self.member_sync.schedule(int(chat_id), first=5)
+        logger.info("Registered team for chat %s", chat_id)
+
+    def save_teams(self, team_id=None):
+        logger.debug("Saving teams: %s", self.teams)
+        self.storage.save_teams(self.teams, team_id)
+        logger.debug("Saved teams")
 
     
     def delete_team(self, team_id):
         if str(team_id) in self.teams:
             team_name = self.teams[str(team_id)].name
             del self.teams[str(team_id)]
-            self.save_teams("teams.json")
-            logger.info(f"Deleted team '{team_name}' for chat {team_id}")
-
-    def load_teams(self, filename):
-        teams = {}
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                data = json.load(f)
-                for team_id, team_data in data.items():
-                    team = Team(team_data['name'])
-                    teams[str(team_id)] = team
-        logger.debug(f"Loaded teams: {teams}")
-        return teams
+            self.save_teams(str(team_id))
+            self.member_sync.cancel(int(team_id))
+            logger.info("Deleted team '%s' for chat %s", team_name, team_id)
 
-    def load_chat_members(self, filename):
-        chat_members = {}
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                chat_members = json.load(f)
-        return chat_members
+    def load_teams(self):
+        teams = self.storage.load_teams()
+        logger.info("Loaded %s teams", len(teams))
+        return teams
 
-    def save_chat_members(self, chat_members_file):
-        with open(chat_members_file, "w") as f:
-            json.dump(self.chat_members, f)
+    async def reload_teams(self, context: ContextTypes.DEFAULT_TYPE):
+        if not await asyncio.to_thread(self.storage.teams_changed):
+            return
+        try:
+            teams = await asyncio.to_thread(self.storage.load_teams)
+        except (OSError, ValueError) as e:
+            # A file caught in the middle of an edit is read again on the next check
+            logger.warning("Could not reload the teams: %s", e)
+            return
+        self.teams = teams
+        logger.info("Reloaded %s teams with %s poll templates", len(teams), sum(len(team.templates) for team in teams.values()))
+
+    def match_template(self, chat_id, title):
+        team = self.teams.get(str(chat_id))
+        if team is None:
+            # Chats with polls may predate the registration of teams
+            return DEFAULT_TEMPLATE if DEFAULT_TEMPLATE.regex.match(title) is not None else None
+        return team.match(title)
+
+    def load_chat_members(self, chat_id):
+        return self.storage.load_chat_members(chat_id)
+
+    def save_chat_members(self, chat_id=None, user_id=None):
+        self.persistence.mark_dirty("chat_members", None if chat_id is None else (chat_id, user_id))
+
+    def snapshot_pending_topics(self, keys):
+        pending_topics = {}
+        for (chat_id, topic_id), template in (self.pending_topics | self.creating_topics).items():
+            pending_topics.setdefault(str(chat_id), {})[str(topic_id)] = template.to_dict()
+        return pending_topics
+
+    def snapshot_chat_members(self, changed):
+        return self.members.to_dict(changed), changed
+
+    def write_chat_members(self, state):
+        chat_members, changed = state
+        self.storage.save_chat_members(chat_members, changed)
     
-    def load_active_match_polls(self, filename):
-        logger.debug(f"Loading active match polls from {filename}")
-        active_match_polls = {}
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                data = json.load(f)
-                for chat_id, topics in data.items():
-                    active_match_polls[chat_id] = {}
-                    for topic_id, polls in topics.items():
-                        active_match_polls[chat_id][topic_id] = {}
-                        for poll_id, poll_data in polls.items():
-                            poll = MatchPoll(poll_data['poll_id'], datetime.datetime.fromisoformat(poll_data['created_at']))
-                            for user_id, vote_data in poll_data['votes'].items():
-                                poll.add_vote(vote_data['user_id'], vote_data['option'], datetime.datetime.fromisoformat(vote_data['timestamp']))
-                            active_match_polls[chat_id][topic_id][poll_id] = poll
-                            self.chat_polls[poll.poll_id] = chat_id
-
-        logger.debug(f"Loaded active match polls: {active_match_polls}")
-        return active_match_polls
+    def load_active_match_polls(self):
+        logger.debug("Loading active match polls with %s", type(self.storage).__name__)
+        return self.storage.load_active_match_polls()
     
-    def save_active_match_polls(self, filename):
-        data = {}
-        for chat_id, topics in self.active_match_polls.items():
-            data[chat_id] = {}
-            for topic_id, polls in topics.items():
-                data[chat_id][topic_id] = {}
-                for poll_id, poll in polls.items():
-                    data[chat_id][topic_id][poll_id] = {
-                        'poll_id': poll.poll_id,
-                        'created_at': poll.created_at.isoformat(),
-                        'votes': {str(user_id): {'user_id': vote.user_id, 'option': vote.option, 'timestamp': vote.timestamp.isoformat()} for user_id, vote in poll.votes.items()}
-                    }
-        logger.debug(f"Saving active match polls: {data}")
-        with open(filename, "w") as f:
-            json.dump(data, f)
+    def record_poll_change(self, op, chat_id, topic_id, poll_id, **fields):
+        start = time.perf_counter()
+        self.storage.record_poll_change(op, chat_id, topic_id, poll_id, **fields)
+        self.persistence_seconds.observe(time.perf_counter() - start, "record_poll_change")
+        self.persistence.mark_dirty("polls")
+        if self.storage.should_compact():
+            self.persistence.mark_dirty("compaction")
+
+    def close_poll(self, chat_id, topic_id, poll):
+        closed_at = time.time()
+        # The persistence writes the history before the poll changes
+        self.history.add(self.history.row(chat_id, topic_id, poll, closed_at))
+        self.persistence.mark_dirty("history")
+        self.record_poll_change("close", chat_id, topic_id, poll.poll_id, closed_at=isoformat(closed_at))
+        self.live_reports.remove(poll.poll_id)
+        self.deadlines.cancel(poll.poll_id)
+
+    def save_report_messages(self, report):
+        self.record_poll_change("report", report.chat_id, report.topic_id, report.poll.poll_id, message_ids=list(report.message_ids))
+
+    def run_compaction(self, compaction):
+        if compaction is not None:
+            compaction()
     
 
-    async def stop_match_poll(self, context: ContextTypes.DEFAULT_TYPE, chat_id, topic_id, poll_id):
-        logger.debug(f"Stopping poll {poll_id} in chat {chat_id}, topic {topic_id}")
-        await context.bot.stop_poll(chat_id=chat_id, message_id=poll_id)
+    async def stop_match_poll(self, bot, chat_id, topic_id, poll):
+        if poll.message_id is None:
+            logger.warning("Poll %s in chat %s, topic %s was created by an older version, its message is unknown and it cannot be stopped", poll.poll_id, chat_id, topic_id)
+            return
+        logger.debug("Stopping poll %s in chat %s, topic %s", poll.poll_id, chat_id, topic_id)
+        await bot.stop_poll(chat_id=chat_id, message_id=poll.message_id)
 
     async def register_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.debug(f"Received update {update}")
-        msg = update.message
-        user = msg.from_user
-        chat = msg.chat
-        await self.register_member_logic(user, chat.id)
-
-    async def register_member_logic(self, user: User, chat_id: int):
-        logger.debug(f"Registering member {user} in chat {chat_id}")
-        chat_id_str = str(chat_id)
-        if chat_id_str not in self.chat_members:
-            self.chat_members[chat_id_str] = {}
-        user_exists = str(user.id) in self.chat_members[chat_id_str]
-        logger.debug(f"User exists: {user_exists} ({str(user.id) in self.chat_members[chat_id_str]})")
-        logger.debug(f"Current members in chat {chat_id_str}: {self.chat_members[chat_id_str]}")
-        logger.debug(f"Keys: {self.chat_members[chat_id_str].keys()}")
-        if not user.is_bot and not user_exists:
-            self.chat_members[chat_id_str][str(user.id)] = {"username": user.username, "full_name": user.full_name}
-            logger.info(f"Registered member {user} in chat {chat_id}")
-            self.save_chat_members("chat_members.json")
-
-
-    def get_chat_id_from_poll_id(self, poll_id):
-        for chat_id, topics in self.active_match_polls.items():
-            for topic_id, polls in topics.items():
-                if poll_id in polls:
-                    return chat_id, topic_id
-        return None, None
-
-    async def check_topic_exists(self, context, chat_id, thread_id):
-        try:
-            # You can use send_message or get_forum_topic (if supported)
-            await context.bot.get_forum_topic(chat_id, thread_id)
-            return True
-        except BadRequest as e:
-            logger.debug(f"Error checking topic existence: {e}")
-            if "message thread not found" in str(e):
-                logger.info(f"Topic {thread_id} was deleted.")
-                # Clean up local data here
-                if thread_id in self.pending_topics:
-                    await self.handle_topic_deleted(context, chat_id, thread_id)
-                    return False
-            else:
-                raise
-    
+        # Runs for every message and reaction. Update.effective_user and effective_chat check every kind of
+        # update, which costs more than the registry lookup, so plain messages go straight to their fields
+        message = update.message
+        if message is not None:
+            user = message.from_user
+            chat = message.chat
+        else:
+            user = update.effective_user
+            chat = update.effective_chat
+        # Anonymous reactions and channel posts have no user
+        if user is not None and chat is not None:
+            self.register_member_logic(user, chat.id)
+
+    def register_member_logic(self, user: User, chat_id: int):
+        if self.members.seen(chat_id, user):
+            self.save_chat_members(chat_id, user.id)
+            for entry in self.polls.polls_in_chat(chat_id):
+                self.live_reports.changed(entry.poll.poll_id, user.id)
+
+
+    def chat_of_update(self, update: Update):
+        # Called for every update before its handlers, so messages go straight to their chat as in register_member
+        message = update.message
+        if message is not None:
+            return message.chat.id
+        if update.poll_answer is not None:
+            entry = self.polls.get(update.poll_answer.poll_id)
+            return None if entry is None else entry.chat_id
+        if update.poll is not None:
+            entry = self.polls.get(update.poll.id)
+            return None if entry is None else entry.chat_id
+        chat = update.effective_chat
+        return None if chat is None else chat.id
+
+    def remove_member(self, chat_id, user_id):
+        if self.members.remove(chat_id, user_id):
+            self.save_chat_members(chat_id, user_id)
+            for entry in self.polls.polls_in_chat(chat_id):
+                self.live_reports.changed(entry.poll.poll_id, user_id)
+
     async def daily_report(self, context: ContextTypes.DEFAULT_TYPE):
-        polls_to_remove = []
-        for chat_id, topics in self.active_match_polls.items():
-            logger.debug(f"Processing daily report for chat {chat_id}. Active topics: {topics.keys()}")
-            for topic_id, polls in topics.items():
-                logger.debug(f"Processing topic {topic_id} with polls: {polls.keys()}")
-                for poll_id in polls:
-                    poll: MatchPoll = polls[poll_id]
-                    logger.debug(f"Processing poll {poll}")
-                    if not poll.is_active():
-                        logger.info(f"Poll {poll.poll_id} in chat {chat_id}, topic {topic_id} is not active anymore, stopping it")
-                        try:
-                            await self.stop_match_poll(context, chat_id, topic_id, poll.poll_id)
-                        except Exception as e:
-                            logger.error(f"Error stopping poll {poll.poll_id}: {e}")
-                        polls_to_remove.append((chat_id, topic_id, poll.poll_id))
-                    else:
-                        logger.info(f"Generating daily report for poll {poll.poll_id} in chat {chat_id}, topic {topic_id}")
-                        members = self.chat_members[str(chat_id)]
-                        logger.debug(f"Members: {members}")
-                        report = poll.report(members)
-                        await context.bot.send_message(chat_id=chat_id, message_thread_id=topic_id, text=report, parse_mode="HTML", disable_web_page_preview=True)
-        for chat_id, topic_id, poll_id in polls_to_remove:
-            if chat_id in self.active_match_polls and topic_id in self.active_match_polls[chat_id] and poll_id in self.active_match_polls[chat_id][topic_id]:
-                del self.active_match_polls[chat_id][topic_id][poll_id]
-                logger.debug(f"Closed poll {poll_id} removed from active polls")
-
-    async def make_match_poll(self, context: ContextTypes.DEFAULT_TYPE, chat_id, topic_id, question, options):
-        logger.debug(f"Creating poll in chat {chat_id}, topic {topic_id} with question '{question}' and options {options}")
-        now = datetime.datetime.now(tz=tzlocal.get_localzone())
+        run = SendRun("daily report")
+        # Deadline jobs close the polls on time, this only catches the ones whose job could not run
+        for poll_id in self.deadlines.expired():
+            await self.close_expired_poll(context.bot, poll_id, run)
+        # Polls of deleted topics are purged so they are not reported anymore
+        await self.topics.reconcile(context.bot, self.followed_topics())
+        # The live reports are refreshed instead of posting a new one every day
+        for chat_id, topic_id, poll in self.polls:
+            self.live_reports.changed(poll.poll_id)
+        await self.live_reports.flush(run=run)
+        # Handlers keep going meanwhile, only this job waits for its sends to log how long they took
+        await run.wait()
+
+    def followed_topics(self):
+        """(chat_id, topic_id) of the topics with active polls or waiting for their first message"""
+        topics = {(chat_id, topic_id) for chat_id, topics in self.polls.by_chat.items() for topic_id in topics}
+        topics.update(self.pending_topics)
+        topics.update(self.creating_topics)
+        return topics
+
+    def purge_topic(self, chat_id, topic_id):
+        """Forgets a deleted topic. Its polls are closed and archived, there is no poll message left to stop"""
+        if self.pending_topics.pop((chat_id, topic_id), None) is not None or self.creating_topics.pop((chat_id, topic_id), None) is not None:
+            self.persistence.mark_dirty("pending_topics")
+        for chat_id, topic_id, poll in self.polls.remove_topic(chat_id, topic_id):
+            logger.info("Poll %s was in deleted topic %s of chat %s, closing it", poll.poll_id, topic_id, chat_id)
+            self.close_poll(chat_id, topic_id, poll)
+
+    async def close_expired_poll(self, bot, poll_id, run=None):
+        entry = self.polls.remove(poll_id)
+        if entry is None:
+            return
+        chat_id, topic_id, poll = entry
+        logger.info("Poll %s in chat %s, topic %s is not active anymore, stopping it", poll_id, chat_id, topic_id)
+        self.close_poll(chat_id, topic_id, poll)
+        self.outbound.submit(chat_id, PRIORITY_POLL, f"Stopping poll {poll_id}", functools.partial(self.stop_match_poll, bot, chat_id, topic_id, poll), run=run)
+
+    async def send_reminder(self, bot, poll_id):
+        entry = self.polls.get(poll_id)
+        if entry is None:
+            return
+        chat_id, topic_id, poll = entry
+        pending = [member.mention() for user_id, member in self.members.members_of(chat_id).items() if user_id not in poll.votes]
+        if not pending:
+            return
+        lines = [f"Recordatorio: la convocatoria se cierra el {to_datetime(poll.deadline).strftime('%d-%m-%Y %H:%M')}. Aún no han votado:"] + pending
+        for text in split_message(lines, separator="\n"):
+            self.outbound.submit(chat_id, PRIORITY_REPORT, f"Reminder of poll {poll_id}",
+                                 functools.partial(bot.send_message, chat_id=chat_id, message_thread_id=topic_id, text=text, parse_mode="HTML", disable_web_page_preview=True))
+
+    async def make_match_poll(self, context: ContextTypes.DEFAULT_TYPE, chat_id, topic_id, template):
+        logger.debug("Creating poll in chat %s, topic %s from template %s", chat_id, topic_id, template)
+        now = time.time()
         poll_msg = await context.bot.send_poll(
             chat_id=chat_id,
             message_thread_id=topic_id,
-            question=question,
-            options=options,
+            question=template.question,
+            options=template.options,
             is_anonymous=False,
             allows_multiple_answers=False,
             type="regular",
         )
-        logger.debug(f"Poll created: {poll_msg}")
-        if chat_id not in self.active_match_polls:
-            self.active_match_polls[chat_id] = {}
-        
-        if topic_id not in self.active_match_polls[chat_id]:
-            self.active_match_polls[chat_id][topic_id] = {} 
-        
-        self.active_match_polls[chat_id][topic_id][poll_msg.poll.id] = MatchPoll(poll_msg.poll.id, now) 
-        self.chat_polls[poll_msg.poll.id] = chat_id
+        logger.debug("Poll created: %s", poll_msg)
+        self.topics.seen(chat_id, topic_id)
+        poll = template.make_poll(poll_msg.poll.id, now, poll_msg.message_id)
+        self.polls.add(chat_id, topic_id, poll)
+        if chat_id not in self.member_sync.jobs:
+            self.member_sync.schedule(chat_id, first=5)
 
-        logger.debug(f"Active polls updated: {self.active_match_polls}")
+        logger.debug("Active polls updated: %s", self.active_match_polls)
 
-        self.save_active_match_polls("active_match_polls.json")
+        self.record_poll_change("create", chat_id, topic_id, poll_msg.poll.id, created_at=isoformat(now), message_id=poll_msg.message_id, **poll.settings())
+        if self.creating_topics.pop((chat_id, topic_id), None) is not None:
+            self.persistence.mark_dirty("pending_topics")
+        self.live_reports.add(chat_id, topic_id, poll)
+        self.deadlines.schedule(poll)
 
-        await context.bot.pin_chat_message(chat_id=chat_id, message_id=poll_msg.message_id)
+        self.outbound.submit(chat_id, PRIORITY_POLL, f"Pinning poll {poll.poll_id}", functools.partial(context.bot.pin_chat_message, chat_id=chat_id, message_id=poll_msg.message_id))
 
     async def handle_topic_created(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = update.message
-        logger.debug(f'New topic message: {msg}')
-
         topic_title = msg.forum_topic_created and msg.forum_topic_created.name
         thread_id = msg.message_thread_id
 
-        logger.debug(f"New topic created: {topic_title} in thread {thread_id}")
+        logger.debug("New topic created: %s in thread %s", topic_title, thread_id)
 
         if not topic_title:
             return
 
-        if re.match(r"^[JA]\d+\s*-", topic_title):
-            self.pending_topics[thread_id] = topic_title
-            logger.debug(f"Detected new matching topic: {topic_title}")
+        template = self.match_template(msg.chat.id, topic_title)
+        if template is not None:
+            self.pending_topics[msg.chat.id, thread_id] = template
+            self.persistence.mark_dirty("pending_topics")
+            self.topics.seen(msg.chat.id, thread_id)
+            logger.debug("Detected new topic %s matching template %s", topic_title, template.name)
             # Wait for first message — do NOT create poll yet
 
     async def handle_first_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = update.message
         thread_id = msg.message_thread_id
         
-        logger.debug(f"First message {msg} in thread {thread_id}")
+        logger.debug("Topic message in thread %s", thread_id)
+        # A message in the topic is all the proof that it exists the daily check needs
+        self.topics.seen(msg.chat.id, thread_id)
         # Check if this thread is in pending topics
-        if thread_id in self.pending_topics:
-            topic_title = self.pending_topics.pop(thread_id)
-            logger.debug(f"First message in topic '{topic_title}', creating poll...")
-            await self.make_match_poll(context, msg.chat.id, msg.message_thread_id, "Indica tu disponibilidad", available_options)
-
-    async def handle_topic_deleted(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        msg = update.message
-        thread_id = msg.message_thread_id
-        chat_id = msg.chat.id
-
-        logger.debug(f"Topic deleted in thread {thread_id}")
-
-        if chat_id in self.active_match_polls and thread_id in self.active_match_polls[chat_id]:
-            poll = self.active_match_polls[chat_id][thread_id]
-            await self.stop_match_poll(context, chat_id, thread_id, poll.poll_id)
+        template = self.pending_topics.pop((msg.chat.id, thread_id), None)
+        if template is not None:
+            self.creating_topics[msg.chat.id, thread_id] = template
+            logger.debug("First message in topic %s, creating poll from template %s...", thread_id, template.name)
+            self.outbound.submit(msg.chat.id, PRIORITY_POLL, f"Creating poll in topic {thread_id}",
+                                 functools.partial(self.make_match_poll, context, msg.chat.id, msg.message_thread_id, template),
+                                 on_failure=lambda e: self.retry_topic(msg.chat.id, thread_id))
+
+    def retry_topic(self, chat_id, topic_id):
+        """Puts a topic whose poll could not be created back to wait for its next message, which tries again"""
+        template = self.creating_topics.pop((chat_id, topic_id), None)
+        if template is not None:
+            self.pending_topics[chat_id, topic_id] = template
 
     async def handle_poll_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.debug(f"Handling poll update {update}")
         poll = update.poll
         if not poll:
             return
         
         poll_id = poll.id
-        chat_id, topic_id = self.get_chat_id_from_poll_id(poll_id)
-        logger.debug(f"Poll update for poll {poll_id} in chat {chat_id}, topic {topic_id}")
+        entry = self.polls.get(poll_id)
+        logger.debug("Poll update for poll %s: %s", poll_id, entry)
 
-        if not chat_id or not topic_id:
+        if entry is None:
             logger.debug("Poll not found in active polls, new poll received")
         elif poll.is_closed:
-            logger.info(f"Poll {poll_id} is closed")
-            del self.active_match_polls[chat_id][topic_id][poll_id]
-            logger.debug(f"Poll {poll_id} stopped and removed from active polls")
-            await context.bot.send_message(chat_id=chat_id, message_thread_id=topic_id, text="Convocatoria cerrada")
+            logger.info("Poll %s is closed", poll_id)
+            chat_id, topic_id, match_poll = self.polls.remove(poll_id)
+            self.close_poll(chat_id, topic_id, match_poll)
+            logger.debug("Poll %s stopped and removed from active polls", poll_id)
+            self.outbound.submit(chat_id, PRIORITY_ALERT, f"Announcing poll {poll_id} closed", functools.partial(context.bot.send_message, chat_id=chat_id, message_thread_id=topic_id, text="Convocatoria cerrada"))
     
-    async def handle_vote(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.debug(f"Handling update {update}")
-        logger.debug(f"Received poll answer: {update.poll_answer}")
+    async def handle_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/estadisticas [months]: availability, response time and late answers of the members over the closed polls
+        of the last months, 12 by default"""
+        msg = update.message
+        chat_id = msg.chat.id
+        months = int(context.args[0]) if context.args and context.args[0].isdigit() else 12
+        today = datetime.date.today()
+        first_month = today.year * 12 + today.month - 1 - (max(months, 1) - 1)
+        since = f"{first_month // 12:04d}-{first_month % 12 + 1:02d}"
+        # Reading the archive blocks, so it runs in a worker thread
+        stats = await asyncio.to_thread(self.history.player_stats, chat_id, since)
+        if not stats:
+            lines = [f"No hay convocatorias cerradas desde {since}."]
+        else:
+            lines = [f"<u><b>ESTADÍSTICAS DESDE {since}</b></u>"]
+            for user_id, player in sorted(stats.items(), key=lambda item: item[1]["availability"], reverse=True):
+                lines.append(f"{self.members.mention(chat_id, user_id)}: disponible {player['availability']:.0%} "
+                             f"({player['available']}/{player['polls']}), responde en {player['latency_hours']:.1f} h, "
+                             f"{player['changes_per_poll']:.1f} cambios por convocatoria")
+            lines.append("<b>Los que más tarde responden:</b>")
+            for user_id, player in late_ranking(stats, 5):
+                lines.append(f"{self.members.mention(chat_id, user_id)}: {player['late']} tarde, {player['polls'] - player['answered']} sin responder")
+        for text in split_message(lines, separator="\n"):
+            self.outbound.submit(chat_id, PRIORITY_REPORT, f"Stats of chat {chat_id}",
+                                 functools.partial(context.bot.send_message, chat_id=chat_id, message_thread_id=msg.message_thread_id, text=text,
+                                                   parse_mode="HTML", disable_web_page_preview=True))
 
+    async def handle_vote(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.poll_answer:
             return
         
         poll_answer = update.poll_answer
         user_id = poll_answer.user.id
         poll_id = poll_answer.poll_id
-        chat_id, topic_id = self.get_chat_id_from_poll_id(poll_id)
+        entry = self.polls.get(poll_id)
         option_ids = poll_answer.option_ids
-        logger.debug(f"Vote from user {user_id} in chat {chat_id}, topic {topic_id}, options {option_ids}")
+        logger.debug("Vote from user %s in %s, options %s", user_id, entry, option_ids)
 
-        if not chat_id or not topic_id:
+        if entry is None:
             return
         
-        await self.register_member_logic(update.poll_answer.user, chat_id)
+        chat_id, topic_id, poll = entry
+        # Members can only answer a poll whose message is still there, so its topic needs no check either
+        self.topics.seen(chat_id, topic_id)
+        self.register_member_logic(update.poll_answer.user, chat_id)
 
         if len(option_ids) > 1:
             logger.debug("Multiple options selected, ignoring")
             return
 
-        poll: MatchPoll = self.active_match_polls[chat_id][topic_id][poll_id]
-        logger.debug(f"Found poll: {poll}")
+        logger.debug("Found poll: %s", poll)
         if not poll.is_active():
-            logger.info("Poll is not active anymore")
-            await self.stop_match_poll(context, chat_id, topic_id, poll.poll_id)
+            await self.close_expired_poll(context.bot, poll_id)
             return
 
         if len(option_ids) == 0:
             logger.debug("Vote retracted, deleting vote")
             # We need to delete vote to know if user has voted before
             poll.delete_vote(user_id)
+            self.record_poll_change("retract", chat_id, topic_id, poll_id, user_id=user_id)
+            self.live_reports.changed(poll_id, user_id)
         elif len(option_ids) == 1:
             option_id = option_ids[0]
             if option_id < 0 or option_id >= len(poll.options):
-                logger.debug(f"Invalid option id {option_id}, ignoring")
+                logger.debug("Invalid option id %s, ignoring", option_id)
                 return
             
-            option = list(poll.options)[option_id]
-
-            if poll.has_voted(user_id) and not poll.is_same_vote(user_id, option):
-                logger.debug(f"User {user_id} has already voted, updating vote")
-                username = self.chat_members[str(chat_id)][str(user_id)]['username']
-                fullname = self.chat_members[str(chat_id)][str(user_id)]['full_name']
-                user_mention = f'<a href="https://t.me/{username}">@{username}</a>' if username is not None else f'<a href="tg://user?id={user_id}">{fullname}</a>'
-                vote_option_before = poll.previous_votes[str(user_id)].option
-                vote_option_after = option
-                await context.bot.send_message(chat_id=chat_id, message_thread_id=topic_id, text=f"ALERTA: El usuario {user_mention} ha cambiado su voto de {vote_option_before} a {vote_option_after}", parse_mode="HTML", disable_web_page_preview=True)
-
-            timestamp = datetime.datetime.now(tz=tzlocal.get_localzone())
-            poll.add_vote(user_id, option, timestamp)
-            self.active_match_polls[chat_id][topic_id][poll_id] = poll
-            self.save_active_match_polls("active_match_polls.json")
+            if poll.has_voted(user_id) and not poll.is_same_vote(user_id, option_id):
+                logger.debug("User %s has already voted, updating vote", user_id)
+                user_mention = self.members.mention(chat_id, user_id)
+                vote_option_before = poll.options[poll.previous_votes[user_id].option]
+                vote_option_after = poll.options[option_id]
+                self.vote_alerts.changed(chat_id, topic_id, user_id, user_mention, vote_option_before, vote_option_after)
+
+            timestamp = time.time()
+            poll.add_vote(user_id, option_id, timestamp)
+            self.record_poll_change("vote", chat_id, topic_id, poll_id, user_id=user_id, option=poll.options[option_id], timestamp=isoformat(timestamp))
+            self.live_reports.changed(poll_id, user_id)
 
 
@@ -0,0 +1,84 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger("footballteambot.HighAvailability")
+
+LEASE_FILE = "footballteambot.lock"
+
+"""High availability
+
+With --ha, several processes on the same host share a --data-dir and only the one holding the lease is
+active: it receives the updates through polling or the webhook and writes the state. The lease is an
+exclusive flock on <data_dir>/footballteambot.lock, which the kernel releases as soon as the process holding it
+exits or is killed, so there is no expiry to wait for and no stale lease to clean up.
+
+The other processes are warm standbys. They import everything, build the bot and load the state at boot,
+then follow the changes the active process writes while trying to take the lease every interval. The JSON
+vote journal is read as it is appended to, and the SQLite storage needs no following since its readers see
+every committed transaction. Once a standby gets the lease it reads what is left of the journal, loads the
+rest of the state (teams, pending topics) and starts polling or serving the webhook.
+
+What the active process had not written yet is lost on failover: the changes of the last --flush-interval
+seconds, the calls waiting in the outbound queue and the vote change alerts of the current window.
+
+"""
+class Lease:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def acquire(self):
+        """Takes the lease if no other process holds it. Returns whether this process holds it"""
+        if self.file is not None:
+            return True
+        f = open(self.filename, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        # Who holds the lease, for the logs of the standbys
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps({"pid": os.getpid(), "host": socket.gethostname(), "acquired_at": time.time()}))
+        f.flush()
+        self.file = f
+        return True
+
+    def holder(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def release(self):
+        if self.file is None:
+            return
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+class Standby:
+    """Calls follow every interval until the lease is acquired. follow applies the changes written by the active
+    process since its previous call and returns how many there were"""
+    def __init__(self, lease, follow, interval=0.5):
+        self.lease = lease
+        self.follow = follow
+        self.interval = interval
+        self.followed = 0
+        self.waited = 0.0
+
+    def wait(self):
+        start = time.monotonic()
+        logger.info("Standing by, the lease is held by %s", self.lease.holder())
+        while not self.lease.acquire():
+            self.followed += self.follow()
+            time.sleep(self.interval)
+        self.waited = time.monotonic() - start
+        logger.info("Lease acquired after %.1fs on standby, %s changes followed", self.waited, self.followed)
@@ -0,0 +1,187 @@
+import logging
+
+from telegram.error import BadRequest
+
+from OutboundQueue import PRIORITY_REPORT
+
+logger = logging.getLogger("footballteambot.LiveReport")
+
+MESSAGE_LIMIT = 4096
+LINE_SEPARATOR = "\n\n"
+
+"""Live poll reports
+
+Every active poll has one report message in its topic that the bot edits as votes come in, instead of
+posting the whole report again. Changes are gathered for report_interval seconds and then every changed
+report is edited once, through the outbound queue of the bot.
+
+A report keeps the rendered line of every member and only renders again the lines of the members whose
+vote or name changed. Reports longer than a Telegram message are split over several messages.
+
+"""
+def split_message(lines, limit=MESSAGE_LIMIT, separator=LINE_SEPARATOR):
+    """Joins lines into as few texts of at most limit characters as possible, never splitting a line"""
+    texts = []
+    current = []
+    length = 0
+    for line in lines:
+        added = len(line) if not current else len(separator) + len(line)
+        if current and length + added > limit:
+            texts.append(separator.join(current))
+            current = []
+            length = 0
+            added = len(line)
+        current.append(line)
+        length += added
+    if current:
+        texts.append(separator.join(current))
+    return texts
+
+
+class LiveReport:
+    def __init__(self, chat_id, topic_id, poll, members):
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.poll = poll
+        self.members = members
+        self.message_ids = list(poll.report_message_ids)
+        # Texts the messages are showing, unknown after a restart
+        self.texts = []
+        self.lines = {}
+        self.dirty = set()
+        self.all_dirty = True
+
+    def changed(self, user_id=None):
+        if user_id is None:
+            self.all_dirty = True
+        else:
+            self.dirty.add(user_id)
+
+    def render(self):
+        members = self.members.members_of(self.chat_id)
+        if self.all_dirty:
+            self.lines.clear()
+            self.dirty.clear()
+            self.all_dirty = False
+        for user_id in self.dirty:
+            self.lines[user_id] = self.poll.report_line(user_id, members.get(user_id))
+        self.dirty.clear()
+
+        lines = self.poll.report_header()
+        for user_id in self.poll.votes:
+            lines.append(self.line(user_id, members))
+        for user_id in members:
+            if user_id not in self.poll.votes:
+                lines.append(self.line(user_id, members))
+        lines.extend(self.poll.report_footer())
+        return split_message(lines)
+
+    def line(self, user_id, members):
+        line = self.lines.get(user_id)
+        if line is None:
+            line = self.lines[user_id] = self.poll.report_line(user_id, members.get(user_id))
+        return line
+
+    async def publish(self, bot):
+        """Edits the messages whose text changed, sending or deleting messages when the report grows or shrinks.
+        Returns True if the message ids changed since the last time they were saved"""
+        texts = self.render()
+        del self.texts[len(texts):]
+        self.texts.extend([None] * (len(texts) - len(self.texts)))
+        # Progress is kept as it is made, so a retry after a flood error does not send the same message twice
+        for index, text in enumerate(texts):
+            if self.texts[index] == text:
+                continue
+            if index < len(self.message_ids):
+                if not await self.edit(bot, self.message_ids[index], text):
+                    self.message_ids[index] = await self.send(bot, text)
+            else:
+                self.message_ids.append(await self.send(bot, text))
+            self.texts[index] = text
+        while len(self.message_ids) > len(texts):
+            message_id = self.message_ids.pop()
+            try:
+                await bot.delete_message(chat_id=self.chat_id, message_id=message_id)
+            except BadRequest as e:
+                logger.warning("Could not delete report message %s in chat %s: %s", message_id, self.chat_id, e)
+        message_ids = tuple(self.message_ids)
+        changed = message_ids != self.poll.report_message_ids
+        self.poll.report_message_ids = message_ids
+        return changed
+
+    async def edit(self, bot, message_id, text):
+        """Returns False if the message is gone and has to be sent again"""
+        try:
+            await bot.edit_message_text(text, chat_id=self.chat_id, message_id=message_id, parse_mode="HTML", disable_web_page_preview=True)
+        except BadRequest as e:
+            if "not modified" in e.message.lower():
+                return True
+            if "not found" in e.message.lower():
+                logger.info("Report message %s of poll %s was deleted, sending it again", message_id, self.poll.poll_id)
+                return False
+            raise
+        return True
+
+    async def send(self, bot, text):
+        message = await bot.send_message(chat_id=self.chat_id, message_thread_id=self.topic_id, text=text, parse_mode="HTML", disable_web_page_preview=True)
+        return message.message_id
+
+
+class LiveReports:
+    def __init__(self, job_queue, members, outbound, on_messages_changed, interval=10.0):
+        self.job_queue = job_queue
+        self.members = members
+        self.outbound = outbound
+        self.on_messages_changed = on_messages_changed
+        self.interval = interval
+        self.reports = {}
+        self.pending = set()
+        self.job = None
+        self.publishes = 0
+        self.changes = 0
+
+    def add(self, chat_id, topic_id, poll, publish=True):
+        report = self.reports[poll.poll_id] = LiveReport(chat_id, topic_id, poll, self.members)
+        if publish:
+            self.mark(poll.poll_id)
+        return report
+
+    def remove(self, poll_id):
+        self.pending.discard(poll_id)
+        return self.reports.pop(poll_id, None)
+
+    def changed(self, poll_id, user_id=None):
+        """Marks the line of user_id in the report of poll_id as changed, or the whole report if user_id is None"""
+        report = self.reports.get(poll_id)
+        if report is not None:
+            report.changed(user_id)
+            self.mark(poll_id)
+
+    def mark(self, poll_id):
+        self.changes += 1
+        self.pending.add(poll_id)
+        if self.job is None:
+            self.job = self.job_queue.run_once(self.flush, self.interval, name="live reports")
+
+    async def flush(self, context=None, run=None):
+        # Called directly, the scheduled flush is not needed anymore
+        if context is None and self.job is not None:
+            self.job.schedule_removal()
+        self.job = None
+        pending, self.pending = self.pending, set()
+        for poll_id in pending:
+            report = self.reports.get(poll_id)
+            if report is not None:
+                # A report still waiting for its turn renders the latest votes anyway
+                self.outbound.submit(report.chat_id, PRIORITY_REPORT, f"Live report of poll {poll_id}", lambda report=report: self.publish(report), key=("live report", poll_id), run=run)
+
+    async def publish(self, report):
+        if report.poll.poll_id not in self.reports:
+            # Closed while waiting in the queue
+            return
+        self.publishes += 1
+        if await report.publish(self.job_queue.application.bot):
+            self.on_messages_changed(report)
+
+    def stats(self):
+        return {"reports": len(self.reports), "changes": self.changes, "publishes": self.publishes}
@@ -0,0 +1,45 @@
+import collections
+import logging
+import random
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+SHARD_LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+
+"""Logging setup
+
+The bot loggers live under "footballteambot". All of them use %-style arguments, so nothing is formatted
+unless the record is actually emitted at the configured level.
+
+"""
+def configure_logging(level="INFO", telegram_level="WARNING", log_format=LOG_FORMAT):
+    logging.basicConfig(format=log_format)
+    logging.getLogger("footballteambot").setLevel(level.upper())
+    logging.getLogger("telegram").setLevel(telegram_level.upper())
+
+
+class UpdateTracer:
+    """Debug traces of the raw updates without paying for them on every event.
+
+    A random sample of the updates (sample_rate, between 0 and 1) is logged at DEBUG level, and the last
+    buffer_size updates are kept unformatted in a ring buffer that is only logged when a handler fails
+    """
+    def __init__(self, sample_rate=0.0, buffer_size=0):
+        self.sample_rate = sample_rate
+        self.buffer = collections.deque(maxlen=buffer_size) if buffer_size > 0 else None
+        self.logger = logging.getLogger("footballteambot.updates")
+
+    def enabled(self):
+        return self.sample_rate > 0 or self.buffer is not None
+
+    def trace(self, update):
+        if self.buffer is not None:
+            self.buffer.append(update)
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.logger.debug("Update %s", update)
+
+    def dump(self, level=logging.ERROR):
+        if not self.buffer:
+            return
+        self.logger.log(level, "Last %s updates received:", len(self.buffer))
+        for update in self.buffer:
+            self.logger.log(level, "%s", update)
@@ -0,0 +1,215 @@
+import csv
+import functools
+import json
+import logging
+import os
+
+from MatchPoll import AVAILABLE, available_options, isoformat, to_datetime
+
+logger = logging.getLogger("footballteambot.MatchHistory")
+
+# A first answer in the last day before the deadline counts as late
+LATE_WINDOW = 24 * 60 * 60
+EXPORT_COLUMNS = ("team_id", "poll_id", "topic_id", "created_at", "deadline", "closed_at", "user_id", "option", "first_voted_at", "voted_at", "changes")
+
+"""Match history
+
+Closed polls are appended to an archive in <data_dir>/history, with a directory per team and a file per
+month, named after the month the poll was created in. Files are only ever appended to.
+
+Every poll is a single JSON line holding its columns: the user ids of the members who answered it, and in the
+same order their final option (null if they retracted it), when they first answered, when they last answered
+and how many times they changed their option. Polls created from a template with other options than the
+default ones also hold the texts of their options. Queries pick the files of the teams and months they need from
+the directory names and read them one line at a time, and the statistics are added up column by column, so
+years of matches of many teams are never loaded at once.
+
+"""
+@functools.cache
+def option_labels(options):
+    """Short names of the options, their text up to the first parenthesis"""
+    return tuple(option.split(" (")[0] for option in options)
+
+
+def late_ranking(stats, limit=10):
+    """(user_id, stats) of the members of player_stats ranked by the share of polls they answered late or never
+    answered, then by their average latency"""
+    def lateness(item):
+        player = item[1]
+        return (player["late"] + player["polls"] - player["answered"]) / player["polls"], player["latency_hours"]
+    return sorted(stats.items(), key=lateness, reverse=True)[:limit]
+
+
+class MatchHistory:
+    def __init__(self, directory):
+        self.directory = directory
+        # Rows of the polls closed since the last write
+        self.pending = []
+        self.archived = 0
+
+    def row(self, chat_id, topic_id, poll, closed_at):
+        """Columns of a closed poll. Built on the event loop, cheap enough to run when the poll closes"""
+        user_ids, options, first_voted_at, voted_at, changes = [], [], [], [], []
+        for votes, final in ((poll.votes, True), (poll.previous_votes, False)):
+            for user_id, vote in votes.items():
+                if not final and user_id in poll.votes:
+                    continue
+                user_ids.append(user_id)
+                options.append(vote.option if final else None)
+                first_voted_at.append(vote.first_timestamp)
+                voted_at.append(vote.timestamp)
+                changes.append(vote.changes)
+        row = {"team_id": str(chat_id), "poll_id": poll.poll_id, "topic_id": int(topic_id), "created_at": poll.created_at,
+               "deadline": poll.deadline, "closed_at": closed_at, "user_ids": user_ids, "options": options,
+               "first_voted_at": first_voted_at, "voted_at": voted_at, "changes": changes}
+        if poll.options != available_options:
+            row["option_texts"] = list(poll.options)
+        return row
+
+    def partition(self, team_id, created_at):
+        return os.path.join(self.directory, str(team_id), f"{to_datetime(created_at).strftime('%Y-%m')}.jsonl")
+
+    def append(self, rows):
+        """Writes rows to their partitions, one append per partition"""
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(self.partition(row["team_id"], row["created_at"]), []).append(row)
+        for filename, partition_rows in partitions.items():
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "a") as f:
+                f.write("".join(json.dumps(row, separators=(",", ":")) + "\n" for row in partition_rows))
+                f.flush()
+                os.fsync(f.fileno())
+        self.archived += len(rows)
+
+    def teams(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name)))
+
+    def partitions(self, team_id=None, since=None, until=None):
+        """Yields the files of team_id, or of every team, whose month is between since and until, as "YYYY-MM" strings"""
+        for team in [str(team_id)] if team_id is not None else self.teams():
+            team_directory = os.path.join(self.directory, team)
+            if not os.path.isdir(team_directory):
+                continue
+            for filename in sorted(os.listdir(team_directory)):
+                month = filename[:-len(".jsonl")]
+                if not filename.endswith(".jsonl") or (since and month < since) or (until and month > until):
+                    continue
+                yield os.path.join(team_directory, filename)
+
+    def read(self, team_id=None, since=None, until=None):
+        """Yields the archived polls, one partition after the other"""
+        for filename in self.partitions(team_id, since, until):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash in the middle of an append leaves a truncated last line
+                        logger.warning("Ignoring truncated poll in %s", filename)
+
+    def player_stats(self, team_id, since=None, until=None):
+        """Returns the statistics of every member of team_id who answered any poll, keyed by user id: polls of the
+        team since the first one they answered, polls answered, votes of each option keyed by its text up to the
+        first parenthesis, votes of the first option of each poll (available), the availability rate over those
+        polls, the average hours from the poll creation to the first answer, the average option changes and the
+        late answers"""
+        polls = 0
+        stats = {}
+        for row in self.read(team_id, since, until):
+            polls += 1
+            created_at = row["created_at"]
+            late_after = row["deadline"] - LATE_WINDOW
+            labels = option_labels(tuple(row.get("option_texts", available_options)))
+            for user_id, option, first_voted_at, changes in zip(row["user_ids"], row["options"], row["first_voted_at"], row["changes"]):
+                player = stats.get(user_id)
+                if player is None:
+                    player = stats[user_id] = {"first_poll": polls, "answered": 0, "options": dict.fromkeys(option_labels(available_options), 0),
+                                               "available": 0, "retracted": 0, "latency": 0.0, "changes": 0, "late": 0}
+                player["answered"] += 1
+                if option is None:
+                    player["retracted"] += 1
+                else:
+                    label = labels[option]
+                    player["options"][label] = player["options"].get(label, 0) + 1
+                    player["available"] += option == AVAILABLE
+                player["latency"] += first_voted_at - created_at
+                player["changes"] += changes
+                player["late"] += first_voted_at >= late_after
+        for player in stats.values():
+            answered = player["answered"]
+            player["polls"] = polls - player.pop("first_poll") + 1
+            player["availability"] = player["available"] / player["polls"]
+            player["latency_hours"] = player.pop("latency") / answered / 3600
+            player["changes_per_poll"] = player.pop("changes") / answered
+        return stats
+
+    def late_voters(self, team_id, since=None, until=None, limit=10):
+        return late_ranking(self.player_stats(team_id, since, until), limit)
+
+    def export_rows(self, team_id=None, since=None, until=None):
+        """Yields the archived polls flattened to one row of EXPORT_COLUMNS per answer"""
+        for row in self.read(team_id, since, until):
+            option_texts = row.get("option_texts", available_options)
+            poll = (row["team_id"], row["poll_id"], row["topic_id"], isoformat(row["created_at"]), isoformat(row["deadline"]), isoformat(row["closed_at"]))
+            for user_id, option, first_voted_at, voted_at, changes in zip(row["user_ids"], row["options"], row["first_voted_at"], row["voted_at"], row["changes"]):
+                yield poll + (user_id, None if option is None else option_texts[option], isoformat(first_voted_at), isoformat(voted_at), changes)
+
+    def export_csv(self, filename, team_id=None, since=None, until=None):
+        count = 0
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in self.export_rows(team_id, since, until):
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def export_parquet(self, filename, team_id=None, since=None, until=None, batch_size=65536):
+        """Writes the rows in batches of batch_size, each one a row group. Needs pyarrow"""
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow, install it with pip install pyarrow")
+
+        schema = pyarrow.schema([(name, pyarrow.int64() if name in ("user_id", "topic_id", "changes") else pyarrow.string()) for name in EXPORT_COLUMNS])
+        count = 0
+        with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+            batch = []
+            for row in self.export_rows(team_id, since, until):
+                batch.append(row)
+                if len(batch) == batch_size:
+                    writer.write_table(pyarrow.Table.from_pylist([dict(zip(EXPORT_COLUMNS, row)) for row in batch], schema))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_table(pyarrow.Table.from_pylist([dict(zip(EXPORT_COLUMNS, row)) for row in batch], schema))
+                count += len(batch)
+        return count
+
+    def export(self, filename, team_id=None, since=None, until=None):
+        """Exports to Parquet if filename ends in .parquet, to CSV otherwise, and returns the rows written"""
+        if filename.endswith(".parquet"):
+            return self.export_parquet(filename, team_id, since, until)
+        return self.export_csv(filename, team_id, since, until)
+
+    def add(self, row):
+        self.pending.append(row)
+
+    def take(self):
+        rows, self.pending = self.pending, []
+        return rows
+
+    def write(self, rows):
+        """Appends rows taken from the pending ones. Runs in a worker thread, and gives them back if it fails so the next flush retries them"""
+        try:
+            self.append(rows)
+        except Exception:
+            self.pending[:0] = rows
+            raise
+
+    def stats(self):
+        return {"archived": self.archived, "pending": len(self.pending)}
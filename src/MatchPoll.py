@@ -1,99 +1,163 @@
 import datetime
+import functools
 import logging
+import time
 
 import tzlocal
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from MemberRegistry import mention
 
 logger = logging.getLogger("footballteambot.MatchPoll")
-logger.setLevel(logging.DEBUG)
 
-available_options = ['Disponible', 'Duda (indica cuándo podrás confirmar)', 'Baja']
+available_options = ('Disponible', 'Duda (indica cuándo podrás confirmar)', 'Baja')
+OPTION_CODES = {option: code for code, option in enumerate(available_options)}
+AVAILABLE = OPTION_CODES['Disponible']
+
+POLL_DURATION = 4 * 24 * 60 * 60
+
+"""Match polls
+
+A bot keeps every vote of every active poll in memory, so polls and votes are kept small: user ids are
+integers, options are their index in the options of the poll and timestamps are seconds since the epoch. They
+are only turned into option texts and dates when shown or saved, which keeps the storage formats as they were.
+
+The options, deadline and reminders of a poll come from the template it was created from. Polls share the
+options tuple of their template, and only the settings that differ from the default ones are saved with them.
+
+"""
+@functools.cache
+def local_zone():
+    return tzlocal.get_localzone()
+
+
+def to_datetime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=local_zone())
+
+
+def isoformat(timestamp):
+    return to_datetime(timestamp).isoformat()
+
+
+def from_isoformat(text):
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+@functools.cache
+def option_codes(options):
+    return {option: code for code, option in enumerate(options)}
+
 
 class MatchPoll:
-    def __init__(self, poll_id, created_at):
+    __slots__ = ("poll_id", "created_at", "deadline", "message_id", "votes", "previous_votes", "tallies", "report_message_ids", "options", "reminders")
+
+    def __init__(self, poll_id, created_at, message_id=None, deadline=None, options=available_options, reminders=None):
         self.poll_id = poll_id
         self.created_at = created_at
-        self.options = available_options
+        self.deadline = created_at + POLL_DURATION if deadline is None else deadline
+        # The first option counts as available
+        self.options = options
+        # Hours before the deadline the reminders are sent at, None for the ones of the bot
+        self.reminders = reminders
+        # Message of the poll itself, unknown for polls created by older versions
+        self.message_id = message_id
         self.votes = {}
         self.previous_votes = {}
-        self.deadline = created_at + datetime.timedelta(days=4)
-        logger.debug(f"Created MatchPoll with id={self.poll_id}, options={self.options}, created_at={self.created_at}, deadline={self.deadline}")
+        # Current votes of each option, kept up to date on every vote so counting never scans the votes
+        self.tallies = [0] * len(self.options)
+        # Messages showing the live report of the poll
+        self.report_message_ids = ()
+
+    @classmethod
+    def restore(cls, poll_id, created_at, message_id, settings):
+        """Builds a saved poll. settings holds the fields saved by settings(), and may hold others"""
+        deadline = settings.get('deadline')
+        reminders = settings.get('reminders')
+        return cls(poll_id, created_at, message_id, None if deadline is None else from_isoformat(deadline),
+                   tuple(settings.get('options', available_options)), None if reminders is None else tuple(reminders))
+
+    def settings(self):
+        """The deadline, options and reminders of the poll that differ from the default ones, to save with it"""
+        settings = {}
+        if self.deadline != self.created_at + POLL_DURATION:
+            settings['deadline'] = isoformat(self.deadline)
+        if self.options != available_options:
+            settings['options'] = list(self.options)
+        if self.reminders is not None:
+            settings['reminders'] = list(self.reminders)
+        return settings
+
+    def option_code(self, option):
+        return option_codes(self.options)[option]
 
     def add_vote(self, user_id, option, timestamp):
-        logger.debug(f"Adding vote: user_id={user_id}, option={option}, timestamp={timestamp}")
-        if not self.has_voted(user_id):
-            self.votes[str(user_id)] = Vote(user_id, option, timestamp)
-            logger.debug(f"Vote added: {self.votes[(str(user_id))]}")
+        user_id = int(user_id)
+        vote = self.votes.get(user_id)
+        if vote is None:
+            previous_vote = self.previous_votes.get(user_id)
+            if previous_vote is None:
+                self.votes[user_id] = Vote(user_id, option, timestamp)
+            else:
+                # Voting again after a retraction keeps the history of the first vote
+                self.votes[user_id] = Vote(user_id, option, timestamp, previous_vote.first_timestamp,
+                                           previous_vote.changes + (option != previous_vote.option))
         else:
-            logger.debug(f"Updating vote for user_id={user_id} from {self.votes[str(user_id)]} to option={option}, timestamp={timestamp}")
-            self.votes[str(user_id)].option = option
-            self.votes[str(user_id)].timestamp = timestamp
+            self.tallies[vote.option] -= 1
+            if option != vote.option:
+                vote.changes += 1
+            vote.option = option
+            vote.timestamp = timestamp
+        self.tallies[option] += 1
 
     def delete_vote(self, user_id):
-        logger.debug(f"Deleting vote {self.votes[str(user_id)]} for user_id={user_id}")
-        self.previous_votes[str(user_id)] = self.votes.pop(str(user_id), None)
-        
+        user_id = int(user_id)
+        vote = self.votes.pop(user_id, None)
+        if vote is not None:
+            self.tallies[vote.option] -= 1
+            self.previous_votes[user_id] = vote
+
     def has_voted(self, user_id):
-        return str(user_id) in self.previous_votes
-    
+        return int(user_id) in self.previous_votes
+
     def is_same_vote(self, user_id, option):
-        vote = Vote(user_id, option, datetime.datetime.now(tz=tzlocal.get_localzone()))
-        return vote == self.previous_votes[str(vote.user_id)]
+        return self.previous_votes[int(user_id)].option == option
 
     def is_active(self):
-        logger.debug(f"Checking if poll {self.poll_id} is active. Current time: {datetime.datetime.now(tz=tzlocal.get_localzone())}, Deadline: {self.deadline}")
-        return datetime.datetime.now(tz=tzlocal.get_localzone()) < self.deadline
-
-    def available_players(self):
-        return [vote.user_id for vote in self.votes.values() if vote.is_available()]
-
-    def unavailable_players(self):
-        return [vote.user_id for vote in self.votes.values() if vote.is_unavailable()]
-
-    def report(self, members = {}):
-        logger.debug(f"Generating report for poll {self.poll_id}. Votes: {self.votes}, Members: {members}")
-        report_lines = [f"<u><b>REPORTE ACTUAL DE LA CONVOCATORIA {self.created_at.strftime('%d-%m-%Y %H:%M')}</b></u>", "Votos:"]
-        for user_id, vote in self.votes.items():
-            user_name = members[str(user_id)]['username']
-            logger.debug(f"Member: {members[str(user_id)]}")
-            full_name = members[str(user_id)]['full_name']
-            timestamp_str = vote.timestamp.strftime("%Y-%m-%d %H:%M")
-            user_html_mention = f'<a href="https://t.me/{user_name}">@{user_name}</a>' if (user_name) else f'<a href="tg://user?id={user_id}">{full_name}</a>'
-            report_lines.append(f"{user_html_mention} : {vote.option} (Marca temporal: {timestamp_str})")
-
-        voted_user_ids = set(self.votes.keys())
-        logger.debug(f"Voted user IDs: {voted_user_ids}")
-        for user_id, user_info in members.items():
-            logger.debug(f"Checking member: user_id={user_id}, user_info={user_info}")
-            if str(user_id) not in voted_user_ids:
-                user_name = members[str(user_id)]['username']
-                logger.debug(f"Member: {members[str(user_id)]}")
-                full_name = members[str(user_id)]['full_name']
-                logger.debug(f"User {user_info['full_name']} (ID: {user_id}) has not voted yet.")
-                user_html_mention = f'<a href="https://t.me/{user_name}">@{user_name}</a>' if (user_name) else f'<a href="tg://user?id={user_id}">{full_name}</a>'
-                report_lines.append(f"{user_html_mention} aún no ha votado.")
-
-        report_lines.append(f"<u>Cierre de la convocatoria: {self.deadline.strftime('%d-%m-%Y %H:%M')}</u>")
-        return "\n\n".join(report_lines)
-   
+        return time.time() < self.deadline
+
+    def report_header(self):
+        return [f"<u><b>REPORTE ACTUAL DE LA CONVOCATORIA {to_datetime(self.created_at).strftime('%d-%m-%Y %H:%M')}</b></u>", "Votos:"]
+
+    def report_line(self, user_id, member=None):
+        user_html_mention = member.mention() if member is not None else mention(user_id)
+        vote = self.votes.get(user_id)
+        if vote is None:
+            return f"{user_html_mention} aún no ha votado."
+        timestamp_str = to_datetime(vote.timestamp).strftime("%Y-%m-%d %H:%M")
+        return f"{user_html_mention} : {self.options[vote.option]} (Marca temporal: {timestamp_str})"
+
+    def report_footer(self):
+        return [" · ".join(f"{option.split(' (')[0]}: {tally}" for option, tally in zip(self.options, self.tallies)),
+                f"<u>Cierre de la convocatoria: {to_datetime(self.deadline).strftime('%d-%m-%Y %H:%M')}</u>"]
+
     def __repr__(self):
-        return f"MatchPoll(poll_id={self.poll_id}, created_at={self.created_at}, votes={self.votes})"
+        return f"MatchPoll(poll_id={self.poll_id}, created_at={isoformat(self.created_at)}, votes={list(self.votes.values())})"
+
 
 class Vote:
-    def __init__(self, user_id, option, timestamp):
+    __slots__ = ("user_id", "option", "timestamp", "first_timestamp", "changes")
+
+    def __init__(self, user_id, option, timestamp, first_timestamp=None, changes=0):
         self.user_id = user_id
         self.option = option
         self.timestamp = timestamp
-
-    def is_available(self):
-        return self.option == 'Disponible'
-
-    def is_unavailable(self):
-        return not self.is_available()
+        # When the member first answered the poll, and how many times they changed their option since
+        self.first_timestamp = timestamp if first_timestamp is None else first_timestamp
+        self.changes = changes
 
     def __repr__(self):
-        return f"Vote(user_id={self.user_id}, option={self.option}, timestamp={self.timestamp})"
-    
-    def __eq__(self, value : 'Vote'):
-        self.user_id == value.user_id and self.option == value.option
\ No newline at end of file
+        return f"Vote(user_id={self.user_id}, option={self.option}, timestamp={isoformat(self.timestamp)})"
+
+    def __eq__(self, value):
+        if not isinstance(value, Vote):
+            return NotImplemented
+        return self.user_id == value.user_id and self.option == value.option
@@ -0,0 +1,129 @@
+import html
+import logging
+
+logger = logging.getLogger("footballteambot.MemberRegistry")
+
+"""Member registry
+
+Keeps the members seen in every chat, keyed by integer chat and user ids. It is asked about every message
+and reaction, and nearly all of them come from members it already knows with the same name, so that
+check is kept to a couple of dict lookups and attribute comparisons.
+
+Given load_chat, the members of a chat are only read from the storage the first time the chat is used,
+so booting does not load the members of every chat.
+
+"""
+class Member:
+    __slots__ = ("user_id", "username", "first_name", "last_name")
+
+    def __init__(self, user_id, username, first_name, last_name=None):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @property
+    def full_name(self):
+        if self.last_name:
+            return f"{self.first_name} {self.last_name}"
+        return self.first_name
+
+    def mention(self):
+        return mention(self.user_id, self.username, self.full_name)
+
+    def to_dict(self):
+        return {"username": self.username, "full_name": self.full_name, "first_name": self.first_name, "last_name": self.last_name}
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        # Members saved before first and last names were kept only have the full name
+        return cls(user_id, data['username'], data.get('first_name', data['full_name']), data.get('last_name'))
+
+    def __repr__(self):
+        return f"Member(user_id={self.user_id}, username={self.username}, full_name={self.full_name})"
+
+
+def mention(user_id, username=None, full_name=None):
+    if username:
+        return f'<a href="https://t.me/{username}">@{username}</a>'
+    return f'<a href="tg://user?id={user_id}">{html.escape(full_name or str(user_id))}</a>'
+
+
+class MemberRegistry:
+    def __init__(self, load_chat=None):
+        self.chats = {}
+        # Returns the members of a chat in the format of the storages: string user id -> dict
+        self.load_chat = load_chat
+
+    def load(self, chat_members):
+        """Loads the members in the format of the storages: string chat id -> string user id -> dict"""
+        for chat_id, members in chat_members.items():
+            self.chats[int(chat_id)] = members_from_dict(members)
+
+    def chat(self, chat_id):
+        """Returns the members of chat_id, loading them if it was not used yet"""
+        members = self.chats.get(chat_id)
+        if members is None:
+            members = self.chats[chat_id] = members_from_dict(self.load_chat(chat_id)) if self.load_chat is not None else {}
+            logger.debug("Loaded %s members of chat %s", len(members), chat_id)
+        return members
+
+    def seen(self, chat_id, user):
+        """Records that user was seen in chat_id. Returns True if the member is new or changed name"""
+        members = self.chats.get(chat_id)
+        if members is None:
+            members = self.chat(chat_id)
+        member = members.get(user.id)
+        if member is not None and member.first_name == user.first_name and member.last_name == user.last_name and member.username == user.username:
+            return False
+        if user.is_bot:
+            return False
+
+        if member is None:
+            members[user.id] = Member(user.id, user.username, user.first_name, user.last_name)
+            logger.info("Registered member %s in chat %s", user.id, chat_id)
+        else:
+            logger.info("Member %s in chat %s changed name from %s to %s", user.id, chat_id, member, user.full_name)
+            member.username = user.username
+            member.first_name = user.first_name
+            member.last_name = user.last_name
+        return True
+
+    def remove(self, chat_id, user_id):
+        """Forgets a member who left chat_id. Returns True if they were known"""
+        if self.chat(int(chat_id)).pop(int(user_id), None) is None:
+            return False
+        logger.info("Removed member %s from chat %s", user_id, chat_id)
+        return True
+
+    def get(self, chat_id, user_id):
+        return self.chat(int(chat_id)).get(int(user_id))
+
+    def members_of(self, chat_id):
+        return self.chat(int(chat_id))
+
+    def mention(self, chat_id, user_id):
+        member = self.get(chat_id, user_id)
+        if member is None:
+            return mention(user_id)
+        return member.mention()
+
+    def to_dict(self, changed=None):
+        """Returns the members of the loaded chats in the format of the storages, only the changed (chat_id, user_id) pairs if given.
+        Changed members who were removed are left out"""
+        if changed is None:
+            return {str(chat_id): {str(user_id): member.to_dict() for user_id, member in members.items()} for chat_id, members in self.chats.items()}
+        data = {}
+        for chat_id, user_id in changed:
+            member = self.chats[int(chat_id)].get(int(user_id))
+            if member is not None:
+                data.setdefault(str(chat_id), {})[str(user_id)] = member.to_dict()
+        return data
+
+    def __len__(self):
+        # Members of the loaded chats only
+        return sum(len(members) for members in self.chats.values())
+
+
+def members_from_dict(members):
+    return {int(user_id): Member.from_dict(int(user_id), data) for user_id, data in members.items()}
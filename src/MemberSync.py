@@ -0,0 +1,118 @@
+import logging
+import time
+
+from apscheduler.jobstores.base import JobLookupError
+from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger("footballteambot.MemberSync")
+
+LEFT_STATUSES = (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
+
+"""Member sync
+
+The Bot API cannot list the members of a group, so members are learnt from their messages, reactions and
+votes. A job per team completes and checks them every interval: the administrators are registered, the
+member count is kept to tell how many members are still unknown, and the known members are looked up with
+getChatMember so the ones who left the group are pruned.
+
+Every member that was checked is cached with the time of the check, and only looked up again once that entry
+expires after ttl seconds. A sync looks up at most lookups members, the ones checked longest ago first, so big
+teams are checked over several runs without bursts of calls. Calls go through the FanOut of the bot as reads,
+paced by its global rate only, so a sync does not hold up the alerts, polls and reports of the chat waiting
+for its per-chat rate.
+
+Lookups only tell whether the member is still in the group. Names keep coming from the updates of the member.
+
+"""
+class MemberSync:
+    def __init__(self, job_queue, members, fan_out, on_seen, on_left, interval=6 * 60 * 60, ttl=24 * 60 * 60, lookups=50):
+        self.job_queue = job_queue
+        self.members = members
+        self.fan_out = fan_out
+        # Called with (user, chat_id) for every administrator, and (chat_id, user_id) for every member who left
+        self.on_seen = on_seen
+        self.on_left = on_left
+        self.interval = interval
+        self.ttl = ttl
+        self.lookups = lookups
+        self.jobs = {}
+        # chat_id -> user_id -> time the member was last found in the chat
+        self.checked = {}
+        self.member_counts = {}
+        self.syncs = 0
+        self.api_calls = 0
+        self.pruned = 0
+
+    def schedule(self, chat_id, first=None):
+        """Syncs chat_id every interval, the first time after first seconds or a fraction of the interval so teams are spread over it"""
+        if self.interval <= 0:
+            return
+        self.cancel(chat_id)
+        if first is None:
+            first = self.interval * (hash(chat_id) % 1000) / 1000
+        self.jobs[chat_id] = self.job_queue.run_repeating(self.sync_job, interval=self.interval, first=first, data=chat_id, name=f"member sync {chat_id}")
+
+    def cancel(self, chat_id):
+        job = self.jobs.pop(chat_id, None)
+        if job is not None:
+            try:
+                job.schedule_removal()
+            except JobLookupError:
+                pass
+        self.checked.pop(chat_id, None)
+        self.member_counts.pop(chat_id, None)
+
+    async def sync_job(self, context):
+        await self.sync(context.bot, context.job.data)
+
+    async def call(self, chat_id, call):
+        self.api_calls += 1
+        return await self.fan_out.read(chat_id, call)
+
+    async def sync(self, bot, chat_id, now=None):
+        now = time.time() if now is None else now
+        self.syncs += 1
+        checked = self.checked.setdefault(chat_id, {})
+        try:
+            administrators = await self.call(chat_id, lambda: bot.get_chat_administrators(chat_id))
+            self.member_counts[chat_id] = await self.call(chat_id, lambda: bot.get_chat_member_count(chat_id))
+        except (BadRequest, Forbidden) as e:
+            # The bot left the chat or lost access to it, the team is removed by its membership update
+            logger.warning("Could not sync the members of chat %s: %s", chat_id, e)
+            return
+        for administrator in administrators:
+            if not administrator.user.is_bot:
+                self.on_seen(administrator.user, chat_id)
+                checked[administrator.user.id] = now
+
+        members = self.members.members_of(chat_id)
+        for user_id in [user_id for user_id in list(checked) if user_id not in members]:
+            del checked[user_id]
+        expired = sorted((checked.get(user_id, 0), user_id) for user_id in members if now - checked.get(user_id, 0) >= self.ttl)
+        for _, user_id in expired[:self.lookups]:
+            try:
+                member = await self.call(chat_id, lambda user_id=user_id: bot.get_chat_member(chat_id, user_id))
+            except BadRequest as e:
+                logger.debug("Could not look up member %s of chat %s: %s", user_id, chat_id, e)
+                continue
+            if member.status in LEFT_STATUSES or (member.status == ChatMemberStatus.RESTRICTED and not member.is_member):
+                logger.info("Member %s left chat %s, pruning them", user_id, chat_id)
+                checked.pop(user_id, None)
+                self.pruned += 1
+                self.on_left(chat_id, user_id)
+            else:
+                checked[user_id] = now
+        logger.debug("Synced the members of chat %s: %s known of %s, %s looked up", chat_id, len(self.members.members_of(chat_id)),
+                     self.member_counts[chat_id], min(len(expired), self.lookups))
+
+    def unknown_members(self):
+        """Members of every synced chat the bot has not seen yet, by chat id. The count includes the bot"""
+        return {chat_id: max(0, count - 1 - len(self.members.members_of(chat_id))) for chat_id, count in self.member_counts.items()}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def stats(self):
+        return {"teams": len(self.jobs), "syncs": self.syncs, "api_calls": self.api_calls, "pruned": self.pruned,
+                "cached": sum(len(checked) for checked in self.checked.values())}
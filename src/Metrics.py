@@ -0,0 +1,195 @@
+import bisect
+import functools
+import logging
+import time
+
+logger = logging.getLogger("footballteambot.Metrics")
+
+# Seconds, from the microseconds of a vote to the seconds of a daily report
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+"""Metrics
+
+Counters and histograms updated by the bot as it works, and gauges and counters read from the state and the
+stats of its components only when the metrics are scraped, rendered in the Prometheus text format.
+
+Recording is kept cheap enough to leave on: a counter is a dict update, and a histogram observation a
+bisect over the bucket bounds and two additions. Labelled series are kept in dicts keyed by the tuple of
+label values, and cumulative bucket counts are only computed when rendering.
+
+"""
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count of every bucket, then of the values above the last bucket, sum]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labels, label_values, f'le="{format_value(bound)}"'), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, label_values), series[-1]
+            yield f"{self.name}_count", format_labels(self.labels, label_values), cumulative
+
+
+class Collected:
+    """Gauge or counter whose value is read when the metrics are scraped. collect returns a number, or a
+    dict from the tuple of label values to the number"""
+
+    def __init__(self, kind, name, help, collect, labels=()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = tuple(labels)
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, collect, labels=()):
+        return self.register(Collected("gauge", name, help, collect, labels))
+
+    def collected_counter(self, name, help, collect, labels=()):
+        return self.register(Collected("counter", name, help, collect, labels))
+
+    def instrument(self, callback, seconds, errors, name=None):
+        """Wraps a coroutine function so its run time is observed in seconds and its exceptions counted in errors,
+        both labelled with name or the name of the function"""
+        name = name or callback.__name__
+
+        @functools.wraps(callback)
+        async def instrumented(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except Exception:
+                errors.inc(name)
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - start, name)
+        return instrumented
+
+    def timed(self, function, seconds, name=None):
+        """Wraps a plain function so its run time is observed in seconds, labelled with name or the name of the function"""
+        name = name or function.__name__
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds.observe(time.perf_counter() - start, name)
+        return timed
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.error("Could not collect metric %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        return web.Response(body=self.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+class MetricsServer:
+    """Serves the metrics on their own port, for when there is no webhook server to serve them"""
+
+    def __init__(self, metrics, listen="127.0.0.1", port=9090, path="/metrics"):
+        self.metrics = metrics
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        web_app = web.Application()
+        web_app.router.add_get(self.path, self.metrics.handle)
+        self.runner = web.AppRunner(web_app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        logger.info("Metrics served on http://%s:%s%s", self.listen, self.port, self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,94 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from telegram.request import BaseRequest
+
+logger = logging.getLogger("footballteambot.OfflineRequest")
+
+"""Offline Telegram API
+
+A python-telegram-bot request backend that answers every Bot API call locally instead of contacting
+Telegram. It lets the whole bot run without a network connection, for instance to feed it recorded
+updates through the webhook server. Every call is kept in self.calls.
+
+"""
+class OfflineRequest(BaseRequest):
+    def __init__(self, bot_id=1, bot_name="FootballTeamBot"):
+        self.bot_user = {"id": bot_id, "is_bot": True, "first_name": bot_name, "username": bot_name.lower()}
+        self.message_ids = itertools.count(1)
+        self.calls = []
+        # (chat_id, topic_id) of the topics that were deleted, which reject any call made in them
+        self.deleted_topics = set()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls.append((time.monotonic(), api_method, parameters))
+        logger.debug("%s(%s)", api_method, parameters)
+        if parameters.get("message_thread_id") is not None and (int(parameters.get("chat_id", 0)), int(parameters["message_thread_id"])) in self.deleted_topics:
+            return 400, json.dumps({"ok": False, "error_code": 400, "description": "Bad Request: message thread not found"}).encode()
+        if api_method == "getUpdates":
+            # Nothing will ever arrive, so behave like an idle long poll
+            await asyncio.sleep(float(parameters.get("timeout", 0) or 0))
+        return 200, json.dumps({"ok": True, "result": self.result(api_method, parameters)}).encode()
+
+    def result(self, api_method, parameters):
+        if api_method == "getMe":
+            return self.bot_user
+        if api_method == "getUpdates":
+            return []
+        if api_method == "getMyDescription":
+            return {"description": ""}
+        if api_method in ("sendMessage", "editMessageText"):
+            return self.message(parameters, text=parameters.get("text", ""))
+        if api_method == "sendPoll":
+            return self.message(parameters, poll=self.poll(parameters))
+        if api_method == "stopPoll":
+            return dict(self.poll(parameters), is_closed=True)
+        if api_method == "getChatAdministrators":
+            return []
+        if api_method == "getChatMemberCount":
+            return 0
+        if api_method == "getChatMember":
+            # Everyone stays, names are not known here
+            return {"status": "member", "user": {"id": int(parameters.get("user_id", 0)), "is_bot": False, "first_name": "Offline"}}
+        return True
+
+    def message(self, parameters, **content):
+        message_id = parameters.get("message_id") or next(self.message_ids)
+        chat = {"id": int(parameters.get("chat_id", 0)), "type": "supergroup", "title": "Offline", "is_forum": True}
+        message = {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": self.bot_user, **content}
+        if parameters.get("message_thread_id") is not None:
+            message.update(message_thread_id=parameters["message_thread_id"], is_topic_message=True)
+        return message
+
+    def poll(self, parameters):
+        options = parameters.get("options", [])
+        if isinstance(options, str):
+            options = json.loads(options)
+        return {
+            # Telegram poll ids are unique across chats, and so across the processes of a sharded bot
+            "id": f"offline-{parameters.get('chat_id', 0)}-{parameters.get('message_id') or next(self.message_ids)}",
+            "question": parameters.get("question", ""),
+            "options": [{"text": option["text"] if isinstance(option, dict) else option, "voter_count": 0, "persistent_id": str(index)} for index, option in enumerate(options)],
+            "total_voter_count": 0,
+            "is_closed": False,
+            "is_anonymous": False,
+            "type": "regular",
+            "allows_multiple_answers": False,
+            "allows_revoting": True,
+            "members_only": False,
+        }
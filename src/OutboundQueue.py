@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger("footballteambot.OutboundQueue")
+
+# Lower runs first
+PRIORITY_POLL = 0
+PRIORITY_ALERT = 1
+PRIORITY_REPORT = 2
+
+"""Outbound queue
+
+Handlers and jobs submit their Telegram API calls here instead of awaiting them, so they return right away.
+Calls run on a few workers through the FanOut of the bot, which paces them with its token buckets and
+retries flood-control errors. Every chat has its own queue: its calls run one at a time, the ones with
+the highest priority first and in submission order within a priority, while the calls of different
+chats run concurrently. Among the chats waiting for a worker, the one with the most urgent call goes first.
+
+A call submitted with a key is dropped while an earlier call with the same key is still waiting, which
+is how the edits of the same live report collapse into one. A call submitted with on_failure has it called
+with the exception once the call failed for good, after the flood-control retries of the FanOut. A call
+submitted with a SendRun counts towards it, so a job can wait for the calls it queued and log how long each
+chat took.
+
+"""
+class OutboundQueue:
+    def __init__(self, fan_out, workers=8):
+        self.fan_out = fan_out
+        self.workers = workers
+        # chat_id -> heap of (priority, sequence, description, call, key, on_failure, run)
+        self.chats = {}
+        # (priority, sequence, chat_id) of the chats with calls and no worker. Entries whose sequence is not the
+        # first call of the chat anymore are stale and skipped
+        self.ready = []
+        self.busy = set()
+        self.keys = set()
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.idle = None
+        self.tasks = []
+        # SendRuns with calls still queued, ended when the queue stops
+        self.runs = set()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, chat_id, priority, description, call, key=None, on_failure=None, run=None):
+        """Queues call, a coroutine function, to run in chat_id. Returns False if a call with the same key is already waiting"""
+        if key is not None:
+            if key in self.keys:
+                self.dropped += 1
+                return False
+            self.keys.add(key)
+        self.start()
+        calls = self.chats.setdefault(chat_id, [])
+        if run is not None:
+            run.submitted(chat_id)
+            self.runs.add(run)
+        entry = (priority, next(self.sequence), description, call, key, on_failure, run)
+        heapq.heappush(calls, entry)
+        if calls[0] is entry and chat_id not in self.busy:
+            self.schedule(chat_id)
+        return True
+
+    def schedule(self, chat_id):
+        calls = self.chats.get(chat_id)
+        if not calls:
+            self.chats.pop(chat_id, None)
+            if not self.chats:
+                self.idle.set()
+            return
+        heapq.heappush(self.ready, (calls[0][0], calls[0][1], chat_id))
+        self.idle.clear()
+        self.wakeup.set()
+
+    def start(self):
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.worker(), name=f"outbound-{index}") for index in range(self.workers)]
+
+    async def next_chat(self):
+        while True:
+            while self.ready:
+                _, sequence, chat_id = heapq.heappop(self.ready)
+                calls = self.chats.get(chat_id)
+                if chat_id in self.busy or not calls or calls[0][1] != sequence:
+                    continue
+                self.busy.add(chat_id)
+                return chat_id
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    async def worker(self):
+        while True:
+            chat_id = await self.next_chat()
+            _, _, description, call, key, on_failure, run = heapq.heappop(self.chats[chat_id])
+            self.keys.discard(key)
+            try:
+                await self.fan_out.call(chat_id, call)
+                self.sent += 1
+                if run is not None:
+                    run.finished(chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error("%s failed in chat %s: %s", description, chat_id, e)
+                if on_failure is not None:
+                    on_failure(e)
+                if run is not None:
+                    run.finished(chat_id, failed=True)
+            finally:
+                if run is not None and run.waiting == 0:
+                    self.runs.discard(run)
+                self.busy.discard(chat_id)
+                self.schedule(chat_id)
+
+    def __len__(self):
+        return sum(len(calls) for calls in self.chats.values())
+
+    async def join(self):
+        """Waits until every submitted call ran"""
+        if self.tasks:
+            await self.idle.wait()
+
+    async def stop(self, timeout=5.0):
+        """Gives the queued calls up to timeout seconds to run, then stops the workers"""
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %s calls still queued", len(self))
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # Their calls will not run anymore
+        for run in self.runs:
+            run.done.set()
+        self.runs.clear()
+
+    def stats(self):
+        return {"queued": len(self), "sent": self.sent, "failed": self.failed, "dropped": self.dropped}
+
+
+class SendRun:
+    """The calls a job submitted to the queue, timed by chat from the start of the run until the last call of the
+    chat ran"""
+    def __init__(self, name):
+        self.name = name
+        self.start = time.monotonic()
+        # chat_id -> calls submitted, calls failed and seconds from the start until its last call ran
+        self.calls = {}
+        self.failures = {}
+        self.latencies = {}
+        self.waiting = 0
+        self.done = asyncio.Event()
+        self.done.set()
+
+    def submitted(self, chat_id):
+        self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+        self.waiting += 1
+        self.done.clear()
+
+    def finished(self, chat_id, failed=False):
+        if failed:
+            self.failures[chat_id] = self.failures.get(chat_id, 0) + 1
+        self.latencies[chat_id] = time.monotonic() - self.start
+        self.waiting -= 1
+        if self.waiting == 0:
+            self.done.set()
+
+    async def wait(self):
+        """Waits until every call of the run ran and logs the run time and the latency of every chat. Returns the latencies"""
+        await self.done.wait()
+        total = time.monotonic() - self.start
+        logger.info("%s: %s calls to %s chats in %.2fs, %s failed", self.name, sum(self.calls.values()), len(self.calls), total, sum(self.failures.values()))
+        for chat_id, latency in sorted(self.latencies.items(), key=lambda item: item[1], reverse=True):
+            logger.info("%s: chat %s done after %.2fs (%s calls, %s failed)", self.name, chat_id, latency, self.calls[chat_id], self.failures.get(chat_id, 0))
+        return self.latencies
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("footballteambot.PersistenceScheduler")
+
+"""Persistence scheduler
+
+Handlers only mark a piece of state as dirty. A job on the job queue flushes the dirty state at most once
+per interval, so a burst of votes or new members ends up in a single write. Each writer is split in two:
+a snapshot taken on the event loop, which must be cheap, and the write itself (serialization and I/O),
+which runs in a thread executor. Dirty writers are flushed in the order they were registered, and a writer
+registered with after is held back while one of those writers could not be written.
+
+"""
+class PersistenceScheduler:
+    def __init__(self, job_queue, interval=1.0):
+        self.interval = interval
+        self.writers = {}
+        self.after = {}
+        self.dirty = {}
+        self.flushing = False
+        self.marks = 0
+        self.writes = 0
+        self.coalesced = 0
+        if interval > 0:
+            job_queue.run_repeating(self.flush_job, interval=interval, first=interval, name="persistence")
+
+    def register(self, name, snapshot, write, after=()):
+        """snapshot(keys) runs on the event loop and returns what write(state) persists in a worker thread.
+
+        keys holds the keys passed to mark_dirty since the last flush, or None if the whole state is dirty. The
+        writers in after, registered earlier, are written first, and a failure of theirs keeps this one dirty
+        """
+        self.writers[name] = (snapshot, write)
+        self.after[name] = tuple(after)
+
+    def mark_dirty(self, name, key=None):
+        self.marks += 1
+        if name in self.dirty:
+            self.coalesced += 1
+        self.merge(name, None if key is None else {key})
+        if self.interval <= 0:
+            self.flush_now()
+
+    def merge(self, name, keys):
+        dirty_keys = self.dirty.get(name, set())
+        self.dirty[name] = None if keys is None or dirty_keys is None else dirty_keys | keys
+
+    async def flush_job(self, context):
+        await self.flush()
+
+    async def flush(self):
+        if self.flushing or not self.dirty:
+            return
+        self.flushing = True
+        try:
+            loop = asyncio.get_running_loop()
+            dirty, self.dirty = self.dirty, {}
+            failed = set()
+            for name, keys in self.in_order(dirty):
+                if failed.intersection(self.after[name]):
+                    logger.warning("Holding %s back until %s can be written", name, ", ".join(sorted(failed.intersection(self.after[name]))))
+                    self.merge(name, keys)
+                    continue
+                snapshot, write = self.writers[name]
+                try:
+                    await loop.run_in_executor(None, write, snapshot(keys))
+                    self.writes += 1
+                except Exception as e:
+                    # Writers give back what their snapshot took, so keeping it dirty makes the next flush retry it
+                    logger.error("Error writing %s: %s", name, e)
+                    self.merge(name, keys)
+                    failed.add(name)
+            logger.debug("Flushed %s. %s", list(dirty), self.stats())
+        finally:
+            self.flushing = False
+
+    def flush_now(self):
+        """Writes all the dirty state synchronously, for shutdown"""
+        dirty, self.dirty = self.dirty, {}
+        for name, keys in self.in_order(dirty):
+            snapshot, write = self.writers[name]
+            write(snapshot(keys))
+            self.writes += 1
+
+    def in_order(self, dirty):
+        return [(name, dirty[name]) for name in self.writers if name in dirty]
+
+    def stats(self):
+        return {"marks": self.marks, "writes": self.writes, "coalesced": self.coalesced, "interval": self.interval}
@@ -0,0 +1,88 @@
+import logging
+
+logger = logging.getLogger("footballteambot.PollRegistry")
+
+"""Poll registry
+
+Telegram does not tell which chat a poll answer belongs to, so the bot keeps its own index from poll id
+to the chat, topic and MatchPoll it was sent to. Polls are also indexed by chat and topic, which is the
+layout the storages and the daily report use.
+
+on_add and on_remove, when set, are called with the PollEntry of every poll added or removed, so other
+processes can keep their own view of where each poll lives.
+
+"""
+class PollEntry:
+    __slots__ = ("chat_id", "topic_id", "poll")
+
+    def __init__(self, chat_id, topic_id, poll):
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.poll = poll
+
+    def __iter__(self):
+        return iter((self.chat_id, self.topic_id, self.poll))
+
+    def __repr__(self):
+        return f"PollEntry(chat_id={self.chat_id}, topic_id={self.topic_id}, poll_id={self.poll.poll_id})"
+
+
+class PollRegistry:
+    def __init__(self):
+        self.by_poll_id = {}
+        # chat_id -> topic_id -> poll_id -> MatchPoll
+        self.by_chat = {}
+        self.on_add = None
+        self.on_remove = None
+
+    def load(self, active_match_polls):
+        """Indexes the polls loaded by a storage, whose chat and topic ids may be strings"""
+        for chat_id, topics in active_match_polls.items():
+            for topic_id, polls in topics.items():
+                for poll in polls.values():
+                    self.add(chat_id, topic_id, poll)
+
+    def add(self, chat_id, topic_id, poll):
+        entry = PollEntry(int(chat_id), int(topic_id), poll)
+        self.by_poll_id[poll.poll_id] = entry
+        self.by_chat.setdefault(entry.chat_id, {}).setdefault(entry.topic_id, {})[poll.poll_id] = poll
+        if self.on_add is not None:
+            self.on_add(entry)
+        return entry
+
+    def get(self, poll_id):
+        return self.by_poll_id.get(poll_id)
+
+    def remove(self, poll_id):
+        entry = self.by_poll_id.pop(poll_id, None)
+        if entry is None:
+            return None
+        topics = self.by_chat[entry.chat_id]
+        polls = topics[entry.topic_id]
+        del polls[poll_id]
+        if not polls:
+            del topics[entry.topic_id]
+        if not topics:
+            del self.by_chat[entry.chat_id]
+        if self.on_remove is not None:
+            self.on_remove(entry)
+        return entry
+
+    def remove_topic(self, chat_id, topic_id):
+        polls = self.by_chat.get(int(chat_id), {}).get(int(topic_id), {})
+        return [self.remove(poll_id) for poll_id in list(polls)]
+
+    def topics_in_chat(self, chat_id):
+        return self.by_chat.get(int(chat_id), {})
+
+    def polls_in_chat(self, chat_id):
+        return [self.by_poll_id[poll_id] for polls in self.topics_in_chat(chat_id).values() for poll_id in polls]
+
+    def __len__(self):
+        return len(self.by_poll_id)
+
+    def __iter__(self):
+        return iter(list(self.by_poll_id.values()))
+
+    def __contains__(self, poll_id):
+        return poll_id in self.by_poll_id
@@ -0,0 +1,83 @@
+import logging
+import re
+
+from MatchPoll import POLL_DURATION, MatchPoll, available_options
+
+logger = logging.getLogger("footballteambot.PollTemplate")
+
+MATCH_TOPIC_PATTERN = r"^[JA]\d+\s*-"
+DEFAULT_QUESTION = "Indica tu disponibilidad"
+DEFAULT_DEADLINE_HOURS = POLL_DURATION / 3600
+# Options Telegram accepts in a poll
+MIN_OPTIONS = 2
+MAX_OPTIONS = 10
+
+"""Poll templates
+
+A template tells which forum topics of a team get a poll and what the poll looks like: the regular
+expression the topic title has to match, the question, the options, the hours from the creation of the poll
+to its deadline, and the hours before the deadline the reminders are sent at (the --reminders of the bot if
+not given). The first option is the one counted as available in reports and statistics.
+
+Patterns are compiled once, when the template is built, and teams keep their templates, so checking a new
+topic is a call to the match method of each compiled pattern of its team, in order, and a topic no template
+matches costs nothing else. Teams without templates use DEFAULT_TEMPLATE, the "J1 - Rival" and "A1 - Rival"
+topics of league and friendly matches.
+
+"""
+class PollTemplate:
+    __slots__ = ("name", "pattern", "question", "options", "deadline_hours", "reminders", "regex")
+
+    def __init__(self, name, pattern=MATCH_TOPIC_PATTERN, question=DEFAULT_QUESTION, options=available_options,
+                 deadline_hours=DEFAULT_DEADLINE_HOURS, reminders=None):
+        if not MIN_OPTIONS <= len(options) <= MAX_OPTIONS:
+            raise ValueError(f"Template {name} has {len(options)} options, polls take {MIN_OPTIONS} to {MAX_OPTIONS}")
+        if deadline_hours <= 0:
+            raise ValueError(f"Template {name} has a deadline {deadline_hours} hours after the poll is created")
+        self.name = name
+        self.pattern = pattern
+        # Raises re.error for invalid patterns
+        self.regex = re.compile(pattern)
+        self.question = question
+        # Polls created from the template share its options
+        self.options = tuple(options)
+        self.deadline_hours = deadline_hours
+        self.reminders = None if reminders is None else tuple(sorted(reminders, reverse=True))
+
+    def make_poll(self, poll_id, created_at, message_id=None):
+        return MatchPoll(poll_id, created_at, message_id, created_at + self.deadline_hours * 60 * 60, self.options, self.reminders)
+
+    def to_dict(self):
+        """The name and pattern, and the fields that differ from the default template"""
+        data = {"name": self.name, "pattern": self.pattern}
+        if self.question != DEFAULT_QUESTION:
+            data["question"] = self.question
+        if self.options != available_options:
+            data["options"] = list(self.options)
+        if self.deadline_hours != DEFAULT_DEADLINE_HOURS:
+            data["deadline_hours"] = self.deadline_hours
+        if self.reminders is not None:
+            data["reminders"] = list(self.reminders)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["pattern"], data.get("question", DEFAULT_QUESTION), data.get("options", available_options),
+                   data.get("deadline_hours", DEFAULT_DEADLINE_HOURS), data.get("reminders"))
+
+    def __repr__(self):
+        return f"PollTemplate(name={self.name}, pattern={self.pattern!r})"
+
+
+DEFAULT_TEMPLATE = PollTemplate("partido")
+
+
+def load_templates(team_name, templates_data):
+    """Builds the templates of a team, leaving out and logging the invalid ones so they do not take the others down"""
+    templates = []
+    for data in templates_data:
+        try:
+            templates.append(PollTemplate.from_dict(data))
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            logger.error("Ignoring invalid poll template %s of team %s: %s", data, team_name, e)
+    return templates
@@ -0,0 +1,54 @@
+import asyncio
+import datetime
+import time
+
+"""Rate limiting for Telegram API calls
+
+Telegram allows a bot around 30 messages per second overall and around 20 messages per minute in the same
+group. Going over those limits gets a RetryAfter error back, so calls are paced with token buckets instead.
+
+"""
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, global_rate=30, chat_rate=20 / 60, chat_burst=5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+
+    async def acquire(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+
+    async def acquire_global(self):
+        await self.global_bucket.acquire()
+
+
+def retry_after_seconds(error):
+    """Returns the delay requested by a RetryAfter error, which is a timedelta or a number depending on the python-telegram-bot settings"""
+    if isinstance(error.retry_after, datetime.timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
@@ -0,0 +1,326 @@
+import asyncio
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from LogConfig import SHARD_LOG_FORMAT, configure_logging
+from Storage import make_storage
+
+logger = logging.getLogger("footballteambot.Sharding")
+
+# Updates whose chat is in update[field]["chat"]
+CHAT_UPDATE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post", "business_message", "edited_business_message",
+                      "my_chat_member", "chat_member", "chat_join_request", "message_reaction", "message_reaction_count",
+                      "chat_boost", "removed_chat_boost")
+
+"""Sharded deployment
+
+A dispatcher process receives the updates, through the webhook server or long polling, and routes them to
+worker processes by chat id. Every worker runs a FootballTeamBot with its own storage in
+<data_dir>/shard-<n>, so it owns the teams, members and polls of its chats and nothing else.
+
+Poll and poll answer updates do not carry a chat id. Workers tell the dispatcher about every poll they
+add or remove, and those updates are routed with that poll id -> shard map. Dispatcher and workers talk
+through multiprocessing pipes. A worker that dies is started again, and the updates sent to it in the
+meantime wait in its outbox.
+
+"""
+def shard_for_chat(chat_id, shards):
+    return int(chat_id) % shards
+
+
+def shard_config(config, index):
+    shard = copy.copy(config)
+    shard.data_dir = os.path.join(config.data_dir, f"shard-{index}")
+    shard.webhook = False
+    # Each worker serves its own metrics, on the ports following the configured one
+    shard.metrics_port = config.metrics_port + index
+    # Telegram limits the whole bot, so the workers share its global rate
+    shard.global_rate = config.global_rate / config.shards
+    return shard
+
+
+def chat_id_of(data):
+    for field in CHAT_UPDATE_FIELDS:
+        if field in data:
+            return data[field]["chat"]["id"]
+    message = data.get("callback_query", {}).get("message")
+    if message is not None:
+        return message["chat"]["id"]
+    return None
+
+
+def prepare_shards(config):
+    """Creates the shard directories, splitting the state of a single process deployment the first time"""
+    layout_file = os.path.join(config.data_dir, "shards.json")
+    if os.path.exists(layout_file):
+        with open(layout_file) as f:
+            shards = json.load(f)["shards"]
+        if shards != config.shards:
+            raise SystemExit(f"{config.data_dir} is split in {shards} shards, start the bot with --shards {shards}")
+        return
+
+    logger.info("Splitting the state in %s into %s shards", config.data_dir, config.shards)
+    storage = make_storage(config)
+    teams = storage.load_teams()
+    chat_members = storage.load_chat_members()
+    active_match_polls = storage.load_active_match_polls()
+    pending_topics = storage.load_pending_topics()
+    storage.close()
+    for index in range(config.shards):
+        shard = shard_config(config, index)
+        os.makedirs(shard.data_dir, exist_ok=True)
+        mine = lambda chat_id: shard_for_chat(chat_id, config.shards) == index
+        shard_storage = make_storage(shard)
+        shard_storage.save_teams({team_id: team for team_id, team in teams.items() if mine(team_id)})
+        shard_storage.save_chat_members({chat_id: members for chat_id, members in chat_members.items() if mine(chat_id)})
+        shard_storage.save_active_match_polls({chat_id: topics for chat_id, topics in active_match_polls.items() if mine(chat_id)})
+        shard_storage.save_pending_topics({chat_id: topics for chat_id, topics in pending_topics.items() if mine(chat_id)})
+        shard_storage.close()
+    with open(layout_file, "w") as f:
+        json.dump({"shards": config.shards}, f)
+
+
+def run_worker(index, config, conn):
+    """Entry point of the worker processes"""
+    # Ctrl-C reaches the whole process group, workers stop when the dispatcher tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging(config.log_level, config.telegram_log_level, SHARD_LOG_FORMAT)
+    from Startup import StartupTimer
+    startup = StartupTimer()
+    from FootballTeamBot import FootballTeamBot
+    startup.mark("imports")
+    bot = FootballTeamBot(config.token, config, startup)
+    asyncio.run(ShardWorker(index, bot, conn).run())
+
+
+class ShardWorker:
+    def __init__(self, index, bot, conn):
+        self.index = index
+        self.bot = bot
+        self.conn = conn
+        self.stop = None
+
+    async def run(self):
+        self.stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.stop.set)
+        app = self.bot.app
+        async with app:
+            if self.index == 0:
+                await self.bot.set_description(app)
+            await app.start()
+            await self.bot.start_metrics_server()
+            self.bot.polls.on_add = lambda entry: self.conn.send(("poll_added", entry.poll.poll_id))
+            self.bot.polls.on_remove = lambda entry: self.conn.send(("poll_removed", entry.poll.poll_id))
+            for entry in self.bot.polls:
+                self.conn.send(("poll_added", entry.poll.poll_id))
+            self.conn.send(("ready",))
+            loop.add_reader(self.conn.fileno(), self.receive)
+            logger.info("Shard %s ready with %s active polls", self.index, len(self.bot.polls))
+            self.bot.startup.mark("telegram")
+            self.bot.startup.report()
+
+            await self.stop.wait()
+            loop.remove_reader(self.conn.fileno())
+            await app.stop()
+            await self.bot.post_stop(app)
+            await self.bot.close_storage(app)
+        logger.info("Shard %s stopped", self.index)
+
+    def receive(self):
+        try:
+            while self.conn.poll():
+                data = self.conn.recv()
+                if data is None:
+                    self.stop.set()
+                    return
+                self.bot.app.update_queue.put_nowait(Update.de_json(data, self.bot.app.bot))
+        except (EOFError, OSError):
+            logger.error("Shard %s lost the connection to the dispatcher", self.index)
+            self.stop.set()
+
+
+class Shard:
+    """Dispatcher side of a worker: the process, its pipe and the outbox of updates waiting to be sent"""
+    def __init__(self, index, config):
+        self.index = index
+        self.config = config
+        self.outbox = queue.SimpleQueue()
+        self.process = None
+        self.conn = None
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.sender = threading.Thread(target=self.send_loop, name=f"shard-{index}-sender", daemon=True)
+
+    def start(self, context):
+        conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(self.index, self.config, child_conn), name=f"shard-{self.index}")
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        if not self.sender.is_alive():
+            self.sender.start()
+
+    def send_loop(self):
+        # Sending blocks when the worker falls behind, so it is done in a thread for each shard
+        while True:
+            data = self.outbox.get()
+            while True:
+                try:
+                    self.conn.send(data)
+                    break
+                except (OSError, ValueError):
+                    if self.closing:
+                        return
+                    # The worker died, wait for the dispatcher to start it again
+                    time.sleep(0.1)
+            if data is None:
+                return
+
+
+class ShardDispatcher:
+    def __init__(self, config):
+        self.config = config
+        self.shards = [Shard(index, shard_config(config, index)) for index in range(config.shards)]
+        self.poll_shards = {}
+        self.context = multiprocessing.get_context("spawn")
+        self.stopping = False
+        self.stats = {"routed": 0, "dropped": 0, "restarts": 0}
+
+    def run(self):
+        prepare_shards(self.config)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        for shard in self.shards:
+            self.start_shard(shard)
+        await asyncio.gather(*(shard.ready.wait() for shard in self.shards))
+        logger.info("%s shards ready, %s active polls", len(self.shards), len(self.poll_shards))
+        supervisor = asyncio.create_task(self.supervise())
+
+        if self.config.offline:
+            from OfflineRequest import OfflineRequest
+            bot = Bot(self.config.token or "0:offline", request=OfflineRequest(), get_updates_request=OfflineRequest())
+        else:
+            bot = Bot(self.config.token)
+        async with bot:
+            stop_intake = await self.start_intake(bot)
+            await stop.wait()
+            logger.info("Stopping shards")
+            await stop_intake()
+
+        self.stopping = True
+        supervisor.cancel()
+        for shard in self.shards:
+            shard.outbox.put(None)
+        await asyncio.to_thread(self.join_shards)
+        logger.info("Dispatcher stopped: %s", self.stats)
+
+    async def start_intake(self, bot):
+        """Starts receiving updates and returns the coroutine function stopping it"""
+        if self.config.webhook:
+            from WebhookServer import WebhookServer
+
+            server = WebhookServer(self.dispatch, self.config.listen, self.config.port, self.config.webhook_path, self.config.secret_token)
+            try:
+                await server.start()
+                if self.config.webhook_url:
+                    await bot.set_webhook(self.config.webhook_url, secret_token=self.config.secret_token, allowed_updates=Update.ALL_TYPES)
+                return server.stop
+            except Exception as e:
+                logger.error("Could not start the webhook, falling back to polling: %s", e)
+                await server.stop()
+
+        updates = asyncio.Queue()
+        updater = Updater(bot, updates)
+        await updater.initialize()
+        await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        forwarder = asyncio.create_task(self.forward(updates))
+
+        async def stop_polling():
+            await updater.stop()
+            await updater.shutdown()
+            forwarder.cancel()
+            while not updates.empty():
+                await self.dispatch(updates.get_nowait().to_dict())
+        return stop_polling
+
+    async def forward(self, updates):
+        while True:
+            update = await updates.get()
+            await self.dispatch(update.to_dict())
+
+    async def dispatch(self, data):
+        shard = self.route(data)
+        if shard is None:
+            self.stats["dropped"] += 1
+            logger.debug("Dropped update %s of an unknown poll", data.get("update_id"))
+            return
+        self.stats["routed"] += 1
+        shard.outbox.put(data)
+
+    def route(self, data):
+        chat_id = chat_id_of(data)
+        if chat_id is not None:
+            return self.shards[shard_for_chat(chat_id, len(self.shards))]
+        if "poll_answer" in data:
+            index = self.poll_shards.get(data["poll_answer"]["poll_id"])
+        elif "poll" in data:
+            index = self.poll_shards.get(data["poll"]["id"])
+        else:
+            # Updates without a chat, like inline queries, are not handled by any shard in particular
+            index = 0
+        return None if index is None else self.shards[index]
+
+    def start_shard(self, shard):
+        shard.start(self.context)
+        asyncio.get_running_loop().add_reader(shard.conn.fileno(), self.receive, shard, shard.conn)
+
+    def receive(self, shard, conn):
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == "poll_added":
+                    self.poll_shards[message[1]] = shard.index
+                elif message[0] == "poll_removed":
+                    self.poll_shards.pop(message[1], None)
+                elif message[0] == "ready":
+                    shard.ready.set()
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+            conn.close()
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(1)
+            for shard in self.shards:
+                if not shard.process.is_alive() and not self.stopping:
+                    logger.error("Shard %s exited with code %s, starting it again", shard.index, shard.process.exitcode)
+                    self.stats["restarts"] += 1
+                    self.start_shard(shard)
+
+    def join_shards(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            shard.sender.join(max(0, deadline - time.monotonic()))
+            shard.closing = True
+            shard.process.join(max(0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                logger.warning("Shard %s did not stop in time, terminating it", shard.index)
+                shard.process.terminate()
+                shard.process.join()
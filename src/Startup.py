@@ -0,0 +1,72 @@
+import logging
+import os
+import time
+
+from Config import env
+
+logger = logging.getLogger("footballteambot.Startup")
+
+VERSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "VERSION")
+
+"""Startup
+
+The version of the bot is written when it is built, in the FOOTBALLTEAMBOT_VERSION environment variable
+or a VERSION file next to src, so booting does not import GitPython nor run git. git describe is only
+tried when neither exists, for instance in a plain checkout.
+
+StartupTimer keeps how long every phase of the boot took, and logs them once the bot is online.
+
+"""
+def get_version(repo_path="."):
+    version = env("VERSION", "").strip()
+    if version:
+        return format_version(version)
+    try:
+        with open(VERSION_FILE) as f:
+            version = f.read().strip()
+        if version:
+            return format_version(version)
+    except OSError:
+        pass
+    return git_version(repo_path)
+
+
+def git_version(repo_path):
+    try:
+        from git import Repo
+
+        return format_version(Repo(repo_path).git.describe('--tags', '--long', '--always'))
+    except Exception as e:
+        logger.error("Error getting git version: %s", e)
+        return "unknown"
+
+
+def format_version(describe):
+    """Turns the output of git describe --tags --long into "tag (commit)" or "tag+commits (commit)". Other versions are kept as they are"""
+    parts = describe.rsplit('-', 2)
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].startswith('g'):
+        return describe
+    tag, commits_ahead, commit = parts
+    commit = commit[1:]
+    if commits_ahead == "0":
+        return f"{tag} ({commit})"
+    return f"{tag}+{commits_ahead} ({commit})"
+
+
+class StartupTimer:
+    def __init__(self, started_at=None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.last = self.started_at
+        self.phases = []
+
+    def mark(self, phase):
+        """Records the time since the previous mark as the duration of phase"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started_at
+
+    def report(self):
+        logger.info("Online %.3fs after start: %s", self.total(), ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.phases))
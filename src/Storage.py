@@ -0,0 +1,484 @@
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+
+from MatchPoll import MatchPoll, from_isoformat, isoformat
+from Team import Team
+from VoteJournal import JournalFollower, VoteJournal, apply_record, deserialize_polls, serialize_polls, write_json_atomically
+
+logger = logging.getLogger("footballteambot.Storage")
+
+"""Storage backends
+
+A storage persists the teams, the chat members, the active match polls and the match topics waiting for their
+first message of the bot. The bot keeps
+the whole state in memory and notifies the storage about every change, so each backend can decide
+how much it has to write. Poll changes are queued and written in batches with flush_poll_changes, which
+can run in a worker thread.
+
+"""
+class Storage:
+    def __init__(self):
+        self.pending_poll_changes = []
+
+    def load_teams(self):
+        raise NotImplementedError
+
+    def save_teams(self, teams, team_id=None):
+        """Persists the teams. team_id is the team that changed, or None if any of them could have"""
+        raise NotImplementedError
+
+    def teams_changed(self):
+        """Whether the teams were changed by someone else since they were last loaded or saved, for instance to edit their poll templates"""
+        return False
+
+    def load_chat_members(self, chat_id=None):
+        """Returns the members of chat_id, or of every chat keyed by chat id if chat_id is None"""
+        raise NotImplementedError
+
+    def save_chat_members(self, chat_members, changed=None):
+        """Persists the chat members, which may be those of some chats only. changed holds the (chat_id, user_id) pairs
+        that changed, or None if any of them could have. Changed pairs missing from chat_members were removed"""
+        raise NotImplementedError
+
+    def load_active_match_polls(self):
+        raise NotImplementedError
+
+    def save_active_match_polls(self, active_match_polls):
+        raise NotImplementedError
+
+    def load_pending_topics(self):
+        """Returns the templates of the topics waiting for their first message, by chat id and topic id"""
+        raise NotImplementedError
+
+    def save_pending_topics(self, pending_topics):
+        """Persists every pending topic, replacing the ones saved before"""
+        raise NotImplementedError
+
+    def record_poll_change(self, op, chat_id, topic_id, poll_id, **fields):
+        """Queues a single change of an active poll: create, vote, retract, report (its report messages) or close"""
+        self.pending_poll_changes.append(dict(fields, op=op, chat_id=chat_id, topic_id=topic_id, poll_id=poll_id))
+
+    def take_poll_changes(self):
+        records, self.pending_poll_changes = self.pending_poll_changes, []
+        return records
+
+    def write_poll_changes(self, records):
+        raise NotImplementedError
+
+    def write_taken_poll_changes(self, records):
+        """Writes records taken with take_poll_changes, and gives them back if it fails so the next flush retries them"""
+        try:
+            self.write_poll_changes(records)
+        except Exception:
+            self.pending_poll_changes[:0] = records
+            raise
+
+    def flush_poll_changes(self):
+        self.write_taken_poll_changes(self.take_poll_changes())
+
+    def should_compact(self):
+        return False
+
+    def start_compaction(self, active_match_polls):
+        """Returns a callable doing the blocking part of the compaction, or None if there is nothing to do"""
+        return None
+
+    def follower(self):
+        """Returns a follower keeping the active match polls written by another process up to date, with load,
+        follow and finish methods and the polls in its polls attribute, or None if loading them once that process is
+        gone is enough"""
+        return None
+
+    def close(self):
+        self.flush_poll_changes()
+
+
+class JsonStorage(Storage):
+    def __init__(self, data_dir=".", fsync="always"):
+        super().__init__()
+        self.teams_file = os.path.join(data_dir, "teams.json")
+        # Modification time of teams_file when it was last loaded or saved
+        self.teams_mtime = None
+        self.chat_members_file = os.path.join(data_dir, "chat_members.json")
+        self.pending_topics_file = os.path.join(data_dir, "pending_topics.json")
+        # Contents of chat_members_file, read on first use
+        self.chat_members = None
+        self.vote_journal = VoteJournal(os.path.join(data_dir, "active_match_polls.json"), fsync=fsync)
+
+    def load_teams(self):
+        teams = {}
+        # Taken before reading, so a write in between is seen as a change by the next check
+        self.teams_mtime = self.teams_file_mtime()
+        if os.path.exists(self.teams_file):
+            with open(self.teams_file, "r") as f:
+                data = json.load(f)
+                for team_id, team_data in data.items():
+                    teams[str(team_id)] = Team.from_dict(team_data)
+        return teams
+
+    def save_teams(self, teams, team_id=None):
+        if team_id is not None and self.teams_changed():
+            # Someone else edited the file since it was loaded: only the team that changed is written over their
+            # edits, and the modification time is left as it was so the next reload picks the rest of them up
+            with open(self.teams_file, "r") as f:
+                data = json.load(f)
+            team = teams.get(str(team_id))
+            if team is None:
+                data.pop(str(team_id), None)
+            else:
+                data[str(team_id)] = team.to_dict()
+            write_json_atomically(self.teams_file, data)
+            logger.debug("Saved team %s into the teams edited in %s", team_id, self.teams_file)
+            return
+        data = {}
+        for team_id, team in teams.items():
+            data[team_id] = team.to_dict()
+        write_json_atomically(self.teams_file, data)
+        self.teams_mtime = self.teams_file_mtime()
+        logger.debug("Saved teams to %s", self.teams_file)
+
+    def teams_file_mtime(self):
+        try:
+            return os.stat(self.teams_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def teams_changed(self):
+        return self.teams_file_mtime() != self.teams_mtime
+
+    def read_chat_members(self):
+        if self.chat_members is None:
+            self.chat_members = {}
+            if os.path.exists(self.chat_members_file):
+                with open(self.chat_members_file, "r") as f:
+                    self.chat_members = json.load(f)
+        return self.chat_members
+
+    def load_chat_members(self, chat_id=None):
+        chat_members = self.read_chat_members()
+        if chat_id is None:
+            return chat_members
+        return chat_members.get(str(chat_id), {})
+
+    def save_chat_members(self, chat_members, changed=None):
+        # The file holds every chat, also the ones the bot did not load, so the changes are merged into its contents
+        stored = self.read_chat_members()
+        for chat_id, members in chat_members.items():
+            stored.setdefault(chat_id, {}).update(members)
+        for chat_id, user_id in changed or ():
+            if str(user_id) not in chat_members.get(str(chat_id), {}):
+                stored.get(str(chat_id), {}).pop(str(user_id), None)
+        write_json_atomically(self.chat_members_file, stored)
+
+    def load_active_match_polls(self):
+        data, records = self.vote_journal.load()
+        active_match_polls = deserialize_polls(data)
+        for record in records:
+            apply_record(active_match_polls, record)
+        if records:
+            # Start every run from a fresh snapshot so the journal replay at boot stays short
+            self.vote_journal.compact(serialize_polls(active_match_polls))
+        return active_match_polls
+
+    def save_active_match_polls(self, active_match_polls):
+        self.vote_journal.compact(serialize_polls(active_match_polls))
+
+    def load_pending_topics(self):
+        if not os.path.exists(self.pending_topics_file):
+            return {}
+        with open(self.pending_topics_file, "r") as f:
+            return json.load(f)
+
+    def save_pending_topics(self, pending_topics):
+        write_json_atomically(self.pending_topics_file, pending_topics)
+
+    def record_poll_change(self, op, chat_id, topic_id, poll_id, **fields):
+        # The sequence number is taken now so a snapshot serialized later on knows which queued changes it already holds
+        self.pending_poll_changes.append(self.vote_journal.stamp(dict(fields, op=op, chat_id=chat_id, topic_id=topic_id, poll_id=poll_id)))
+
+    def write_poll_changes(self, records):
+        self.vote_journal.append(records)
+
+    def should_compact(self):
+        return self.vote_journal.should_compact()
+
+    def start_compaction(self, active_match_polls):
+        seq = self.vote_journal.start_compaction()
+        if seq is None:
+            return None
+        return functools.partial(self.vote_journal.finish_compaction, serialize_polls(active_match_polls), seq)
+
+    def follower(self):
+        return JournalFollower(self.vote_journal)
+
+    def close(self):
+        self.flush_poll_changes()
+        self.vote_journal.close()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS teams (
+    team_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    templates TEXT
+);
+CREATE TABLE IF NOT EXISTS members (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    full_name TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS polls (
+    poll_id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    closed_at TEXT,
+    report_message_ids TEXT,
+    message_id INTEGER,
+    settings TEXT
+);
+CREATE INDEX IF NOT EXISTS polls_by_chat ON polls (chat_id, created_at);
+CREATE INDEX IF NOT EXISTS polls_by_closed_at ON polls (closed_at);
+CREATE TABLE IF NOT EXISTS pending_topics (
+    chat_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    template TEXT NOT NULL,
+    PRIMARY KEY (chat_id, topic_id)
+);
+CREATE TABLE IF NOT EXISTS votes (
+    poll_id TEXT NOT NULL REFERENCES polls (poll_id),
+    user_id INTEGER NOT NULL,
+    option TEXT,
+    timestamp TEXT,
+    previous_option TEXT,
+    previous_timestamp TEXT,
+    first_timestamp TEXT,
+    changes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (poll_id, user_id)
+);
+"""
+
+
+class SqliteStorage(Storage):
+    def __init__(self, data_dir=".", filename="footballteambot.db"):
+        import sqlite3
+
+        super().__init__()
+        self.lock = threading.Lock()
+        self.filename = os.path.join(data_dir, filename)
+        # Changes when another connection commits, which is how changes to the teams made by the tools are noticed
+        self.data_version = None
+        self.db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SQLITE_SCHEMA)
+        self.add_missing_columns("members", {"first_name": "TEXT", "last_name": "TEXT"})
+        self.add_missing_columns("teams", {"templates": "TEXT"})
+        self.add_missing_columns("polls", {"report_message_ids": "TEXT", "message_id": "INTEGER", "settings": "TEXT"})
+        self.add_missing_columns("votes", {"first_timestamp": "TEXT", "changes": "INTEGER NOT NULL DEFAULT 0"})
+
+    def add_missing_columns(self, table, columns):
+        # Databases created by older versions lack the newer columns
+        existing = {row['name'] for row in self.db.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns.items():
+            if column not in existing:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def load_teams(self):
+        with self.lock:
+            self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            rows = self.db.execute("SELECT team_id, name, templates FROM teams").fetchall()
+        return {str(row['team_id']): Team.from_dict({"name": row['name'], "templates": json.loads(row['templates'] or "[]")}) for row in rows}
+
+    def teams_changed(self):
+        with self.lock:
+            return self.db.execute("PRAGMA data_version").fetchone()[0] != self.data_version
+
+    def save_teams(self, teams, team_id=None):
+        changed = [team_id] if team_id is not None else list(teams)
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for team_id in changed:
+                team = teams.get(str(team_id))
+                if team is None:
+                    self.db.execute("DELETE FROM teams WHERE team_id = ?", (int(team_id),))
+                else:
+                    templates = team.to_dict().get("templates")
+                    self.db.execute("INSERT INTO teams (team_id, name, templates) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (team_id) DO UPDATE SET name = excluded.name, templates = excluded.templates",
+                                    (int(team_id), team.name, templates and json.dumps(templates)))
+
+    def load_chat_members(self, chat_id=None):
+        query = "SELECT chat_id, user_id, username, full_name, first_name, last_name FROM members"
+        with self.lock:
+            if chat_id is None:
+                rows = self.db.execute(query).fetchall()
+            else:
+                rows = self.db.execute(query + " WHERE chat_id = ?", (int(chat_id),)).fetchall()
+        chat_members = {}
+        for row in rows:
+            member = {"username": row['username'], "full_name": row['full_name']}
+            if row['first_name'] is not None:
+                member['first_name'] = row['first_name']
+                member['last_name'] = row['last_name']
+            chat_members.setdefault(str(row['chat_id']), {})[str(row['user_id'])] = member
+        if chat_id is not None:
+            return chat_members.get(str(chat_id), {})
+        return chat_members
+
+    def save_chat_members(self, chat_members, changed=None):
+        if changed is None:
+            changed = [(chat_id, user_id) for chat_id, members in chat_members.items() for user_id in members]
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for chat_id, user_id in changed:
+                member = chat_members.get(str(chat_id), {}).get(str(user_id))
+                if member is None:
+                    self.db.execute("DELETE FROM members WHERE chat_id = ? AND user_id = ?", (int(chat_id), int(user_id)))
+                    continue
+                self.db.execute(
+                    "INSERT INTO members (chat_id, user_id, username, full_name, first_name, last_name) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id, user_id) DO UPDATE SET username = excluded.username, full_name = excluded.full_name, "
+                    "first_name = excluded.first_name, last_name = excluded.last_name",
+                    (int(chat_id), int(user_id), member['username'], member['full_name'], member.get('first_name'), member.get('last_name')))
+
+    def load_active_match_polls(self):
+        active_match_polls = {}
+        polls = {}
+        for row in self.db.execute("SELECT poll_id, chat_id, topic_id, created_at, message_id, report_message_ids, settings FROM polls WHERE closed_at IS NULL"):
+            poll = MatchPoll.restore(row['poll_id'], from_isoformat(row['created_at']), row['message_id'], json.loads(row['settings'] or "{}"))
+            if row['report_message_ids']:
+                poll.report_message_ids = tuple(json.loads(row['report_message_ids']))
+            active_match_polls.setdefault(str(row['chat_id']), {}).setdefault(str(row['topic_id']), {})[poll.poll_id] = poll
+            polls[poll.poll_id] = poll
+        for row in self.db.execute("SELECT votes.* FROM votes JOIN polls USING (poll_id) WHERE polls.closed_at IS NULL"):
+            poll = polls[row['poll_id']]
+            if row['previous_option'] is not None:
+                poll.add_vote(row['user_id'], poll.option_code(row['previous_option']), from_isoformat(row['previous_timestamp']))
+                poll.delete_vote(row['user_id'])
+                self.restore_vote_history(poll.previous_votes[row['user_id']], row)
+            if row['option'] is not None:
+                poll.add_vote(row['user_id'], poll.option_code(row['option']), from_isoformat(row['timestamp']))
+                self.restore_vote_history(poll.votes[row['user_id']], row)
+        return active_match_polls
+
+    def restore_vote_history(self, vote, row):
+        # Votes written by older versions have no first timestamp, their first vote is the one they have
+        if row['first_timestamp'] is not None:
+            vote.first_timestamp = from_isoformat(row['first_timestamp'])
+        vote.changes = row['changes']
+
+    def save_active_match_polls(self, active_match_polls):
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for chat_id, topics in active_match_polls.items():
+                for topic_id, polls in topics.items():
+                    for poll in polls.values():
+                        self.upsert_poll(chat_id, topic_id, poll)
+
+    def load_pending_topics(self):
+        pending_topics = {}
+        with self.lock:
+            rows = self.db.execute("SELECT chat_id, topic_id, template FROM pending_topics").fetchall()
+        for row in rows:
+            pending_topics.setdefault(str(row['chat_id']), {})[str(row['topic_id'])] = json.loads(row['template'])
+        return pending_topics
+
+    def save_pending_topics(self, pending_topics):
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM pending_topics")
+            self.db.executemany("INSERT INTO pending_topics (chat_id, topic_id, template) VALUES (?, ?, ?)",
+                                [(int(chat_id), int(topic_id), json.dumps(template)) for chat_id, topics in pending_topics.items()
+                                 for topic_id, template in topics.items()])
+
+    def upsert_poll(self, chat_id, topic_id, poll):
+        settings = poll.settings()
+        self.db.execute(
+            "INSERT INTO polls (poll_id, chat_id, topic_id, created_at, message_id, report_message_ids, settings) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (poll_id) DO NOTHING",
+            (poll.poll_id, int(chat_id), int(topic_id), isoformat(poll.created_at), poll.message_id, json.dumps(list(poll.report_message_ids)),
+             json.dumps(settings) if settings else None))
+        for user_id in set(poll.votes) | set(poll.previous_votes):
+            vote = poll.votes.get(user_id)
+            previous_vote = poll.previous_votes.get(user_id)
+            latest = vote or previous_vote
+            self.db.execute(
+                "INSERT OR REPLACE INTO votes (poll_id, user_id, option, timestamp, previous_option, previous_timestamp, first_timestamp, changes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (poll.poll_id, int(user_id),
+                 vote and poll.options[vote.option], vote and isoformat(vote.timestamp),
+                 previous_vote and poll.options[previous_vote.option], previous_vote and isoformat(previous_vote.timestamp),
+                 isoformat(latest.first_timestamp), latest.changes))
+
+    def write_poll_changes(self, records):
+        if not records:
+            return
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for record in records:
+                self.write_poll_change(**record)
+
+    def write_poll_change(self, op, chat_id, topic_id, poll_id, **fields):
+        if op == "create":
+            settings = {key: fields[key] for key in ("deadline", "options", "reminders") if key in fields}
+            self.db.execute("INSERT INTO polls (poll_id, chat_id, topic_id, created_at, message_id, settings) VALUES (?, ?, ?, ?, ?, ?)",
+                            (poll_id, int(chat_id), int(topic_id), fields['created_at'], fields.get('message_id'), json.dumps(settings) if settings else None))
+        elif op == "vote":
+            # Changes count the votes for another option than the last one, also after a retraction
+            self.db.execute(
+                "INSERT INTO votes (poll_id, user_id, option, timestamp, first_timestamp) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (poll_id, user_id) DO UPDATE SET "
+                "first_timestamp = COALESCE(first_timestamp, previous_timestamp, timestamp), "
+                "changes = changes + (COALESCE(option, previous_option) IS NOT excluded.option), "
+                "option = excluded.option, timestamp = excluded.timestamp",
+                (poll_id, int(fields['user_id']), fields['option'], fields['timestamp'], fields['timestamp']))
+        elif op == "retract":
+            self.db.execute(
+                "UPDATE votes SET previous_option = option, previous_timestamp = timestamp, option = NULL, timestamp = NULL "
+                "WHERE poll_id = ? AND user_id = ? AND option IS NOT NULL",
+                (poll_id, int(fields['user_id'])))
+        elif op == "report":
+            self.db.execute("UPDATE polls SET report_message_ids = ? WHERE poll_id = ?", (json.dumps(fields['message_ids']), poll_id))
+        elif op == "close":
+            closed_at = fields.get('closed_at') or datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+            self.db.execute("UPDATE polls SET closed_at = ? WHERE poll_id = ?", (closed_at, poll_id))
+
+    def import_state(self, teams, chat_members, active_match_polls, pending_topics=None):
+        self.save_teams(teams)
+        self.save_chat_members(chat_members)
+        self.save_active_match_polls(active_match_polls)
+        if pending_topics:
+            self.save_pending_topics(pending_topics)
+
+    def close(self):
+        self.flush_poll_changes()
+        self.db.close()
+
+
+def make_storage(config):
+    if config.storage == "sqlite":
+        return SqliteStorage(config.data_dir)
+    return JsonStorage(config.data_dir, fsync=config.fsync)
+
+
+def migrate_json_to_sqlite(data_dir):
+    """Imports teams.json, chat_members.json, active_match_polls.json and pending_topics.json from data_dir into the SQLite database"""
+    json_storage = JsonStorage(data_dir)
+    sqlite_storage = SqliteStorage(data_dir)
+    teams = json_storage.load_teams()
+    chat_members = json_storage.load_chat_members()
+    active_match_polls = json_storage.load_active_match_polls()
+    sqlite_storage.import_state(teams, chat_members, active_match_polls, json_storage.load_pending_topics())
+    json_storage.close()
+    sqlite_storage.close()
+    poll_count = sum(len(polls) for topics in active_match_polls.values() for polls in topics.values())
+    logger.info("Imported %s teams, %s members and %s active polls into %s", len(teams), sum(len(members) for members in chat_members.values()), poll_count, sqlite_storage.filename)
@@ -1,29 +1,30 @@
-
-import json
-import datetime
+from PollTemplate import DEFAULT_TEMPLATE, load_templates
 
 
 class Team:
-    def __init__(self, name, members = []):
-        self.name = name
-
-    def save(self):
-        data = {
-            "name": self.name
-        }
-        with open(f"team_{self.name}.json", "w") as f:
-            json.dump(data, f)
+    __slots__ = ("name", "templates")
 
-    def load(self):
-        with open(f"team_{self.name}.json", "r") as f:
-            data = json.load(f)
-            self.name = data["name"]
-
-    def save(self):
-        pass
-
-    def load(self):
-        pass
+    def __init__(self, name, templates=()):
+        self.name = name
+        # Poll templates tried in order on the topics of the team, DEFAULT_TEMPLATE if there are none
+        self.templates = tuple(templates)
+
+    def match(self, title):
+        """Returns the first template whose pattern matches the topic title, or None"""
+        for template in self.templates or (DEFAULT_TEMPLATE,):
+            if template.regex.match(title) is not None:
+                return template
+        return None
+
+    def to_dict(self):
+        data = {"name": self.name}
+        if self.templates:
+            data["templates"] = [template.to_dict() for template in self.templates]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], load_templates(data["name"], data.get("templates", ())))
 
     def __repr__(self):
-        return f"Team(name={self.name})"
\ No newline at end of file
+        return f"Team(name={self.name}, templates={[template.name for template in self.templates]})"
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger("footballteambot.TopicLifecycle")
+
+"""Topic lifecycle
+
+Telegram sends no update when a forum topic is deleted, and the Bot API has no call to look a topic up, so
+topics are checked by sending a chat action to them, which fails with "message thread not found" once the
+topic is gone. The check is visible: while it lasts, up to five seconds, the members looking at the topic see
+the bot typing.
+
+Whether a topic exists is cached for ttl seconds, and only topics without a cache entry that recent are
+checked. Topics the bot just saw a message or a poll answer in are cached as existing without any call, so
+the topics with activity are never checked. Once a day, every topic with active polls or waiting for its first message is reconciled in
+a single pass, at most workers checks at a time, and the topics found gone are handed to on_deleted to purge
+their polls.
+
+"""
+class TopicLifecycle:
+    def __init__(self, fan_out, on_deleted, ttl=6 * 60 * 60, workers=4):
+        self.fan_out = fan_out
+        self.on_deleted = on_deleted
+        self.ttl = ttl
+        self.workers = workers
+        # (chat_id, topic_id) -> (exists, time of the check)
+        self.cache = {}
+        self.checks = 0
+        self.cache_hits = 0
+        self.deleted = 0
+
+    def seen(self, chat_id, topic_id, now=None):
+        """Records that topic_id exists, for instance because a message was just posted in it"""
+        self.cache[chat_id, topic_id] = (True, time.time() if now is None else now)
+
+    def forget(self, chat_id, topic_id):
+        self.cache.pop((chat_id, topic_id), None)
+
+    async def exists(self, bot, chat_id, topic_id, now=None):
+        """Returns whether the topic exists, checking it with Telegram when its cache entry is missing or expired.
+        Topics that cannot be checked, for instance because the bot lost access to the chat, are assumed to exist"""
+        now = time.time() if now is None else now
+        cached = self.cache.get((chat_id, topic_id))
+        if cached is not None and now - cached[1] < self.ttl:
+            self.cache_hits += 1
+            return cached[0]
+        self.checks += 1
+        try:
+            await self.fan_out.call(chat_id, lambda: bot.send_chat_action(chat_id, ChatAction.TYPING, message_thread_id=topic_id))
+            exists = True
+        except BadRequest as e:
+            if "thread not found" not in e.message.lower():
+                logger.warning("Could not check topic %s of chat %s: %s", topic_id, chat_id, e)
+                return True
+            exists = False
+        except Forbidden as e:
+            logger.warning("Could not check topic %s of chat %s: %s", topic_id, chat_id, e)
+            return True
+        self.cache[chat_id, topic_id] = (exists, now)
+        return exists
+
+    async def reconcile(self, bot, topics, now=None):
+        """Checks the (chat_id, topic_id) pairs in topics, purging the ones that are gone. Returns them"""
+        now = time.time() if now is None else now
+        semaphore = asyncio.Semaphore(self.workers)
+        start = time.monotonic()
+
+        async def check(chat_id, topic_id):
+            async with semaphore:
+                try:
+                    return not await self.exists(bot, chat_id, topic_id, now)
+                except Exception as e:
+                    logger.error("Could not check topic %s of chat %s: %s", topic_id, chat_id, e)
+                    return False
+
+        topics = list(topics)
+        gone = [topic for topic, deleted in zip(topics, await asyncio.gather(*(check(chat_id, topic_id) for chat_id, topic_id in topics))) if deleted]
+        for chat_id, topic_id in gone:
+            logger.info("Topic %s of chat %s was deleted, purging it", topic_id, chat_id)
+            self.deleted += 1
+            self.forget(chat_id, topic_id)
+            self.on_deleted(chat_id, topic_id)
+        # Entries of topics that are not being followed anymore
+        wanted = set(topics)
+        for topic in [topic for topic, (_, checked_at) in self.cache.items() if topic not in wanted and now - checked_at >= self.ttl]:
+            del self.cache[topic]
+        logger.info("Reconciled %s topics in %.2fs, %s deleted", len(topics), time.monotonic() - start, len(gone))
+        return gone
+
+    def stats(self):
+        return {"cached": len(self.cache), "checks": self.checks, "cache_hits": self.cache_hits, "deleted": self.deleted}
@@ -0,0 +1,68 @@
+import logging
+
+from LiveReport import split_message
+from OutboundQueue import PRIORITY_ALERT
+
+logger = logging.getLogger("footballteambot.VoteChangeAlerts")
+
+"""Vote change alerts
+
+The chat is alerted when a member changes their vote. Changes in the same topic are gathered for a time
+window and sent as a single alert, and a member who goes back to the option they had within the window
+is left out, so players flipping their vote or many players changing at once do not flood the topic.
+
+"""
+class VoteChangeAlerts:
+    def __init__(self, job_queue, outbound, window=30.0):
+        self.job_queue = job_queue
+        self.outbound = outbound
+        self.window = window
+        # (chat_id, topic_id) -> user_id -> [mention, option before, option after]
+        self.pending = {}
+        self.changes = 0
+        self.alerts = 0
+
+    def changed(self, chat_id, topic_id, user_id, mention, before, after):
+        self.changes += 1
+        topic = (chat_id, topic_id)
+        changes = self.pending.get(topic)
+        if changes is None:
+            changes = self.pending[topic] = {}
+            self.job_queue.run_once(self.flush_job, self.window, data=topic, name=f"vote alerts {chat_id} {topic_id}")
+        change = changes.get(user_id)
+        if change is None:
+            changes[user_id] = [mention, before, after]
+        else:
+            change[0] = mention
+            change[2] = after
+
+    async def flush_job(self, context):
+        self.flush(context.job.data)
+
+    def flush(self, topic):
+        changes = self.pending.pop(topic, None)
+        if not changes:
+            return
+        changes = [change for change in changes.values() if change[1] != change[2]]
+        if not changes:
+            logger.debug("Vote changes in topic %s of chat %s went back within the window", topic[1], topic[0])
+            return
+        chat_id, topic_id = topic
+        if len(changes) == 1:
+            mention, before, after = changes[0]
+            lines = [f"ALERTA: El usuario {mention} ha cambiado su voto de {before} a {after}"]
+        else:
+            lines = ["ALERTA: Han cambiado su voto:"] + [f"{mention}: de {before} a {after}" for mention, before, after in changes]
+        bot = self.job_queue.application.bot
+        for text in split_message(lines, separator="\n"):
+            self.alerts += 1
+            self.outbound.submit(chat_id, PRIORITY_ALERT, f"Vote change alert in topic {topic_id}",
+                                 lambda text=text: bot.send_message(chat_id=chat_id, message_thread_id=topic_id, text=text, parse_mode="HTML", disable_web_page_preview=True))
+
+    def flush_all(self):
+        """Submits the alerts of every window right away, for shutdown. Their jobs find nothing left to send"""
+        for topic in list(self.pending):
+            self.flush(topic)
+
+    def stats(self):
+        return {"pending": len(self.pending), "changes": self.changes, "alerts": self.alerts}
@@ -0,0 +1,361 @@
+import json
+import logging
+import os
+import time
+
+from MatchPoll import MatchPoll, from_isoformat, isoformat
+
+logger = logging.getLogger("footballteambot.VoteJournal")
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+"""Vote journal
+
+Every change to the active match polls (poll creation, vote, retraction and poll close) is appended
+as a single JSON line to a journal file next to the snapshot. The snapshot is only rewritten on
+compaction, so the cost of a vote does not depend on how many polls are active.
+
+"""
+class VoteJournal:
+    def __init__(self, snapshot_file, fsync=FSYNC_ALWAYS, fsync_interval=1.0, compact_after=1000):
+        self.snapshot_file = snapshot_file
+        self.journal_file = f"{snapshot_file}.journal"
+        self.compacting_file = f"{snapshot_file}.journal.compacting"
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self.seq = 0
+        self.records_since_compaction = 0
+        self.last_fsync = 0.0
+        self.file = None
+
+    def load(self, recover=True):
+        """Returns the snapshot data and the journal records written after it.
+
+        With recover, a journal left aside by a compaction that never finished is folded into the snapshot first.
+        Only the process writing the journal may do it, the followers of another process pass recover=False
+        """
+        if recover:
+            self.recover_compaction()
+        data, snapshot_seq = self.read_snapshot()
+        records = []
+        for filename in (self.compacting_file, self.journal_file):
+            for record in self.read_journal(filename):
+                # Records appended again after a failed write are only applied once
+                if record['seq'] > (records[-1]['seq'] if records else snapshot_seq):
+                    records.append(record)
+        self.seq = max([snapshot_seq] + [record['seq'] for record in records])
+        self.records_since_compaction = len(records)
+        logger.debug("Loaded snapshot (seq %s) and %s journal records from %s", snapshot_seq, len(records), self.snapshot_file)
+        return data, records
+
+    def recover_compaction(self):
+        """Writes the records of the journal a crashed compaction left aside into a new snapshot and removes it,
+        since no compaction can be running before the journal is loaded. Otherwise the leftover file would keep
+        every later compaction from starting"""
+        if not os.path.exists(self.compacting_file):
+            return
+        data, snapshot_seq = self.read_snapshot()
+        records = [record for record in self.read_journal(self.compacting_file) if record['seq'] > snapshot_seq]
+        if records:
+            polls = deserialize_polls(data)
+            for record in records:
+                apply_record(polls, record)
+            write_json_atomically(self.snapshot_file, {"seq": records[-1]['seq'], "polls": serialize_polls(polls)})
+        os.remove(self.compacting_file)
+        logger.warning("Recovered an interrupted compaction of %s with %s journal records", self.snapshot_file, len(records))
+
+    def read_snapshot(self):
+        if not os.path.exists(self.snapshot_file):
+            return {}, 0
+        with open(self.snapshot_file, "r") as f:
+            data = json.load(f)
+        if "polls" in data and "seq" in data:
+            return data["polls"], data["seq"]
+        # Snapshots written before the journal existed hold the polls directly
+        return data, 0
+
+    def read_journal(self, filename):
+        records = []
+        if not os.path.exists(filename):
+            return records
+        with open(filename, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash in the middle of an append leaves a truncated last line
+                    logger.warning("Ignoring truncated record in %s", filename)
+                    break
+        return records
+
+    def stamp(self, record):
+        """Gives the record the next sequence number"""
+        self.seq += 1
+        self.records_since_compaction += 1
+        record['seq'] = self.seq
+        return record
+
+    def append(self, records):
+        """Writes stamped records, syncing them to disk at most once according to the fsync policy"""
+        if not records:
+            return
+        if self.file is None:
+            self.file = open(self.journal_file, "a")
+        size = self.file.tell()
+        try:
+            self.file.write("".join(json.dumps(record) + "\n" for record in records))
+            self.file.flush()
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self.file.fileno())
+            elif self.fsync == FSYNC_INTERVAL:
+                now = time.monotonic()
+                if now - self.last_fsync >= self.fsync_interval:
+                    os.fsync(self.file.fileno())
+                    self.last_fsync = now
+        except OSError:
+            # Drops what was written of the records, so appending them again does not leave a broken line behind
+            self.discard_from(size)
+            raise
+
+    def discard_from(self, size):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        try:
+            os.truncate(self.journal_file, size)
+        except OSError as e:
+            logger.error("Could not drop the records left half written in %s: %s", self.journal_file, e)
+
+    def should_compact(self):
+        return self.records_since_compaction >= self.compact_after and not os.path.exists(self.compacting_file)
+
+    def start_compaction(self):
+        """Moves the current journal aside so appends can continue while the snapshot is written.
+
+        Returns the last sequence number the snapshot has to cover, or None if a compaction is already running
+        """
+        if os.path.exists(self.compacting_file):
+            return None
+        self.close()
+        if os.path.exists(self.journal_file):
+            os.replace(self.journal_file, self.compacting_file)
+        self.records_since_compaction = 0
+        return self.seq
+
+    def finish_compaction(self, data, seq):
+        """Writes the snapshot atomically and drops the journal it replaces. Safe to run in a worker thread"""
+        write_json_atomically(self.snapshot_file, {"seq": seq, "polls": data})
+        if os.path.exists(self.compacting_file):
+            os.remove(self.compacting_file)
+        logger.debug("Compacted %s up to seq %s", self.snapshot_file, seq)
+
+    def compact(self, data):
+        seq = self.start_compaction()
+        if seq is not None:
+            self.finish_compaction(data, seq)
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+def write_json_atomically(filename, data):
+    directory = os.path.dirname(os.path.abspath(filename))
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def serialize_vote(vote, options):
+    data = {'user_id': vote.user_id, 'option': options[vote.option], 'timestamp': isoformat(vote.timestamp)}
+    # Only votes that changed carry their history, so snapshots of first votes stay as they were
+    if vote.first_timestamp != vote.timestamp:
+        data['first_timestamp'] = isoformat(vote.first_timestamp)
+    if vote.changes:
+        data['changes'] = vote.changes
+    return data
+
+
+def restore_vote_history(vote, vote_data):
+    if 'first_timestamp' in vote_data:
+        vote.first_timestamp = from_isoformat(vote_data['first_timestamp'])
+    vote.changes = vote_data.get('changes', 0)
+
+
+def serialize_polls(active_match_polls):
+    data = {}
+    for chat_id, topics in active_match_polls.items():
+        data[str(chat_id)] = {}
+        for topic_id, polls in topics.items():
+            data[str(chat_id)][str(topic_id)] = {}
+            for poll_id, poll in polls.items():
+                data[str(chat_id)][str(topic_id)][poll_id] = {
+                    'poll_id': poll.poll_id,
+                    'created_at': isoformat(poll.created_at),
+                    'message_id': poll.message_id,
+                    'votes': {str(user_id): serialize_vote(vote, poll.options) for user_id, vote in poll.votes.items()},
+                    'previous_votes': {str(user_id): serialize_vote(vote, poll.options) for user_id, vote in poll.previous_votes.items()},
+                    'report_message_ids': list(poll.report_message_ids),
+                    **poll.settings(),
+                }
+    return data
+
+
+def deserialize_polls(data):
+    active_match_polls = {}
+    for chat_id, topics in data.items():
+        active_match_polls[chat_id] = {}
+        for topic_id, polls in topics.items():
+            active_match_polls[chat_id][topic_id] = {}
+            for poll_id, poll_data in polls.items():
+                poll = MatchPoll.restore(poll_data['poll_id'], from_isoformat(poll_data['created_at']), poll_data.get('message_id'), poll_data)
+                for user_id, vote_data in poll_data.get('previous_votes', {}).items():
+                    poll.add_vote(vote_data['user_id'], poll.option_code(vote_data['option']), from_isoformat(vote_data['timestamp']))
+                    poll.delete_vote(vote_data['user_id'])
+                    restore_vote_history(poll.previous_votes[int(vote_data['user_id'])], vote_data)
+                for user_id, vote_data in poll_data['votes'].items():
+                    poll.add_vote(vote_data['user_id'], poll.option_code(vote_data['option']), from_isoformat(vote_data['timestamp']))
+                    restore_vote_history(poll.votes[int(vote_data['user_id'])], vote_data)
+                poll.report_message_ids = tuple(poll_data.get('report_message_ids', ()))
+                active_match_polls[chat_id][topic_id][poll_id] = poll
+    return active_match_polls
+
+
+def apply_record(active_match_polls, record):
+    """Replays a single journal record on top of the polls loaded from the snapshot"""
+    chat_id = str(record['chat_id'])
+    topic_id = str(record['topic_id'])
+    poll_id = record['poll_id']
+    op = record['op']
+    if op == "create":
+        poll = MatchPoll.restore(poll_id, from_isoformat(record['created_at']), record.get('message_id'), record)
+        active_match_polls.setdefault(chat_id, {}).setdefault(topic_id, {})[poll_id] = poll
+        return
+
+    poll = active_match_polls.get(chat_id, {}).get(topic_id, {}).get(poll_id)
+    if poll is None:
+        logger.warning("Journal record %s refers to unknown poll %s, skipping it", record['seq'], poll_id)
+        return
+    if op == "vote":
+        poll.add_vote(record['user_id'], poll.option_code(record['option']), from_isoformat(record['timestamp']))
+    elif op == "retract":
+        poll.delete_vote(record['user_id'])
+    elif op == "report":
+        poll.report_message_ids = tuple(record['message_ids'])
+    elif op == "close":
+        del active_match_polls[chat_id][topic_id][poll_id]
+
+
+class JournalFollower:
+    """Keeps a copy of the active match polls up to date by reading the journal another process appends to, the
+    way tail -F does. The journal file is kept open, so when a compaction moves it aside the rest of it is still
+    read before following the new one. The sequence numbers of the journal are advanced as records are applied, so
+    the process can take over the journal from where the writer left it"""
+    def __init__(self, journal):
+        self.journal = journal
+        self.polls = {}
+        self.file = None
+        self.inode = None
+        # Last line of the file, until the writer completes it
+        self.partial = ""
+        self.applied = 0
+        self.reloads = 0
+
+    def load(self):
+        # Opened before the snapshot is read, so records appended in between are read afterwards instead of missed
+        self.open()
+        # The writer may be compacting, so its compaction is left alone
+        data, records = self.journal.load(recover=False)
+        self.polls = deserialize_polls(data)
+        for record in records:
+            apply_record(self.polls, record)
+        self.reloads += 1
+
+    def open(self):
+        self.close()
+        try:
+            self.file = open(self.journal.journal_file, "r")
+        except FileNotFoundError:
+            return
+        self.inode = os.fstat(self.file.fileno()).st_ino
+
+    def journal_inode(self):
+        try:
+            return os.stat(self.journal.journal_file).st_ino
+        except FileNotFoundError:
+            return None
+
+    def follow(self):
+        """Applies the records appended since the last call and returns how many there were"""
+        applied = self.read()
+        if self.journal_inode() != self.inode:
+            # Moved aside by a compaction, whose rest was just read: the new journal is read from its start
+            self.open()
+            applied += self.read()
+        return applied
+
+    def read(self):
+        if self.file is None:
+            return 0
+        lines = (self.partial + self.file.read()).split("\n")
+        self.partial = lines.pop()
+        applied = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Ignoring invalid record in %s: %s", self.journal.journal_file, line)
+                continue
+            if record['seq'] <= self.journal.seq:
+                continue
+            if record['seq'] != self.journal.seq + 1:
+                # Records were missed, for instance because the journal was compacted twice between two reads
+                logger.warning("Journal jumped from seq %s to %s, loading the snapshot again", self.journal.seq, record['seq'])
+                self.load()
+                return applied
+            apply_record(self.polls, record)
+            self.journal.seq = record['seq']
+            self.journal.records_since_compaction += 1
+            applied += 1
+        self.applied += applied
+        return applied
+
+    def finish(self):
+        """Reads the journal to its end once its writer is gone, dropping the record a crash left half written so
+        the records appended from now on are not read as part of it"""
+        self.follow()
+        if self.partial and self.file is not None:
+            logger.warning("Dropping a half written journal record: %s", self.partial)
+            size = os.fstat(self.file.fileno()).st_size
+            with open(self.journal.journal_file, "r+b") as f:
+                f.truncate(size - len(self.partial.encode()))
+        self.close()
+        # The writer may have died in the middle of a compaction
+        self.journal.recover_compaction()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.inode = None
+        self.partial = ""
+
+    def stats(self):
+        return {"seq": self.journal.seq, "applied": self.applied, "reloads": self.reloads}
@@ -0,0 +1,54 @@
+import hmac
+import json
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger("footballteambot.WebhookServer")
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+"""Webhook server
+
+Small aiohttp server receiving the updates Telegram POSTs to the webhook. Each request body is decoded and
+handed to handle_update, which only has to queue it, so requests are answered right away and many of them
+can be in flight at the same time. When given metrics, it also serves them on GET /metrics.
+
+"""
+class WebhookServer:
+    def __init__(self, handle_update, listen="127.0.0.1", port=8443, path="/telegram", secret_token=None, metrics=None, metrics_path="/metrics"):
+        self.handle_update = handle_update
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.web_app = web.Application()
+        self.web_app.router.add_post(path, self.handle)
+        if metrics is not None:
+            self.web_app.router.add_get(metrics_path, metrics.handle)
+        self.runner = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.web_app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.listen, self.port)
+        await site.start()
+        logger.info("Webhook server listening on http://%s:%s%s", self.listen, self.port, self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        if self.secret_token is not None:
+            received_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+            if not hmac.compare_digest(received_token, self.secret_token):
+                logger.warning("Rejected webhook request from %s: wrong secret token", request.remote)
+                return web.Response(status=403)
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400, text="Invalid JSON")
+        await self.handle_update(data)
+        return web.Response()
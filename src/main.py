@@ -1,6 +1,24 @@
-from FootballTeamBot import FootballTeamBot
-from sys import argv
+import time
+
+started_at = time.perf_counter()
+
+from Config import Config
+from LogConfig import SHARD_LOG_FORMAT, LOG_FORMAT, configure_logging
 
 if __name__ == "__main__":
-    token = argv[1] if (len(argv) >= 2) else ""
-    FootballTeamBot(token)
+    config = Config.from_args()
+    configure_logging(config.log_level, config.telegram_log_level, SHARD_LOG_FORMAT if config.shards > 0 else LOG_FORMAT)
+    if config.migrate:
+        from Storage import migrate_json_to_sqlite
+        migrate_json_to_sqlite(config.data_dir)
+    elif config.shards > 0 and config.ha:
+        raise SystemExit("--ha and --shards cannot be used together")
+    elif config.shards > 0:
+        from Sharding import ShardDispatcher
+        ShardDispatcher(config).run()
+    else:
+        from FootballTeamBot import FootballTeamBot
+        from Startup import StartupTimer
+        startup = StartupTimer(started_at)
+        startup.mark("imports")
+        FootballTeamBot(config.token, config, startup).run()
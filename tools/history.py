@@ -0,0 +1,74 @@
+"""Queries and exports the match history of closed polls
+
+Prints the availability, response time, option changes and late answers of the members of a team, or exports
+the history of a team or of every team to CSV, or to Parquet when the file ends in .parquet (needs pyarrow).
+Months are given as YYYY-MM. In sharded deployments every shard keeps the history of its chats in its own
+--data-dir, <data_dir>/shard-<n>.
+
+Usage:
+    python tools/history.py stats TEAM_ID [--data-dir .] [--storage json] [--since 2024-09] [--until 2025-06]
+    python tools/history.py export history.csv [--data-dir .] [--team TEAM_ID] [--since 2024-09] [--until 2025-06]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from Config import Config
+from MatchHistory import MatchHistory, late_ranking
+from Storage import make_storage
+
+
+def print_stats(history, team_id, since, until, storage):
+    start = time.perf_counter()
+    stats = history.player_stats(team_id, since, until)
+    elapsed = time.perf_counter() - start
+    if not stats:
+        print(f"No closed polls of team {team_id}")
+        return
+    storage = make_storage(Config(storage=storage, data_dir=os.path.dirname(history.directory)))
+    members = storage.load_chat_members(team_id)
+    storage.close()
+
+    def name(user_id):
+        member = members.get(str(user_id), {})
+        return member.get("username") or member.get("full_name") or str(user_id)
+
+    # Teams with poll templates may have answered other options than the default ones
+    options = list(dict.fromkeys(option for player in stats.values() for option in player["options"]))
+    print(f"{'member':<24} | {'polls':>5} | {'answered':>8} | " + " | ".join(f"{option:>10}" for option in options)
+          + f" | {'available':>9} | {'latency':>9} | {'changes':>7} | {'late':>4}")
+    for user_id, player in sorted(stats.items(), key=lambda item: item[1]["availability"], reverse=True):
+        print(f"{name(user_id):<24} | {player['polls']:>5} | {player['answered']:>8} | " + " | ".join(f"{player['options'].get(option, 0):>10}" for option in options)
+              + f" | {player['availability']:>9.0%} | {player['latency_hours']:>7.1f} h | {player['changes_per_poll']:>7.2f} | {player['late']:>4}")
+    print("Latest to answer: " + ", ".join(name(user_id) for user_id, _ in late_ranking(stats, 5)))
+    print(f"Computed in {elapsed * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query and export the match history of closed polls")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats_command = commands.add_parser("stats", help="Statistics of the members of a team")
+    stats_command.add_argument("team", help="Chat id of the team")
+    stats_command.add_argument("--storage", choices=["json", "sqlite"], default="json", help="Storage the member names are read from")
+    export_command = commands.add_parser("export", help="Export one row per answer to CSV or Parquet")
+    export_command.add_argument("file", help="Output file, Parquet if it ends in .parquet and CSV otherwise")
+    export_command.add_argument("--team", help="Chat id of the team, every team if not given")
+    for command in (stats_command, export_command):
+        command.add_argument("--data-dir", default=".", help="Directory holding the storage files of the bot")
+        command.add_argument("--since", help="First month, YYYY-MM")
+        command.add_argument("--until", help="Last month, YYYY-MM")
+    args = parser.parse_args()
+
+    history = MatchHistory(os.path.join(args.data_dir, "history"))
+    if args.command == "stats":
+        print_stats(history, args.team, args.since, args.until, args.storage)
+    else:
+        start = time.perf_counter()
+        try:
+            rows = history.export(args.file, args.team, args.since, args.until)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        print(f"Exported {rows} rows to {args.file} in {time.perf_counter() - start:.2f}s")
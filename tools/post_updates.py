@@ -0,0 +1,44 @@
+"""POSTs recorded Telegram updates to a running webhook server
+
+Each line of the input file is the JSON of one Update, as Telegram sends it. Start the bot with
+--webhook --offline to try them without contacting Telegram.
+
+Usage: python tools/post_updates.py updates.jsonl [--url http://127.0.0.1:8443/telegram] [--secret-token TOKEN] [--concurrency 1]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import ClientSession
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def post_updates(updates, url, secret_token, concurrency):
+    headers = {SECRET_TOKEN_HEADER: secret_token} if secret_token else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def post(session, update):
+        async with semaphore:
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    start = time.monotonic()
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    elapsed = time.monotonic() - start
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s. Responses: {statuses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="POST recorded updates to the bot webhook")
+    parser.add_argument("updates", help="JSONL file with one Update per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret-token")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at the same time. Keep 1 to preserve the order")
+    args = parser.parse_args()
+    with open(args.updates) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    asyncio.run(post_updates(updates, args.url, args.secret_token, args.concurrency))
@@ -0,0 +1,79 @@
+"""Shows, sets and tries the poll templates of a team
+
+Templates are read from a JSON file holding a list of objects with a name and a pattern, and optionally a
+question, options, deadline_hours and reminders, for instance:
+
+    [{"name": "liga", "pattern": "^J\\d+\\s*-", "deadline_hours": 72, "reminders": [48, 24]},
+     {"name": "entreno", "pattern": "^Entreno", "question": "¿Vienes al entreno?", "options": ["Sí", "No"]}]
+
+A running bot picks the changes up within --teams-reload seconds, for polls created from then on. In sharded
+deployments the team lives in the --data-dir of its shard, <data_dir>/shard-<n>.
+
+Usage:
+    python tools/templates.py show TEAM_ID [--data-dir .] [--storage json]
+    python tools/templates.py set TEAM_ID templates.json [--data-dir .] [--storage json]
+    python tools/templates.py reset TEAM_ID [--data-dir .] [--storage json]
+    python tools/templates.py try TEAM_ID "J12 - Rival" [--data-dir .] [--storage json]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from Config import Config
+from PollTemplate import PollTemplate
+from Storage import make_storage
+
+
+def print_templates(team):
+    if not team.templates:
+        print(f"{team.name} uses the default template")
+    for template in team.templates:
+        print(json.dumps(template.to_dict(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show, set and try the poll templates of a team")
+    commands = parser.add_subparsers(dest="command", required=True)
+    subcommands = {}
+    for name, help in (("show", "Print the templates of a team"), ("set", "Replace the templates of a team with the ones in a JSON file"),
+                       ("reset", "Go back to the default template"), ("try", "Print the template a topic title would get")):
+        command = subcommands[name] = commands.add_parser(name, help=help)
+        command.add_argument("team", help="Chat id of the team")
+        command.add_argument("--data-dir", default=".", help="Directory holding the storage files of the bot")
+        command.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    subcommands["set"].add_argument("file", help="JSON file with the list of templates")
+    subcommands["try"].add_argument("title", help="Title of the topic")
+    args = parser.parse_args()
+
+    storage = make_storage(Config(storage=args.storage, data_dir=args.data_dir))
+    teams = storage.load_teams()
+    team = teams.get(args.team)
+    if team is None:
+        storage.close()
+        sys.exit(f"Team {args.team} is not registered")
+
+    if args.command == "set":
+        with open(args.file) as f:
+            templates_data = json.load(f)
+        try:
+            # Invalid templates are rejected here instead of being left out by the bot
+            templates = [PollTemplate.from_dict(data) for data in templates_data]
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            storage.close()
+            sys.exit(f"Invalid template: {e}")
+        team.templates = tuple(templates)
+        storage.save_teams(teams, args.team)
+    elif args.command == "reset":
+        team.templates = ()
+        storage.save_teams(teams, args.team)
+
+    if args.command == "try":
+        template = team.match(args.title)
+        print(f"No template matches {args.title!r}" if template is None else json.dumps(template.to_dict(), ensure_ascii=False))
+    else:
+        print_templates(team)
+    storage.close()